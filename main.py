@@ -7,7 +7,20 @@
 @lastEditTime: 
 @Description: 
 """
-from rmq.receive import Receive
+from rmq.receive import Receive, Queue
+from utils.util_retention import Retention
+from utils.util_tiering import Tiering
 
-receive = Receive()
+tiering = Tiering()
+if tiering.enabled:
+    tiering.start()
+retention = Retention()
+if retention.enabled:
+    retention.start()
+
+if Queue().engine == 'asyncio':
+    from rmq.async_receive import AsyncReceive
+    receive = AsyncReceive()
+else:
+    receive = Receive()
 receive.run()
@@ -0,0 +1,274 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_16:30
+@FileName:async_receive.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 基于asyncio的接收引擎：控制队列和所有数据队列运行在同一个事件循环中，解码和写入在进程池中执行
+"""
+import asyncio
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from rmq.receive import Queue, handle_message_wait, publish_metrics
+
+QUEUE_ARGUMENTS = {
+    'x-queue-mode': 'lazy'  # 设置队列为惰性模式
+}
+
+
+class AsyncDataQueue(object):
+    """
+    单个数据传输队列：消息按接收顺序逐条交给进程池处理，处理成功后批量确认
+    """
+
+    def __init__(self, engine, queue_name):
+        self.engine = engine
+        self.queue_name = queue_name
+        self.channel = None
+        self.consumer_tag = None
+        self.items = asyncio.Queue()
+        self.task = None
+
+    def open(self, connection) -> None:
+        """
+        在连接上打开channel并开始消费，重连后再次调用
+        """
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_channel_open(self, channel):
+        self.channel = channel
+        channel.queue_declare(queue=self.queue_name, durable=True, arguments=QUEUE_ARGUMENTS,
+                              callback=lambda _: self._on_declared(channel))
+
+    def _on_declared(self, channel):
+        if self.engine.queue.auto_ack:
+            self._consume(channel)
+        else:
+            channel.basic_qos(prefetch_count=self.engine.queue.prefetch_count, callback=lambda _: self._consume(channel))
+
+    def _consume(self, channel):
+        self.consumer_tag = channel.basic_consume(queue=self.queue_name, on_message_callback=self._on_message,
+                                                  auto_ack=self.engine.queue.auto_ack)
+        if self.task is None:
+            self.task = asyncio.get_event_loop().create_task(self._work())
+        print(f' [{self.queue_name}] Waiting for messages.')
+
+    def _on_message(self, channel, method, properties, body):
+        self.items.put_nowait((channel, method.delivery_tag, body))
+
+    async def _work(self):
+        q = self.engine.queue
+        loop = asyncio.get_event_loop()
+        pending, count = None, 0  # 等待确认的(channel, delivery_tag)和累计数量
+        while True:
+            item = await self.items.get()
+            if item is None:
+                break
+            channel, tag, body = item
+            print(f"[{self.queue_name}] receive data success!!")
+            try:
+                ok = await loop.run_in_executor(self.engine.executor, handle_message_wait, body)
+            except Exception as e:
+                print(f"An error occurred: {e} in AsyncDataQueue._work")
+                ok = False
+            # 自动确认，或者channel已断开（消息会由RabbitMQ重新投递）
+            if q.auto_ack or not channel.is_open:
+                continue
+            if pending is not None and (pending[0] is not channel or not ok):
+                self._ack(*pending)
+                pending, count = None, 0
+            if ok:
+                pending, count = (channel, tag), count + 1
+            else:
+                channel.basic_nack(delivery_tag=tag, requeue=q.requeue)
+            if pending is not None and (count >= q.ack_batch or self.items.empty()):
+                self._ack(*pending)
+                pending, count = None, 0
+        if pending is not None:
+            self._ack(*pending)
+        if self.channel is not None and self.channel.is_open:
+            self.channel.close()
+        print(f"Stopped consuming from {self.queue_name}")
+
+    @staticmethod
+    def _ack(channel, tag):
+        if channel.is_open:
+            channel.basic_ack(delivery_tag=tag, multiple=True)
+
+    def stop(self) -> None:
+        """
+        立即停止接收新消息，已接收的消息处理完成后关闭channel
+        """
+        if self.channel is not None and self.channel.is_open and self.consumer_tag is not None:
+            self.channel.basic_cancel(self.consumer_tag)
+        self.items.put_nowait(None)
+
+
+class AsyncReceive(object):
+    """
+    asyncio接收主类，与Receive提供相同的队列启停语义
+    """
+
+    def __init__(self):
+        self._queue = Queue()
+        self._loop = None
+        self._executor = None
+        self._connection = None
+        self._control_channel = None
+        self._data_queues = {}
+        self._closing = False
+        self.reconnects = 0
+
+    @property
+    def queue(self):
+        return self._queue
+
+    @property
+    def executor(self):
+        return self._executor
+
+    def metrics(self) -> dict:
+        """
+        连接数、channel数、重连次数和正在消费的队列
+        """
+        channels = [dq.channel for dq in self._data_queues.values()] + [self._control_channel]
+        return {
+            'connections': 1 if self._connection is not None and self._connection.is_open else 0,
+            'channels': sum(1 for ch in channels if ch is not None and ch.is_open),
+            'reconnects': self.reconnects,
+            'queues': sorted(self._data_queues.keys())
+        }
+
+    def start_or_stop_queue(self, queue_name, status):
+        """
+        启停数据传输队列，在事件循环中立即生效
+        :param queue_name:
+        :param status:
+        :return:
+        """
+        if status == 'start':
+            if queue_name in self._data_queues:
+                print(f"Queue {queue_name} is already running.")
+                return
+            dq = AsyncDataQueue(self, queue_name)
+            self._data_queues[queue_name] = dq
+            if self._connection is not None and self._connection.is_open:
+                dq.open(self._connection)
+            print(f"Started config queue: {queue_name}")
+        elif status == 'stop':
+            dq = self._data_queues.pop(queue_name, None)
+            if dq is None:
+                print(f"Queue {queue_name} is not running.")
+                return
+            print(f"Requesting stop for config queue: {queue_name}")
+            dq.stop()
+
+    def _connect(self):
+        q = self.queue
+        credentials = pika.PlainCredentials(username=q.username, password=q.password)
+        parameters = pika.ConnectionParameters(host=q.host, port=q.port, virtual_host=q.virtual_host,
+                                               credentials=credentials, heartbeat=q.heartbeat)
+        self._connection = AsyncioConnection(parameters, on_open_callback=self._on_open,
+                                             on_open_error_callback=self._on_open_error,
+                                             on_close_callback=self._on_closed, custom_ioloop=self._loop)
+
+    def _reconnect(self):
+        if self._closing:
+            return
+        self.reconnects += 1
+        self._loop.call_later(self.queue.reconnect_delay, self._connect)
+
+    def _on_open(self, connection):
+        connection.channel(on_open_callback=self._on_control_channel_open)
+        for dq in self._data_queues.values():
+            dq.open(connection)
+
+    def _on_open_error(self, connection, err):
+        print(f"An error occurred: {err} in AsyncReceive, reconnect after {self.queue.reconnect_delay}s")
+        self._reconnect()
+
+    def _on_closed(self, connection, reason):
+        self._control_channel = None
+        if self._closing:
+            self._loop.stop()
+        else:
+            print(f"Connection closed: {reason}, reconnect after {self.queue.reconnect_delay}s")
+            self._reconnect()
+
+    def _on_control_channel_open(self, channel):
+        q = self.queue
+        self._control_channel = channel
+
+        def consume(_):
+            channel.basic_consume(queue=q.queue, on_message_callback=self._on_control_message, auto_ack=q.auto_ack)
+            print(f' [{q.queue}] Waiting for messages. To exit press CTRL+C')
+
+        def declared(_):
+            channel.basic_qos(prefetch_count=1, callback=consume) if not q.auto_ack else consume(None)
+
+        channel.queue_declare(queue=q.queue, durable=True, arguments=QUEUE_ARGUMENTS, callback=declared)
+        if q.metrics_queue:
+            channel.queue_declare(queue=q.metrics_queue, durable=True, arguments=QUEUE_ARGUMENTS)
+
+    def _report(self):
+        """
+        定期在控制channel上发送接收端指标
+        """
+        q = self.queue
+        channel = self._control_channel
+        if channel is not None and channel.is_open:
+            try:
+                publish_metrics(channel, q.metrics_queue, self.metrics())
+            except Exception as e:
+                print(f"An error occurred: {e} in AsyncReceive._report")
+        if not self._closing:
+            self._loop.call_later(q.metrics_interval, self._report)
+
+    def _on_control_message(self, channel, method, properties, body):
+        if not body:
+            print("no body")
+        else:
+            print("receiving queues and status")
+            message = json.loads(body)
+            queues = message.get('queues', None)
+            if queues is not None:
+                for k, v in queues.items():
+                    self.start_or_stop_queue(k, v)
+        if not self.queue.auto_ack:
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    async def _shutdown(self):
+        self._closing = True
+        for queue_name in list(self._data_queues.keys()):
+            self.start_or_stop_queue(queue_name, 'stop')
+        tasks = [t for t in asyncio.all_tasks(self._loop) if t is not asyncio.current_task()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._connection is not None and not (self._connection.is_closing or self._connection.is_closed):
+            self._connection.close()
+
+    def run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._executor = ProcessPoolExecutor(max_workers=self.queue.workers or None)
+        self._connect()
+        if self.queue.metrics_queue:
+            self._loop.call_later(self.queue.metrics_interval, self._report)
+        try:
+            self._loop.run_forever()
+        except KeyboardInterrupt:
+            self._loop.run_until_complete(self._shutdown())
+            if not self._connection.is_closed:
+                self._loop.run_forever()
+        finally:
+            self._executor.shutdown(wait=True)
+            self._loop.close()
+
+
+if __name__ == '__main__':
+    receive = AsyncReceive()
+    receive.run()
@@ -0,0 +1,245 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_15:10
+@FileName:connection.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: AMQP连接管理：所有数据队列以channel的形式复用少量连接，断线自动重连
+"""
+import abc
+import queue
+import threading
+import zlib
+
+import pika
+
+
+class Consumer(abc.ABC):
+    """
+    连接管理器中的队列消费者接口，所有方法都在连接所在线程调用
+    """
+
+    @abc.abstractmethod
+    def open(self, channel) -> None:
+        """
+        在新的channel上开始消费，重连后会在新的channel上再次调用
+        """
+
+    def tick(self) -> None:
+        """
+        每次处理完网络事件后调用，用于发送累计的确认等周期性工作
+        """
+        pass
+
+    def stop(self) -> None:
+        """
+        停止接收新消息
+        """
+        pass
+
+    def drained(self) -> bool:
+        """
+        停止后是否可以关闭channel
+        """
+        return True
+
+
+class ConnectionWorker(threading.Thread):
+    """
+    单个AMQP连接及其I/O线程，BlockingConnection不是线程安全的，channel的所有操作都在本线程完成
+    """
+
+    def __init__(self, parameters, index, reconnect_delay=5):
+        super().__init__(name=f"amqp-connection-{index}", daemon=True)
+        self._parameters = parameters
+        self._reconnect_delay = reconnect_delay
+        self._connection = None
+        self._consumers = {}  # 队列名称 -> Consumer
+        self._channels = {}  # 队列名称 -> channel
+        self._closing = {}  # 正在停止的队列名称 -> (Consumer, 停止完成事件)
+        self._commands = queue.Queue()
+        self._stopping = threading.Event()
+        self.reconnects = 0
+
+    @property
+    def connected(self) -> bool:
+        return self._connection is not None and self._connection.is_open
+
+    @property
+    def channel_count(self) -> int:
+        return len(self._channels)
+
+    @property
+    def queues(self) -> list:
+        return list(self._consumers.keys())
+
+    def add(self, queue_name, consumer: Consumer) -> None:
+        self._command(('add', queue_name, consumer, None))
+
+    def remove(self, queue_name) -> threading.Event:
+        event = threading.Event()
+        self._command(('remove', queue_name, None, event))
+        return event
+
+    def shutdown(self) -> None:
+        self._stopping.set()
+        self._wakeup()
+
+    def _command(self, command) -> None:
+        self._commands.put(command)
+        self._wakeup()
+
+    def _wakeup(self) -> None:
+        # 唤醒阻塞在process_data_events中的I/O线程
+        conn = self._connection
+        if conn is not None:
+            try:
+                conn.add_callback_threadsafe(lambda: None)
+            except Exception:
+                pass
+
+    def _open_channel(self, queue_name, consumer: Consumer) -> None:
+        channel = self._connection.channel()
+        consumer.open(channel)
+        self._channels[queue_name] = channel
+
+    def _close_channel(self, queue_name) -> None:
+        channel = self._channels.pop(queue_name, None)
+        if channel is not None and channel.is_open:
+            channel.close()
+
+    def _connect(self) -> None:
+        self._connection = pika.BlockingConnection(self._parameters)
+        self._channels = {}
+        for queue_name, consumer in self._consumers.items():
+            self._open_channel(queue_name, consumer)
+        # 重连时正在停止的队列直接视为停止完成
+        for queue_name, (_, event) in list(self._closing.items()):
+            event.set()
+        self._closing = {}
+
+    def _run_commands(self) -> None:
+        while True:
+            try:
+                action, queue_name, consumer, event = self._commands.get_nowait()
+            except queue.Empty:
+                return
+            if action == 'add':
+                if queue_name in self._consumers:
+                    continue
+                self._consumers[queue_name] = consumer
+                if self.connected:
+                    self._open_channel(queue_name, consumer)
+            elif action == 'remove':
+                consumer = self._consumers.pop(queue_name, None)
+                if consumer is None or not self.connected:
+                    self._channels.pop(queue_name, None)
+                    event.set()
+                    continue
+                consumer.stop()
+                self._closing[queue_name] = (consumer, event)
+
+    def _tick(self) -> None:
+        for consumer in list(self._consumers.values()):
+            consumer.tick()
+        for queue_name, (consumer, event) in list(self._closing.items()):
+            consumer.tick()
+            if consumer.drained():
+                self._close_channel(queue_name)
+                del self._closing[queue_name]
+                event.set()
+
+    def run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                if not self.connected:
+                    self._connect()
+                self._run_commands()
+                self._connection.process_data_events(time_limit=1)
+                self._tick()
+            except Exception as e:
+                print(f"An error occurred: {e} in {self.name}, reconnect after {self._reconnect_delay}s")
+                self._connection = None
+                self.reconnects += 1
+                self._stopping.wait(self._reconnect_delay)
+        for queue_name in list(self._channels.keys()):
+            try:
+                self._close_channel(queue_name)
+            except Exception:
+                pass
+        if self.connected:
+            self._connection.close()
+
+
+class ConnectionManager(object):
+    """
+    AMQP连接管理器：数据队列按名称固定分配到少量连接上，每个队列占用一个channel
+    """
+
+    def __init__(self, username, password, host, port, virtual_host, connections=1, heartbeat=60,
+                 reconnect_delay=5):
+        credentials = pika.PlainCredentials(username=username, password=password)
+        self._parameters = pika.ConnectionParameters(host=host, port=port, virtual_host=virtual_host,
+                                                     credentials=credentials, heartbeat=heartbeat)
+        self._workers = [ConnectionWorker(self._parameters, i, reconnect_delay) for i in range(max(1, connections))]
+        self._queues = set()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self) -> None:
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for worker in self._workers:
+            worker.start()
+
+    def _worker(self, queue_name) -> ConnectionWorker:
+        return self._workers[zlib.crc32(str(queue_name).encode('utf-8')) % len(self._workers)]
+
+    def has_queue(self, queue_name) -> bool:
+        with self._lock:
+            return queue_name in self._queues
+
+    def add_queue(self, queue_name, consumer: Consumer) -> bool:
+        """
+        开始消费指定队列
+        :return: 队列已在消费时返回False
+        """
+        self.start()
+        with self._lock:
+            if queue_name in self._queues:
+                return False
+            self._queues.add(queue_name)
+        self._worker(queue_name).add(queue_name, consumer)
+        return True
+
+    def remove_queue(self, queue_name, timeout=None) -> bool:
+        """
+        停止消费指定队列，等待已接收的消息处理完成后关闭channel
+        :return: 是否在超时前停止完成
+        """
+        with self._lock:
+            if queue_name not in self._queues:
+                return False
+            self._queues.discard(queue_name)
+        return self._worker(queue_name).remove(queue_name).wait(timeout)
+
+    def metrics(self) -> dict:
+        """
+        连接数、channel数、累计重连次数和正在消费的队列
+        """
+        return {
+            'connections': sum(1 for w in self._workers if w.connected),
+            'channels': sum(w.channel_count for w in self._workers),
+            'reconnects': sum(w.reconnects for w in self._workers),
+            'queues': sorted(self._queues)
+        }
+
+    def close(self) -> None:
+        for worker in self._workers:
+            worker.shutdown()
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.join()
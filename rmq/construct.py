@@ -13,6 +13,7 @@ import csv
 import datetime
 import math
 import os
+from collections.abc import Mapping
 from typing import List
 
 import numpy as np
@@ -22,19 +23,95 @@ from open3d.cpu.pybind.geometry import PointCloud
 from pandas import DataFrame
 import open3d as o3d
 
+from utils.util_grid import segment_points, cell_stats
+from utils.util_series import SeriesStore, has_store
 from utils.util_rabbitmq import get_line, is_init, pcd2df, find_max_folder, compare_df_len
 
 
 class Region(object):
     """
     投影面类：xy轴形成的投影面
+    紧凑存储：所有点按区域排序后保存在一个连续数组中，offsets记录每个区域的起止位置（CSR格式），
+    cells记录有数据的区域索引；get_pcds()按区域返回DataFrame视图，兼容原有的字典访问方式
     """
     MAX_X, MIN_X = 0, 60  # 投影面x轴的范围，单位米
     MAX_Y, MIN_Y = -10, 10  # 投影面y轴的范围，单位米
     GRID_SIZE = 0.5  # 投影面每个网格的大小，单位米
 
     def __init__(self):
-        self.pcds = {}  # 子区域点云字典，索引：数据
+        self.pcds = {}  # 子区域点云字典，索引：数据（非紧凑存储时使用）
+        self.points = None  # 按区域排序后的点云坐标数组 (N, 3)
+        self.offsets = None  # 区域偏移数组，第i个区域的数据为points[offsets[i]:offsets[i + 1]]
+        self.cells = None  # 有数据的区域索引
+        self.colors = None  # 区域颜色数组 (区域数量, 3)
+
+    @classmethod
+    def from_arrays(cls, points, offsets, cells, colors=None):
+        """
+        由区域划分结果构造紧凑存储的Region对象
+        :param points: 按区域排序后的点云坐标数组
+        :param offsets: 区域偏移数组，长度为区域数量+1
+        :param cells: 有数据的区域索引
+        :param colors: 区域颜色数组
+        :return: Region对象
+        """
+        region = cls()
+        region.points = points
+        region.offsets = np.asarray(offsets, dtype=np.int64)
+        region.cells = np.asarray(cells, dtype=np.int64)
+        region.colors = colors
+        return region
+
+    @classmethod
+    def grid(cls) -> tuple:
+        """
+        区域划分使用的投影面网格，写入Morton布局的打包文件
+        :return: (MIN_X, MAX_X, MIN_Y, MAX_Y, GRID_SIZE)
+        """
+        return cls.MIN_X, cls.MAX_X, cls.MIN_Y, cls.MAX_Y, cls.GRID_SIZE
+
+    def __setstate__(self, state):
+        # 兼容旧版本只包含pcds字典的序列化数据
+        self.__init__()
+        self.__dict__.update(state)
+
+    @property
+    def compact(self) -> bool:
+        """
+        是否为紧凑存储
+        """
+        return self.points is not None
+
+    @property
+    def cell_count(self) -> int:
+        """
+        区域数量
+        """
+        return len(self.offsets) - 1 if self.compact else len(self.pcds)
+
+    def get_cell(self, index):
+        """
+        获取区域的坐标数组视图，不复制数据
+        :param index: 区域索引
+        :return: (n, 3) 坐标数组，区域没有数据时长度为0
+        """
+        return self.points[self.offsets[index]:self.offsets[index + 1]]
+
+    def get_pcd(self, index):
+        """
+        获取单个区域的点云数据
+        :param index: 区域索引
+        :return: DataFrame格式点云数据，区域没有数据时返回None
+        """
+        if not self.compact:
+            return self.pcds.get(index)
+        points = self.get_cell(index)
+        if len(points) == 0:
+            return None
+        df = pd.DataFrame(points, columns=['X', 'Y', 'Z'], copy=False)
+        if self.colors is not None:
+            df['R'], df['G'], df['B'] = self.colors[index]
+        return df
 
     def set_pcd(self, index, pcd) -> None:
         """
@@ -43,6 +120,10 @@ class Region(object):
         :param pcd: DataFrame格式点云数据
         :return: None
         """
+        if self.compact:
+            # 修改单个区域时退化为字典存储
+            self.pcds = dict(self.get_pcds())
+            self.points = self.offsets = self.cells = self.colors = None
         self.pcds[index] = pcd
 
     def get_pcds(self):
@@ -50,7 +131,43 @@ class Region(object):
         获取子区域点云列表
         :return:
         """
-        return self.pcds
+        return RegionPcds(self) if self.compact else self.pcds
+
+    def get_stats(self, percentiles=(5, 50, 95)) -> dict:
+        """
+        一次计算所有区域Z坐标的统计量：数量、均值、最小值、最大值、标准差和分位数
+        :param percentiles: 需要计算的分位数
+        :return: dict，值为长度等于区域数量的数组，没有数据的区域为nan
+        """
+        if self.compact:
+            counts = np.diff(self.offsets)
+            z_vals = self.points[:, 2]
+        else:
+            dfs = list(self.pcds.values())
+            counts = np.array([0 if df is None else len(df) for df in dfs], dtype=np.int64)
+            z_vals = np.concatenate([df['Z'].values for df in dfs if df is not None] or [np.empty(0)])
+        index = np.repeat(np.arange(len(counts)), counts)
+        return cell_stats(z_vals, index, len(counts), percentiles)
+
+
+class RegionPcds(Mapping):
+    """
+    紧凑存储Region的只读字典视图：区域索引 -> DataFrame/None
+    """
+
+    def __init__(self, region: Region):
+        self._region = region
+
+    def __getitem__(self, index):
+        if not isinstance(index, (int, np.integer)) or not 0 <= index < len(self):
+            raise KeyError(index)
+        return self._region.get_pcd(index)
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __len__(self):
+        return self._region.cell_count
 
 
 class AnomalyPointCloudData(object):
@@ -313,6 +430,21 @@ def calculate_data(pcds: dict, init: bool, config: configparser.ConfigParser):
     return column_list, res_pcds
 
 
+def calculate_stats(z_avg, init: bool, config: configparser.ConfigParser):
+    """
+    与calculate_data相同的列选择规则，直接作用于区域统计量数组
+    :param z_avg: 每个区域的Z均值数组
+    :param init: 是否在初始化阶段
+    :param config: 配置文件对象
+    :return: 列名列表和一行时序数据
+    """
+    if init:
+        return None, z_avg.tolist()
+    column_list = ast.literal_eval(config.get("detect", "column"))
+    vals = [z_avg[int(c)] if 0 <= int(c) < len(z_avg) else math.nan for c in column_list]
+    return column_list, vals
+
+
 class Segment(object):
     """
     点云区域划分类：根据点云投影到固定的xy投影面的区域划分点云
@@ -341,6 +473,23 @@ class Segment(object):
 
     @staticmethod
     def subdivide(data: DataFrame) -> Region:
+        """
+        划分子区域：一次性计算所有点的区域索引，通过一次稳定排序完成分组
+        区域索引的计算方式与subdivide_loop一致，落在投影面之外的点会被丢弃
+        :param data: 原始数据
+        :return: 划分结果，Region对象
+        """
+        # 提取x, y, z坐标信息
+        points = data[['X', 'Y', 'Z']].values
+        sorted_points, offsets, occupied, n_cells = segment_points(points, Region.MIN_X, Region.MAX_X, Region.MIN_Y,
+                                                                   Region.MAX_Y, Region.GRID_SIZE)
+        # 创建颜色映射
+        colors = np.random.rand(n_cells, 3)  # 随机生成颜色
+        return Region.from_arrays(sorted_points, offsets, occupied, colors)
+
+    @staticmethod
+    @deprecated(reason="Use subdivide()")
+    def subdivide_loop(data: DataFrame) -> Region:
         """
         划分子区域
         :param data: 原始数据
@@ -610,42 +759,16 @@ class Merge(object):
         region = point_cloud.get_region()
         if region is None:
             return
-        pcd_dict = region.get_pcds()
-        # pcds = list(regions.get_pcds().values())
-
-        # 用于创建文件，初始化csv文件头
-        ssd = SingleSeriesData(len(pcd_dict))
-        # 初始化文件夹对象
-        tsf = TimeSeriesFile(length=130, directory_path=curr_directory)
-        # 检索文件夹中有没有文件
-        if not TimeSeriesFile.check_for_csv_files(directory_path=curr_directory):
-            # 没有文件夹则创建文件
-            tsf.set_count(0)
-            tsf.create_new_file(ssd, directory_path=curr_directory)
+        # 打开时序数据存储，目录中只有旧版CSV文件时先导入
+        if has_store(curr_directory) or not TimeSeriesFile.check_for_csv_files(directory_path=curr_directory):
+            store = SeriesStore(curr_directory, region.cell_count)
         else:
-            # 有文件，则检索最新的文件名称
-            last_file = TimeSeriesFile.get_max_csv_file(directory_path=curr_directory)
-            if last_file is not None:
-                # 根据文件名重设count
-                tsf.set_count(int(os.path.splitext(last_file)[0]))
-
-        # 构建当前时序数据文件路径
-        current_series_path = os.path.join(tsf.get_directory_path(), f"{tsf.count}.csv")
-        # 检查当前文件行数
-        length = tsf.get_length()
-        line = TimeSeriesFile.get_csv_row_count(current_series_path)
-        empty = length - line
-        # 检查当前文件中是否还可以插入数据
-        if 0 < empty <= length:  # 若有剩余空间
-            # 设置剩余空间
-            tsf.set_empty(empty)
-        elif empty <= 0:  # 若没有剩余空间则创建新的文件
-            tsf.set_count(tsf.get_count() + 1)
-            current_series_path = tsf.create_new_file(ssd, directory_path=curr_directory)
-        # 组合数据，注意初始化阶段和非初始化阶段有所不同
-        column_list, res_pcds = calculate_data(pcd_dict, init, config)
-        # 将数据写入文件
-        Merge.merge_data(res_pcds, current_series_path, ssd, column_list)
+            store = SeriesStore.import_csv(curr_directory, region.cell_count)
+        # 一次计算所有区域的统计量，组合数据，注意初始化阶段和非初始化阶段有所不同
+        stats = region.get_stats()
+        column_list, z_avg = calculate_stats(stats['mean'], init, config)
+        # 追加一行定长记录，不需要读取已有数据
+        store.append(point_cloud.get_time(), z_avg, column_list)
 
     @staticmethod
     def update_df(file_line, max_csv_path, max_csv_name, update_data,
@@ -695,6 +818,13 @@ class Merge(object):
         :param directory:
         :return:
         """
+        if has_store(directory):
+            # 定长记录直接原地修改最后几行
+            try:
+                return SeriesStore(directory).amend_tail(data.values, data.columns) == len(data)
+            except Exception as e:
+                print(f"An error occurred: {e} in update_df_merge")
+                return False
         max_csv_path, max_csv_name = find_max_folder(directory)
         if max_csv_path is None:
             return False
@@ -704,6 +834,20 @@ class Merge(object):
         return Merge.update_df(file_line, max_csv_path, max_csv_name, data, directory)
 
     @staticmethod
+    @deprecated(reason="Use SeriesStore.append()")
+    def merge_stats(z_avg: list, file, ssd: SingleSeriesData, column_list: list) -> None:
+        """
+        :param z_avg: 一行时序数据，由Region.get_stats()计算的区域Z均值
+        :param file: 时序数据保存路径
+        :param ssd: SingleSeriesData对象，用于构造DataFrame数据对象
+        :param column_list: 列名
+        :return: None
+        """
+        series_df = ssd.get_df(z_avg, columns=column_list)
+        Merge.merge_write(series_df, file)
+
+    @staticmethod
+    @deprecated(reason="Use merge_stats()")
     def merge_data(vals: dict, file, ssd: SingleSeriesData, column_list: list) -> None:
         """
         :param vals: 一行时序数据
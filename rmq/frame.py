@@ -0,0 +1,201 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_11:20
+@FileName:frame.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 点云消息二进制帧格式：替代base64+pickle，解码时直接包装原始缓冲区，不复制点云数据
+
+帧结构（小端序）：
+    头部      magic(4s) version(B) flags(B) reserved(H) time_us(q) high(f) n_points(I) n_anomaly(I) device_len(H)
+    设备id    utf-8，补齐到4字节对齐
+    点云坐标  float32 * n_points * 3
+    点云颜色  uint8 * n_points * 3（flags含FLAG_RGB时存在）
+    异常信息  region int32 * n_anomaly, position float32 * n_anomaly * 3, bas float64 * n_anomaly,
+              degree uint8 * n_anomaly
+"""
+import base64
+import io
+import pickle
+import struct
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+from rmq.construct import Tunnel, PointCloudData, AnomalyPointCloudData, Segment
+
+MAGIC = b'TPCF'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHqfIIH')
+
+FLAG_INIT = 0x01  # 初始化阶段数据
+FLAG_RGB = 0x02  # 包含颜色数据
+
+EPOCH = datetime(1970, 1, 1)  # 不带时区，带时区的采集时间先转换为UTC
+DEGREES = {1: '一', 2: '二', 3: '三'}  # 预警等级编码
+
+
+def _align(n, size=4):
+    return (n + size - 1) // size * size
+
+
+def _time_us(time: datetime) -> int:
+    if time.tzinfo is not None:
+        time = time.astimezone(timezone.utc).replace(tzinfo=None)
+    return (time - EPOCH) // timedelta(microseconds=1)
+
+
+def _degree2code(degree):
+    if isinstance(degree, str):
+        for code, name in DEGREES.items():
+            if name == degree:
+                return code
+        return 0
+    return int(degree)
+
+
+def encode_frame(device_id: str, time: datetime, init: bool, high, points, colors=None, anomaly: dict = None) -> bytes:
+    """
+    编码一帧点云消息
+    :param device_id: 采集设备编号
+    :param time: 点云采集时间，带时区时按UTC编码，解码得到不带时区的UTC时间
+    :param init: 是否处于初始化阶段
+    :param high: 隧道实际高度
+    :param points: (N, 3) 点云坐标
+    :param colors: (N, 3) 0~255点云颜色，可选
+    :param anomaly: 异常描述信息 {区域索引: [position, bas, degree]}，可选
+    :return: 二进制帧
+    """
+    points = np.ascontiguousarray(points, dtype='<f4').reshape(-1, 3)
+    anomaly = anomaly or {}
+    flags = (FLAG_INIT if init else 0) | (FLAG_RGB if colors is not None else 0)
+    device = str(device_id).encode('utf-8')
+    time_us = _time_us(time)
+
+    parts = [HEADER.pack(MAGIC, VERSION, flags, 0, time_us, float(high), len(points), len(anomaly), len(device)),
+             device, b'\0' * (_align(HEADER.size + len(device)) - HEADER.size - len(device)),
+             points.tobytes()]
+    if colors is not None:
+        parts.append(np.ascontiguousarray(colors, dtype=np.uint8).reshape(-1, 3).tobytes())
+    if anomaly:
+        keys = list(anomaly.keys())
+        parts.append(np.asarray([int(k) for k in keys], dtype='<i4').tobytes())
+        parts.append(np.asarray([anomaly[k][0] for k in keys], dtype='<f4').reshape(-1, 3).tobytes())
+        parts.append(np.asarray([anomaly[k][1] for k in keys], dtype='<f8').tobytes())
+        parts.append(np.asarray([_degree2code(anomaly[k][2]) for k in keys], dtype=np.uint8).tobytes())
+    return b''.join(parts)
+
+
+def encode_tunnel(init: bool, time: datetime, tunnel: Tunnel) -> bytes:
+    """
+    将Tunnel对象编码为二进制帧，供生产者由pickle格式迁移
+    :param init: 是否处于初始化阶段
+    :param time: 点云采集时间
+    :param tunnel: 隧道对象
+    :return: 二进制帧
+    """
+    data = tunnel.get_data().get_preprocess_data()
+    colors = data[['R', 'G', 'B']].values if all(c in data.columns for c in ['R', 'G', 'B']) else None
+    anomaly = tunnel.get_data().get_anomaly()
+    return encode_frame(tunnel.device_id, time, init, tunnel.high, data[['X', 'Y', 'Z']].values, colors,
+                        anomaly.get_describe() if anomaly else None)
+
+
+def is_frame(body) -> bool:
+    """
+    判断消息是否为二进制帧
+    """
+    return len(body) >= HEADER.size and bytes(body[:4]) == MAGIC
+
+
+def decode_frame(body):
+    """
+    解码二进制帧，点云坐标和颜色直接包装消息缓冲区，不复制数据
+    :param body: 消息体
+    :return: dict: device_id, time, init, high, points, colors, anomaly
+    """
+    buf = memoryview(body)
+    magic, version, flags, _, time_us, high, n_points, n_anomaly, device_len = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ValueError("not a point cloud frame")
+    if version != VERSION:
+        raise ValueError(f"unsupported frame version: {version}")
+    offset = HEADER.size
+    device_id = bytes(buf[offset:offset + device_len]).decode('utf-8')
+    offset = _align(offset + device_len)
+
+    points = np.frombuffer(buf, dtype='<f4', count=n_points * 3, offset=offset).reshape(n_points, 3)
+    offset += points.nbytes
+    colors = None
+    if flags & FLAG_RGB:
+        colors = np.frombuffer(buf, dtype=np.uint8, count=n_points * 3, offset=offset).reshape(n_points, 3)
+        offset += colors.nbytes
+
+    anomaly = {}
+    if n_anomaly:
+        region = np.frombuffer(buf, dtype='<i4', count=n_anomaly, offset=offset)
+        offset += region.nbytes
+        position = np.frombuffer(buf, dtype='<f4', count=n_anomaly * 3, offset=offset).reshape(n_anomaly, 3)
+        offset += position.nbytes
+        bas = np.frombuffer(buf, dtype='<f8', count=n_anomaly, offset=offset)
+        offset += bas.nbytes
+        degree = np.frombuffer(buf, dtype=np.uint8, count=n_anomaly, offset=offset)
+        for i, k in enumerate(region.tolist()):
+            anomaly[k] = [tuple(position[i].tolist()), float(bas[i]), DEGREES.get(int(degree[i]), int(degree[i]))]
+
+    return {
+        'device_id': device_id,
+        'time': EPOCH + timedelta(microseconds=time_us),
+        'init': bool(flags & FLAG_INIT),
+        'high': high,
+        'points': points,
+        'colors': colors,
+        'anomaly': anomaly
+    }
+
+
+def frame2tunnel(frame: dict) -> Tunnel:
+    """
+    由解码后的帧构造Tunnel对象：划分区域并还原异常区域数据
+    :param frame: decode_frame的返回值
+    :return: Tunnel对象
+    """
+    df = pd.DataFrame(frame['points'], columns=['X', 'Y', 'Z'], copy=False)
+    if frame['colors'] is not None:
+        df['R'], df['G'], df['B'] = frame['colors'][:, 0], frame['colors'][:, 1], frame['colors'][:, 2]
+    region = Segment.subdivide(df)
+    point_cloud = PointCloudData(df, frame['time'], df, region)
+
+    if frame['anomaly']:
+        anomaly = AnomalyPointCloudData()
+        for k, (position, bas, degree) in frame['anomaly'].items():
+            anomaly.set_region(k, region.get_pcd(k))
+            anomaly.set_describe(k, position, bas, degree)
+        point_cloud.set_anomaly(anomaly)
+    return Tunnel(frame['high'], frame['device_id'], point_cloud)
+
+
+class _Unpickler(pickle.Unpickler):
+    """
+    旧版生产者以顶层模块construct序列化Tunnel，统一映射到rmq.construct，保证isinstance判断一致
+    """
+
+    def find_class(self, module, name):
+        if module == 'construct':
+            module = 'rmq.construct'
+        return super().find_class(module, name)
+
+
+def decode_message(body):
+    """
+    解码数据队列中的消息，兼容旧版base64+pickle格式 [init, time, Tunnel]
+    :param body: 消息体
+    :return: (init, time, tunnel)
+    """
+    if is_frame(body):
+        frame = decode_frame(body)
+        return frame['init'], frame['time'], frame2tunnel(frame)
+    init, time, tunnel = _Unpickler(io.BytesIO(base64.b64decode(body))).load()
+    return init, time, tunnel
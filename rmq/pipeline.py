@@ -0,0 +1,309 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_13:40
+@FileName:pipeline.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 数据队列处理流水线：消费线程只负责接收和投递消息，工作进程负责解码、划分区域、写入文件和记录日志
+"""
+import collections
+import functools
+import multiprocessing
+import queue
+import threading
+import zlib
+from concurrent.futures import Future, wait
+
+
+def worker_loop(handler, tasks, results):
+    """
+    工作进程主循环
+    :param handler: 消息处理函数 handler(body) -> bool或Future，返回Future时在Future完成后才报告结果
+    :param tasks: 任务队列，元素为 (queue_name, delivery_tag, body)，None表示退出
+    :param results: 结果队列，元素为 (queue_name, delivery_tag, 是否处理成功)，按接收顺序报告
+    :return: None
+    """
+    pending = collections.deque()  # [queue_name, delivery_tag, 是否处理成功]，未完成时为None
+    lock = threading.Lock()
+    futures = []
+
+    def report():
+        # 之前的消息还在后台写入时，后面的结果等待，保证同一队列的确认顺序
+        with lock:
+            while pending and pending[0][2] is not None:
+                results.put(tuple(pending.popleft()))
+
+    def finish(entry, future):
+        try:
+            entry[2] = bool(future.result())
+        except Exception as e:
+            print(f"An error occurred: {e} in worker_loop")
+            entry[2] = False
+        report()
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        queue_name, tag, body = task
+        entry = [queue_name, tag, None]
+        with lock:
+            pending.append(entry)
+        try:
+            res = handler(body)
+        except Exception as e:
+            print(f"An error occurred: {e} in worker_loop")
+            res = False
+        if isinstance(res, Future):
+            futures = [f for f in futures if not f.done()] + [res]
+            res.add_done_callback(functools.partial(finish, entry))
+        else:
+            entry[2] = bool(res)
+            report()
+    # 退出前等待后台写入完成
+    wait(futures)
+
+
+class Pipeline(object):
+    """
+    有界的消息处理流水线
+        1. 每个工作进程拥有一个有界任务队列，投递不阻塞，队列写满时submit返回False，由投递方暂存并停止接收，形成背压
+        2. 同一数据队列（即同一采集设备）的消息固定分配到同一个工作进程，保证按接收顺序处理
+        3. 处理结果由回收线程交给on_done回调
+    """
+
+    def __init__(self, handler, workers=None, queue_size=16, on_done=None):
+        """
+        :param handler: 消息处理函数，需可在子进程中调用 handler(body) -> bool
+        :param workers: 工作进程数量，默认为CPU核数
+        :param queue_size: 每个工作进程任务队列的最大长度
+        :param on_done: 处理完成回调 on_done(queue_name, delivery_tag, ok)
+        """
+        self._handler = handler
+        self._workers = workers or multiprocessing.cpu_count()
+        self._queue_size = queue_size
+        self._on_done = on_done
+        self._tasks = []
+        self._processes = []
+        self._results = None
+        self._collector = None
+        self._routes = {}  # 队列名称 -> 该队列专用的处理完成回调
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    def start(self) -> None:
+        """
+        启动工作进程和结果回收线程
+        """
+        self._results = multiprocessing.Queue()
+        for i in range(self._workers):
+            tasks = multiprocessing.Queue(maxsize=self._queue_size)
+            process = multiprocessing.Process(target=worker_loop, args=(self._handler, tasks, self._results),
+                                              name=f"pipeline-worker-{i}", daemon=True)
+            process.start()
+            self._tasks.append(tasks)
+            self._processes.append(process)
+        self._collector = threading.Thread(target=self._collect, name="pipeline-collector", daemon=True)
+        self._collector.start()
+
+    def shard(self, queue_name) -> int:
+        """
+        根据队列名称计算工作进程编号，同一队列始终对应同一个工作进程
+        """
+        return zlib.crc32(str(queue_name).encode('utf-8')) % self._workers
+
+    def register(self, queue_name, on_done) -> None:
+        """
+        为指定队列注册处理完成回调，未注册的队列使用构造时的on_done
+        """
+        self._routes[queue_name] = on_done
+
+    def unregister(self, queue_name) -> None:
+        self._routes.pop(queue_name, None)
+
+    def submit(self, queue_name, delivery_tag, body) -> bool:
+        """
+        投递一条消息，不阻塞，可以在连接所在线程调用
+        :param queue_name: 数据队列名称
+        :param delivery_tag: 消息的delivery_tag
+        :param body: 消息体
+        :return: 工作进程队列已满时返回False，消息没有投递
+        """
+        try:
+            self._tasks[self.shard(queue_name)].put_nowait((queue_name, delivery_tag, body))
+            return True
+        except queue.Full:
+            return False
+
+    def depth(self) -> int:
+        """
+        当前等待处理的消息数量
+        """
+        total = 0
+        for tasks in self._tasks:
+            try:
+                total += tasks.qsize()
+            except NotImplementedError:  # macOS不支持qsize
+                return -1
+        return total
+
+    def _collect(self) -> None:
+        while True:
+            try:
+                res = self._results.get(timeout=1)
+            except queue.Empty:
+                if not any(p.is_alive() for p in self._processes):
+                    break
+                continue
+            if res is None:
+                break
+            queue_name, tag, ok = res
+            on_done = self._routes.get(queue_name, self._on_done)
+            if on_done is not None:
+                try:
+                    on_done(queue_name, tag, ok)
+                except Exception as e:
+                    print(f"An error occurred: {e} in Pipeline._collect")
+            elif not ok:
+                print(f"[{queue_name}] message {tag} process error")
+
+    def close(self) -> None:
+        """
+        处理完已投递的消息后关闭工作进程
+        """
+        for tasks in self._tasks:
+            tasks.put(None)
+        for process in self._processes:
+            process.join()
+        if self._results is not None:
+            self._results.put(None)
+        if self._collector is not None:
+            self._collector.join()
+        self._tasks, self._processes = [], []
+
+
+class Feeder(object):
+    """
+    单个数据队列向流水线投递消息，不阻塞连接所在线程
+    工作进程队列已满时消息按接收顺序暂存，在连接所在线程的retry()中重试，保证同一队列的处理顺序
+    手动确认模式下暂存的消息数量受prefetch_count限制，自动确认模式下由调用方暂停消费
+    """
+
+    def __init__(self, pipeline: Pipeline, queue_name):
+        self._pipeline = pipeline
+        self._queue_name = queue_name
+        self._backlog = collections.deque()  # (delivery_tag, body)
+
+    @property
+    def backlog(self) -> int:
+        """
+        暂存的消息数量
+        """
+        return len(self._backlog)
+
+    def submit(self, delivery_tag, body) -> bool:
+        """
+        投递一条消息，已有暂存消息或工作进程队列已满时暂存
+        :return: 是否已交给工作进程
+        """
+        if not self._backlog and self._pipeline.submit(self._queue_name, delivery_tag, body):
+            return True
+        self._backlog.append((delivery_tag, body))
+        return False
+
+    def retry(self) -> int:
+        """
+        按顺序重新投递暂存的消息
+        :return: 剩余的暂存消息数量
+        """
+        while self._backlog:
+            delivery_tag, body = self._backlog[0]
+            if not self._pipeline.submit(self._queue_name, delivery_tag, body):
+                break
+            self._backlog.popleft()
+        return len(self._backlog)
+
+    def drop(self) -> list:
+        """
+        清空暂存的消息
+        :return: 被清空的消息的delivery_tag
+        """
+        tags = [delivery_tag for delivery_tag, _ in self._backlog]
+        self._backlog.clear()
+        return tags
+
+
+class Acknowledger(object):
+    """
+    手动确认：消息写入成功后再向RabbitMQ确认，并将连续的确认合并为一次multiple确认
+    done()可在任意线程调用，真正的确认在连接所在线程的flush()中完成
+    同一队列的消息按顺序处理，因此确认某个delivery_tag时，比它小的消息都已经处理完成
+    """
+
+    def __init__(self, channel, batch=1, requeue=False):
+        """
+        :param channel: 消费消息的channel
+        :param batch: 累计多少条处理结果后触发一次确认
+        :param requeue: 处理失败的消息是否重新入队
+        """
+        self._channel = channel
+        self._batch = max(1, batch)
+        self._requeue = requeue
+        self._lock = threading.Lock()
+        self._done = []
+        self._in_flight = 0
+
+    @property
+    def in_flight(self) -> int:
+        """
+        已接收但还没有确认的消息数量
+        """
+        return self._in_flight
+
+    def received(self) -> None:
+        """
+        收到一条消息，在连接所在线程调用
+        """
+        with self._lock:
+            self._in_flight += 1
+
+    def done(self, queue_name, tag, ok) -> None:
+        """
+        Pipeline的处理完成回调
+        """
+        with self._lock:
+            self._done.append((tag, ok, self._requeue))
+            full = len(self._done) >= self._batch or len(self._done) >= self._in_flight or not ok
+        if full:
+            self._channel.connection.add_callback_threadsafe(self.flush)
+
+    def release(self, tag) -> None:
+        """
+        没有处理的消息退回队列，由RabbitMQ重新投递，在连接所在线程调用，下一次flush()时发送
+        """
+        with self._lock:
+            self._done.append((tag, False, True))
+
+    def flush(self) -> None:
+        """
+        发送累计的确认，必须在连接所在线程调用
+        """
+        with self._lock:
+            done, self._done = sorted(self._done), []
+            self._in_flight -= len(done)
+        if not done or not self._channel.is_open:
+            return
+        last = None
+        for tag, ok, requeue in done:
+            if ok:
+                last = tag
+                continue
+            if last is not None:
+                self._channel.basic_ack(delivery_tag=last, multiple=True)
+                last = None
+            self._channel.basic_nack(delivery_tag=tag, requeue=requeue)
+        if last is not None:
+            self._channel.basic_ack(delivery_tag=last, multiple=True)
@@ -7,19 +7,25 @@
 @lastEditTime: 
 @Description: 
 """
-import base64
 import configparser
+import datetime
 import json
 import os.path
-import pickle
-import threading
+import time
+from concurrent.futures import Future
 
 import pika
 import requests
+from deprecated import deprecated
 
 from utils.util_database import DBUtils
-from utils.util_pcd import write_init, write_single_df, write_single_log, recreate_init_file, write_single_log_db
-from construct import Tunnel
+from utils.util_pcd import write_init, write_single_df, write_single_log, write_single_log_db
+from utils.util_baseline import BaselineVersions
+from utils.util_writer import get_writer
+from rmq.construct import Tunnel
+from rmq.frame import decode_message
+from rmq.connection import ConnectionManager, Consumer
+from rmq.pipeline import Pipeline, Acknowledger, Feeder
 
 
 def init_process(init: bool, data: Tunnel, init_path, init_name, region_name):
@@ -34,9 +40,17 @@ def init_process(init: bool, data: Tunnel, init_path, init_name, region_name):
     """
     point_cloud = data.get_data()
 
-    recreate_init_file(init_path)
-    print("init pcd save success") if write_init(init_path, init, point_cloud, init_name, region_name) else print(
-        "init pcd save error")
+    # 新基准写入临时目录，写完后替换CURRENT指针发布，旧基准保留为历史版本
+    versions = BaselineVersions(init_path)
+    version = versions.new_version(point_cloud.get_time())
+    staging = versions.stage(version)
+    res = write_init(staging, init, point_cloud, init_name, region_name)
+    if res:
+        versions.publish(staging, version)
+    else:
+        versions.discard(staging)
+    print("init pcd save success") if res else print("init pcd save error")
+    return res
 
 
 # def process(init, time, tunnel: Tunnel, data_path, log_path, init_path):
@@ -52,8 +66,8 @@ def process(init, tunnel: Tunnel, data_path, init_path):
         Tunnel中包含：隧道的实际高度 和 PointCloudData点云数据对象
         PointCloudData中包含：DataFrame点云数据、预处理后的DataFrame点云数据、regions区域点云列表、AnomalyPointCloudData异常点云对象
     """
-    print("pcd save success!") if write_single_df(data_path, init_path, init, tunnel) else print(
-        "pcd save error!")
+    saved = write_single_df(data_path, init_path, init, tunnel)
+    print("pcd save success!") if saved else print("pcd save error!")
 
     # 记录日志至本地文件
     # print("log save success!") if write_single_log(time, log_path, point_cloud) else print("log save error!")
@@ -65,6 +79,59 @@ def process(init, tunnel: Tunnel, data_path, init_path):
         print("log save success!")
     else:
         print("log save error!")
+    return saved and res is not False
+
+
+def handle_message(body) -> bool:
+    """
+    处理数据队列中的一条消息，在流水线的工作进程中执行
+
+    初始化阶段只保存原始的完整点云数据，和预处理后的点云区域数据
+    非初始化保存异常点云区域数据和日志信息
+    :param body: 消息体
+    :return: 是否处理成功，有后台写入时返回写入完成后得到结果的Future
+    """
+    if not body:
+        print("no body")
+        return True
+    # 解码数据：二进制帧或旧版base64+pickle格式 message_data = [is_init(4), now, merge_clouds]
+    init, time, tunnel = decode_message(body)
+
+    # 构建项目保存目录
+    device_id = tunnel.project.get('device_id')
+    root = ReceiveThread.INIT_DATA_PATH
+    init_path = str(os.path.join(root, device_id, 'data', 'init'))
+    data_path = str(os.path.join(root, device_id, 'data', 'history'))
+
+    with get_writer().batch() as batch:
+        if init:
+            ok = init_process(init, tunnel, init_path, ReceiveThread.INIT_ALL_DATA_NAME,
+                              ReceiveThread.INIT_REGIONS_NAME)
+        else:
+            ok = process(init, tunnel, data_path, init_path)
+    if not ok or not batch.futures:
+        return ok
+    # 扫描数据已交给后台写入，全部写入后再确认消息，写入失败时拒绝
+    return batch.future()
+
+
+def publish_metrics(channel, queue_name, metrics: dict) -> None:
+    """
+    向监控队列发送接收端指标，在channel所在线程调用
+    :param channel: 控制队列的channel
+    :param queue_name: 指标队列名称
+    :param metrics: Receive.metrics()或AsyncReceive.metrics()的返回值
+    """
+    body = dict(metrics, time=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    channel.basic_publish(exchange='', routing_key=queue_name, body=json.dumps(body))
+
+
+def handle_message_wait(body) -> bool:
+    """
+    处理一条消息并等待后台写入完成，供只能返回可序列化结果的进程池调用
+    """
+    res = handle_message(body)
+    return bool(res.result()) if isinstance(res, Future) else bool(res)
 
 
 class Queue(object):
@@ -82,6 +149,19 @@ class Queue(object):
         self._port = int(config.get("Receive", "port"))
         self._virtual_host = str(config.get("Receive", "virtualHost"))
         self._queue = str(config.get("Receive", "queueName"))
+        self._workers = config.getint("Worker", "workers", fallback=0)
+        self._queue_size = config.getint("Worker", "queueSize", fallback=16)
+        self._auto_ack = config.getboolean("Consume", "autoAck", fallback=False)
+        self._prefetch_count = config.getint("Consume", "prefetchCount", fallback=8)
+        self._ack_batch = config.getint("Consume", "ackBatch", fallback=4)
+        self._requeue = config.getboolean("Consume", "requeue", fallback=False)
+        self._stop_timeout = config.getint("Consume", "stopTimeout", fallback=30)
+        self._connections = config.getint("Connection", "connections", fallback=1)
+        self._heartbeat = config.getint("Connection", "heartbeat", fallback=60)
+        self._reconnect_delay = config.getint("Connection", "reconnectDelay", fallback=5)
+        self._engine = config.get("Connection", "engine", fallback="blocking")
+        self._metrics_queue = config.get("Connection", "metricsQueue", fallback="").strip()
+        self._metrics_interval = config.getint("Connection", "metricsInterval", fallback=60)
 
     @property
     def username(self) -> str:
@@ -107,6 +187,58 @@ class Queue(object):
     def queue(self) -> str:
         return self._queue
 
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @property
+    def queue_size(self) -> int:
+        return self._queue_size
+
+    @property
+    def auto_ack(self) -> bool:
+        return self._auto_ack
+
+    @property
+    def prefetch_count(self) -> int:
+        return self._prefetch_count
+
+    @property
+    def ack_batch(self) -> int:
+        return self._ack_batch
+
+    @property
+    def requeue(self) -> bool:
+        return self._requeue
+
+    @property
+    def stop_timeout(self) -> int:
+        return self._stop_timeout
+
+    @property
+    def connections(self) -> int:
+        return self._connections
+
+    @property
+    def heartbeat(self) -> int:
+        return self._heartbeat
+
+    @property
+    def reconnect_delay(self) -> int:
+        return self._reconnect_delay
+
+    @property
+    def engine(self) -> str:
+        return self._engine
+
+    @property
+    def metrics_queue(self) -> str:
+        return self._metrics_queue
+
+    @property
+    def metrics_interval(self) -> int:
+        return self._metrics_interval
+
 
 class ReceiveThread(object):
     """
@@ -128,15 +260,22 @@ class ReceiveThread(object):
         self.port = q.port
         self.virtual_host = q.virtual_host
         self.queue = q.queue
+        self.auto_ack = q.auto_ack
+        self.prefetch_count = q.prefetch_count
+        self.ack_batch = q.ack_batch
+        self.requeue = q.requeue
+        self.stop_timeout = q.stop_timeout
         self.init = ReceiveThread.INIT_DATA_PATH
         self.init_all_data = ReceiveThread.INIT_ALL_DATA_NAME
         self.init_regions_name = ReceiveThread.INIT_REGIONS_NAME
 
-    def run(self, queue_name, stop_event_dict):
+    @deprecated(reason="Use DataConsumer with ConnectionManager")
+    def run(self, queue_name, stop_event_dict, pipeline: Pipeline):
         """
-        开启对指定消息传输队列的监听操作
+        开启对指定消息传输队列的监听操作，每个队列独占一个连接
         :param queue_name:
         :param stop_event_dict:
+        :param pipeline: 消息处理流水线
         :return:
         """
         # 创建PlainCredentials实例
@@ -145,90 +284,135 @@ class ReceiveThread(object):
                                                credentials=credentials)
         # 连接到RabbitMQ服务器
         connection = pika.BlockingConnection(parameters)
-        channel = connection.channel()
+        # 消息只投递至处理流水线，不阻塞连接，解码、写入和日志在工作进程中完成
+        consumer = DataConsumer(queue_name, pipeline, Queue())
+        consumer.open(connection.channel())
+
+        while not stop_event_dict[queue_name].is_set():
+            # 非阻塞地处理消息，每1秒检查一次
+            connection.process_data_events(time_limit=1)
+            consumer.tick()
+
+        # 停止接收新消息，等待已投递的消息处理完成并确认，超时未确认的消息由RabbitMQ重新投递
+        consumer.stop()
+        while not consumer.drained():
+            connection.process_data_events(time_limit=1)
+            consumer.tick()
+        connection.close()
+
+
+class DataConsumer(Consumer):
+    """
+    数据传输队列消费者：在ConnectionManager分配的channel上消费，消息投递至处理流水线
+    投递不阻塞连接所在线程：流水线已满时消息暂存在Feeder中，手动确认模式下由prefetch_count限制暂存数量，
+    自动确认模式下暂存达到prefetch_count时暂停消费，暂存的消息全部投递后恢复
+    """
+
+    def __init__(self, queue_name, pipeline: Pipeline, q: Queue):
+        self.queue_name = queue_name
+        self.pipeline = pipeline
+        self.auto_ack = q.auto_ack
+        self.prefetch_count = q.prefetch_count
+        self.ack_batch = q.ack_batch
+        self.requeue = q.requeue
+        self.stop_timeout = q.stop_timeout
+        self._generation = 0  # channel编号，重连后旧channel的处理结果不再确认
+        self._channel = None
+        self._acker = None
+        self._feeder = Feeder(pipeline, queue_name)
+        self._consumer_tag = None
+        self._stop_time = None
+
+    @property
+    def backlog(self) -> int:
+        """
+        流水线已满时暂存的消息数量
+        """
+        return self._feeder.backlog
+
+    def open(self, channel) -> None:
+        self._generation += 1
+        self._channel = channel
+        if not self.auto_ack:
+            # 旧channel上未确认的消息由RabbitMQ重新投递，暂存的副本不再处理
+            self._feeder.drop()
         # 声明队列，如果队列不存在则创建队列
         channel.queue_declare(
-            queue=queue_name,
+            queue=self.queue_name,
             durable=True,
             arguments={
                 'x-queue-mode': 'lazy'  # 设置队列为惰性模式
             }
         )
-
-        # 定义回调函数，处理从队列中接收到的消息
-        def callback(ch, method, properties, body):
-            """
-            接收数据进行处理并保存至本地和云端
-
-            初始化阶段只保存原始的完整点云数据，和预处理后的点云区域数据
-            非初始化保存异常点云区域数据和日志信息
-            :param ch:
-            :param method:
-            :param properties:
-            :param body:
-            :return:
-            """
-            if not body:  # 如果body没有数据关闭channel
-                print("no body")
-            else:
-                print("receive data success!!")
-                print("saving data......")
-                # 解码并反序列化数据 message_data = [is_init(4), now, merge_clouds]
-                decode = base64.b64decode(body)
-                message_data = pickle.loads(decode)
-                """------------本地部分------------"""
-                # TODO: 写入数据库 log表
-                # TODO: 向公众号定向推送 log表
-                # TODO: 保存本地数据 点云数据文件 再上传云端
-
-                # 获取数据
-                init, time, tunnel = message_data
-
-                # 构建项目保存目录
-                # project_name, tunnel_name, working_face = tunnel.project_name, tunnel.tunnel_name, tunnel.working_face
-                # structure, device_id, mileage = tunnel.structure, tunnel.device_id, tunnel.mileage
-                device_id = tunnel.project.get('device_id')
-                # init_path = str(
-                #     os.path.join(self.init, project_name, tunnel_name, working_face, mileage, device_id, 'data',
-                #                  'init'))
-                init_path = str(os.path.join(self.init, device_id, 'data', 'init'))
-                data_path = str(os.path.join(self.init, device_id, 'data', 'history'))
-
-                # log_path = str(
-                #     os.path.join(self.init, project_name, tunnel_name, working_face, mileage, device_id, 'data',
-                #                  'log'))
-
-                # init_process(init, tunnel, init_path, self.init_all_data, self.init_regions_name) if message_data[
-                #     0] else process(init, time, tunnel, data_path, log_path, init_path)
-
-                init_process(init, tunnel, init_path, self.init_all_data, self.init_regions_name) if message_data[
-                    0] else process(init, tunnel, data_path, init_path)
-
-                """------------云端部分------------"""
-                """
-                Influxdb:
-                    organization: project_name
-                    bucket: tunnel_name
-                    tag: working_face = device_id
-                    filed: region_index = z-score
-                """
-                # TODO：点云数据压缩备份云端
-                # TODO：时序数据上传云端
-
-        # 告诉RabbitMQ使用callback来接收消息
-        channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=True)
-
-        print(f' [{queue_name}] Waiting for messages. To exit press CTRL+C')
-
-        while not stop_event_dict[queue_name].is_set():
-            # 非阻塞地处理消息，每1秒检查一次
-            channel.connection.process_data_events(time_limit=1)
-
-        print(f"Stopped consuming from {queue_name}")
-        channel.close()
-        connection.close()
-        # 开始接收消息，并进入阻塞状态
-        # channel.start_consuming()
+        if not self.auto_ack:
+            channel.basic_qos(prefetch_count=self.prefetch_count)
+            self._acker = Acknowledger(channel, batch=self.ack_batch, requeue=self.requeue)
+            self.pipeline.register(self.queue_name, self._done)
+        self._consume()
+        print(f' [{self.queue_name}] Waiting for messages.')
+
+    def _consume(self) -> None:
+        self._consumer_tag = self._channel.basic_consume(queue=self.queue_name, on_message_callback=self._on_message,
+                                                         auto_ack=self.auto_ack)
+
+    def _cancel(self) -> None:
+        if self._consumer_tag is not None and self._channel is not None and self._channel.is_open:
+            self._channel.basic_cancel(self._consumer_tag)
+        self._consumer_tag = None
+
+    def _on_message(self, ch, method, properties, body):
+        print(f"[{self.queue_name}] receive data success!!")
+        if self._acker is not None:
+            self._acker.received()
+        if not self._feeder.submit((self._generation, method.delivery_tag), body):
+            print(f"[{self.queue_name}] pipeline is full, {self._feeder.backlog} message(s) waiting")
+            if self.auto_ack and self._feeder.backlog >= self.prefetch_count:
+                # 自动确认模式没有prefetch限制，暂停消费
+                self._cancel()
+
+        """------------云端部分------------"""
+        """
+        Influxdb:
+            organization: project_name
+            bucket: tunnel_name
+            tag: working_face = device_id
+            filed: region_index = z-score
+        """
+        # TODO：点云数据压缩备份云端
+        # TODO：时序数据上传云端
+
+    def _done(self, queue_name, tag, ok):
+        generation, delivery_tag = tag
+        acker = self._acker
+        if acker is not None and generation == self._generation:
+            acker.done(queue_name, delivery_tag, ok)
+
+    def tick(self) -> None:
+        remaining = self._feeder.retry()
+        if remaining == 0 and self._consumer_tag is None and self._stop_time is None and self._channel is not None \
+                and self._channel.is_open:
+            self._consume()
+        if self._acker is not None:
+            self._acker.flush()
+
+    def stop(self) -> None:
+        # 停止接收新消息，等待已投递的消息处理完成并确认，超时未确认的消息由RabbitMQ重新投递
+        self._cancel()
+        self._stop_time = time.time()
+        if self._acker is not None:
+            # 还没有交给流水线的消息直接退回队列
+            for generation, delivery_tag in self._feeder.drop():
+                if generation == self._generation:
+                    self._acker.release(delivery_tag)
+            self._acker.flush()
+
+    def drained(self) -> bool:
+        idle = self._feeder.backlog == 0 and (self._acker is None or self._acker.in_flight <= 0)
+        if idle or time.time() - self._stop_time >= self.stop_timeout:
+            self.pipeline.unregister(self.queue_name)
+            print(f"Stopped consuming from {self.queue_name}")
+            return True
+        return False
 
 
 class Receive(object):
@@ -238,59 +422,55 @@ class Receive(object):
 
     def __init__(self):
         self._queue = Queue()
-        self._threads_dict = {}
-        self._stop_event_dict = {}
+        q = self._queue
+        self._pipeline = Pipeline(handle_message, workers=q.workers, queue_size=q.queue_size)
+        self._manager = ConnectionManager(q.username, q.password, q.host, q.port, q.virtual_host,
+                                          connections=q.connections, heartbeat=q.heartbeat,
+                                          reconnect_delay=q.reconnect_delay)
+        self._consumers = {}  # 队列名称 -> DataConsumer
 
     @property
     def queue(self):
         return self._queue
 
     @property
-    def threads_dict(self):
-        return self._threads_dict
-
-    @threads_dict.setter
-    def threads_dict(self, value):
-        k, v = value
-        self._threads_dict[k] = v
+    def pipeline(self):
+        return self._pipeline
 
     @property
-    def stop_event_dict(self):
-        return self._stop_event_dict
+    def manager(self):
+        return self._manager
 
-    @stop_event_dict.setter
-    def stop_event_dict(self, value):
-        k, v = value
-        self._stop_event_dict[k] = v
+    def metrics(self) -> dict:
+        """
+        连接数、channel数、重连次数、流水线中等待处理的消息数量以及流水线已满时暂存的消息数量
+        """
+        res = self.manager.metrics()
+        res['pipeline_depth'] = self.pipeline.depth()
+        res['backlog'] = sum(consumer.backlog for consumer in list(self._consumers.values()))
+        return res
 
     def start_or_stop_queue(self, queue_name, status):
         """
-        这里对数据传输队列进行线程管理
-        TODO：
-            1. 判断线程状态 √
-            2. 启停线程 √
+        这里对数据传输队列进行管理，所有数据队列以channel的形式复用ConnectionManager中的连接
         :param queue_name:
         :param status:
         :return:
         """
         if status == 'start':
-            if queue_name not in self.threads_dict or not self.threads_dict[queue_name].is_alive():
-                # 如果队列没有启动，或者线程已停止，启动新的消费者线程
-                self.stop_event_dict = queue_name, threading.Event()
-                thread = threading.Thread(target=ReceiveThread().run, args=(queue_name, self.stop_event_dict))
-                thread.start()
-                self.threads_dict = queue_name, thread
+            consumer = DataConsumer(queue_name, self.pipeline, self.queue)
+            if self.manager.add_queue(queue_name, consumer):
+                self._consumers[queue_name] = consumer
                 print(f"Started config queue: {queue_name}")
             else:
                 print(f"Queue {queue_name} is already running.")
 
         elif status == 'stop':
-            if queue_name in self.stop_event_dict:
+            if self.manager.has_queue(queue_name):
                 print(f"Requesting stop for config queue: {queue_name}")
-                self.stop_event_dict[queue_name].set()  # 设置停止标志
-                thread = self.threads_dict.get(queue_name)
-                if thread and thread.is_alive():
-                    thread.join()  # 等待线程安全退出
+                # 等待已接收的消息处理完成后关闭channel
+                self.manager.remove_queue(queue_name, timeout=self.queue.stop_timeout + 5)
+                self._consumers.pop(queue_name, None)
                 print(f"Data queue {queue_name} has been stopped.")
             else:
                 print(f"Queue {queue_name} is not running.")
@@ -308,6 +488,11 @@ class Receive(object):
                     for k, v in queues.items():
                         self.start_or_stop_queue(k, v)
                     print("starting listening to queues in messages, success")
+            if not self.queue.auto_ack:
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+
+        # 启动处理流水线的工作进程
+        self.pipeline.start()
 
         q = self.queue
         # 创建PlainCredentials实例
@@ -327,13 +512,32 @@ class Receive(object):
             }
         )
 
-        # 告诉RabbitMQ使用callback来接收消息
-        channel.basic_consume(queue=q.queue, on_message_callback=callback, auto_ack=True)
+        # 告诉RabbitMQ使用callback来接收消息，手动确认模式下在队列启停完成后确认
+        if not q.auto_ack:
+            channel.basic_qos(prefetch_count=1)
+        channel.basic_consume(queue=q.queue, on_message_callback=callback, auto_ack=q.auto_ack)
+
+        # 定期在控制连接上发送接收端指标
+        if q.metrics_queue:
+            channel.queue_declare(queue=q.metrics_queue, durable=True, arguments={'x-queue-mode': 'lazy'})
+
+            def report():
+                try:
+                    publish_metrics(channel, q.metrics_queue, self.metrics())
+                except Exception as e:
+                    print(f"An error occurred: {e} in Receive.report")
+                connection.call_later(q.metrics_interval, report)
+
+            connection.call_later(q.metrics_interval, report)
 
         print(f' [{q.queue}] Waiting for messages. To exit press CTRL+C')
 
         # 开始接收消息，并进入阻塞状态
-        channel.start_consuming()
+        try:
+            channel.start_consuming()
+        finally:
+            self.manager.close()
+            self.pipeline.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,53 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_10:05
+@FileName:bench_segment.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 区域划分性能对比：向量化Segment.subdivide vs 逐点循环Segment.subdivide_loop
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from rmq.construct import Segment
+
+
+def random_scan(n, seed=0):
+    """
+    在投影面范围内随机生成n个点
+    :param n: 点数
+    :param seed: 随机种子
+    :return: DataFrame格式点云数据
+    """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'X': rng.uniform(0, 60, n),
+        'Y': rng.uniform(-10, 10, n),
+        'Z': rng.uniform(0, 6, n)
+    })
+
+
+def timeit(func, data, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(data)
+        cost = time.perf_counter() - start
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+def bench(sizes=(1_000_000, 5_000_000)):
+    for n in sizes:
+        data = random_scan(n)
+        vectorized = timeit(Segment.subdivide, data)
+        loop = timeit(Segment.subdivide_loop, data, repeat=1)
+        print(f"{n:>9} points: subdivide {vectorized:.3f}s, subdivide_loop {loop:.3f}s, "
+              f"speedup {loop / vectorized:.1f}x")
+
+
+if __name__ == '__main__':
+    bench()
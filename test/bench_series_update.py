@@ -0,0 +1,69 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_17:50
+@FileName:bench_series_update.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 时序数据尾部修改耗时随历史长度的变化：SeriesStore.amend_tail vs 整个CSV文件读写的Merge.update_df
+"""
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from rmq.construct import Merge
+from utils.util_series import SeriesStore
+
+COLUMNS = 4800  # 区域数量
+
+
+def build(directory, rows, columns=COLUMNS, chunk=500, seed=0):
+    """
+    生成rows行历史数据，同时写入SeriesStore和单个CSV文件
+    :return: CSV文件路径
+    """
+    rng = np.random.default_rng(seed)
+    store = SeriesStore(os.path.join(directory, 'store'), columns)
+    csv_path = os.path.join(directory, '0.csv')
+    header = True
+    for start in range(0, rows, chunk):
+        block = rng.uniform(0, 6, (min(chunk, rows - start), columns))
+        store.extend([None] * len(block), block)
+        pd.DataFrame(block, columns=[str(i) for i in range(columns)]).to_csv(csv_path, mode='a', header=header,
+                                                                           index=False)
+        header = False
+    return csv_path
+
+
+def bench(history=(130, 1000, 4000, 16000), update_rows=5, csv_limit=4000):
+    """
+    :param history: 历史数据行数
+    :param update_rows: 每次修改的行数
+    :param csv_limit: 超过该行数时不再测试CSV方式
+    """
+    update = pd.DataFrame(np.random.rand(update_rows, COLUMNS), columns=[str(i) for i in range(COLUMNS)])
+    for rows in history:
+        directory = tempfile.mkdtemp()
+        try:
+            csv_path = build(directory, rows)
+            store_path = os.path.join(directory, 'store')
+            start = time.perf_counter()
+            Merge.update_df_merge(update, store_path)
+            amend = time.perf_counter() - start
+            line = f"{rows:>6} rows: amend_tail {amend * 1000:8.2f}ms"
+            if rows <= csv_limit:
+                start = time.perf_counter()
+                Merge.update_df(rows, csv_path, '0.csv', update, directory)
+                rewrite = time.perf_counter() - start
+                line += f", update_df {rewrite * 1000:9.2f}ms, speedup {rewrite / amend:.0f}x"
+            print(line)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,74 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_19:10
+@FileName:test_compare_region.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 按包围盒读取Morton布局的打包文件：compare_region只返回与包围盒相交的区域，不含None
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from utils import util_pack
+from utils.util_pack import bbox_mask, list_regions
+
+try:
+    from rmq.construct import Region, Segment
+    from utils.util_pcd import compare_region
+except ImportError:  # 未安装open3d、pymysql时无法导入
+    compare_region = None
+
+BBOX = (10, -2, 12.3, 3.1)
+
+
+def scan(n, seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'X': rng.uniform(0, 60, n), 'Y': rng.uniform(-10, 10, n), 'Z': rng.uniform(0, 6, n)})
+
+
+@unittest.skipIf(compare_region is None, "open3d or pymysql is not installed")
+class CompareRegionBboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        conf = dict(util_pack.storage_config(), morton=True)
+        self.patch = mock.patch.object(util_pack, 'storage_config', return_value=conf)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write(self, name, regions) -> dict:
+        path = os.path.join(self.directory, name)
+        os.makedirs(path)
+        data = {k: df.assign(R=0, G=0, B=0) for k, df in regions.items() if df is not None}
+        util_pack._write_atomic(util_pack.pack_path(path), util_pack.encode_pack(data, grid=Region.grid()))
+        return list_regions(path)
+
+    def test_morton_bbox(self):
+        regions = Segment.subdivide(scan(200000, 0)).get_pcds()
+        keys = sorted(k for k, df in regions.items() if df is not None)
+        root = self.write('root', {k: regions[k] for k in keys[::2]})
+        comparison = self.write('comparison', {k: regions[k] for k in keys[1::2]})
+        res = compare_region(root, comparison, None, None, bbox=BBOX)
+        self.assertTrue(res)
+        self.assertLess(len(res), len(keys))
+        for k, df in res.items():
+            self.assertIsNotNone(df, f"region {k}")
+            self.assertTrue(bbox_mask(df[['X', 'Y']].values, BBOX).all(), f"region {k}")
+        # 包围盒内的点全部返回
+        points = scan(200000, 0)
+        expected = int(bbox_mask(points[['X', 'Y']].values, BBOX).sum())
+        self.assertEqual(expected, sum(len(df) for df in res.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_10:20
+@FileName:test_segment.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 区域划分一致性测试：向量化Segment.subdivide与逐点循环Segment.subdivide_loop的区域→点结果相同
+"""
+import unittest
+
+import numpy as np
+import pandas as pd
+
+try:
+    from rmq.construct import Region, Segment
+except ImportError:  # 未安装open3d时无法导入区域划分模块
+    Region = Segment = None
+
+
+def scan(xs, ys, seed=0):
+    return pd.DataFrame({'X': xs, 'Y': ys, 'Z': np.random.default_rng(seed).uniform(0, 6, len(xs))})
+
+
+def region_points(region) -> dict:
+    """
+    :return: {区域索引: (n, 3) 坐标数组}，不含没有数据的区域
+    """
+    res = {}
+    for index, df in region.get_pcds().items():
+        if df is not None:
+            res[index] = df[['X', 'Y', 'Z']].to_numpy()
+    return res
+
+
+@unittest.skipIf(Segment is None, "open3d is not installed")
+class SubdivideTest(unittest.TestCase):
+
+    def assertSameRegions(self, expected: dict, actual: dict):
+        self.assertEqual(sorted(expected), sorted(actual))
+        for index in expected:
+            np.testing.assert_array_equal(expected[index], actual[index], err_msg=f"region {index}")
+
+    def test_inverted_grid(self):
+        # Region的范围是倒置的（MIN_X > MAX_X，MIN_Y > MAX_Y），网格数量为负数
+        self.assertGreater(Region.MIN_X, Region.MAX_X)
+        self.assertGreater(Region.MIN_Y, Region.MAX_Y)
+        rng = np.random.default_rng(1)
+        data = scan(rng.uniform(0, 60, 20000), rng.uniform(-10, 10, 20000))
+        vectorized, loop = Segment.subdivide(data), Segment.subdivide_loop(data)
+        self.assertEqual(vectorized.cell_count, len(loop.get_pcds()))
+        self.assertSameRegions(region_points(loop), region_points(vectorized))
+
+    def test_grid_edges(self):
+        # 网格边界上的点，x=0、y=-10在范围内
+        xs = np.array([0, 0, 0.5, 59.5, 59.999, 30, 30.25, 0])
+        ys = np.array([-10, 9.999, -9.5, 0, -10, 0.5, 0.5, 0])
+        data = scan(xs, ys)
+        vectorized = region_points(Segment.subdivide(data))
+        self.assertEqual(len(xs), sum(len(points) for points in vectorized.values()))
+        self.assertSameRegions(region_points(Segment.subdivide_loop(data)), vectorized)
+
+    def test_out_of_range(self):
+        # 投影面之外的点被丢弃；subdivide_loop会把这些点错放到其他区域，只与范围内的点比较
+        rng = np.random.default_rng(2)
+        xs = np.concatenate([rng.uniform(0, 60, 5000), [60, 61, -0.5, 75, 30, 30, 120]])
+        ys = np.concatenate([rng.uniform(-10, 10, 5000), [0, 0, 0, 5, 10, -10.5, 30]])
+        data = scan(xs, ys)
+        inside = (xs >= Region.MAX_X) & (xs < Region.MIN_X) & (ys >= Region.MAX_Y) & (ys < Region.MIN_Y)
+        vectorized = region_points(Segment.subdivide(data))
+        self.assertEqual(int(inside.sum()), sum(len(points) for points in vectorized.values()))
+        self.assertSameRegions(region_points(Segment.subdivide_loop(data[inside].reset_index(drop=True))),
+                               vectorized)
+
+    def test_empty(self):
+        region = Segment.subdivide(scan(np.empty(0), np.empty(0)))
+        self.assertEqual({}, region_points(region))
+
+
+if __name__ == '__main__':
+    unittest.main()
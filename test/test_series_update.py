@@ -0,0 +1,97 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_18:00
+@FileName:test_series_update.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 时序数据尾部修改一致性测试：SeriesStore.amend_tail与整个CSV文件读写的Merge.update_df结果相同
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from utils.util_series import SeriesStore
+
+try:
+    from rmq.construct import Merge
+except ImportError:  # 未安装open3d时无法导入时序数据模块
+    Merge = None
+
+COLUMNS = 40
+
+
+def columns(n=COLUMNS) -> list:
+    return [str(i) for i in range(n)]
+
+
+@unittest.skipIf(Merge is None, "open3d is not installed")
+class AmendTailTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_dir = os.path.join(self.directory, 'csv')
+        self.store_dir = os.path.join(self.directory, 'store')
+        os.makedirs(self.csv_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def build(self, sizes, seed=0):
+        """
+        写入相同的历史数据：CSV按sizes切分为0.csv、1.csv...，SeriesStore连续存放
+        """
+        rng = np.random.default_rng(seed)
+        store = SeriesStore(self.store_dir, COLUMNS)
+        for i, size in enumerate(sizes):
+            block = rng.uniform(0, 6, (size, COLUMNS))
+            store.extend([None] * size, block)
+            pd.DataFrame(block, columns=columns()).to_csv(os.path.join(self.csv_dir, f"{i}.csv"), index=False)
+
+    def csv_values(self) -> np.ndarray:
+        names = sorted(os.listdir(self.csv_dir), key=lambda x: int(os.path.splitext(x)[0]))
+        return np.concatenate([pd.read_csv(os.path.join(self.csv_dir, name)).values for name in names])
+
+    def update(self, rows, seed=1):
+        update = pd.DataFrame(np.random.default_rng(seed).uniform(0, 6, (rows, COLUMNS)), columns=columns())
+        name = max(os.listdir(self.csv_dir), key=lambda x: int(os.path.splitext(x)[0]))
+        path = os.path.join(self.csv_dir, name)
+        file_line = len(pd.read_csv(path))
+        self.assertTrue(Merge.update_df(file_line, path, name, update, self.csv_dir))
+        self.assertTrue(Merge.update_df_merge(update, self.store_dir))
+        return update
+
+    def test_amend_within_last_file(self):
+        self.build([130, 130, 20])
+        update = self.update(5)
+        np.testing.assert_allclose(SeriesStore(self.store_dir).values(), self.csv_values())
+        np.testing.assert_allclose(SeriesStore(self.store_dir).values(-5), update.values)
+
+    def test_amend_whole_last_file(self):
+        self.build([130, 5])
+        self.update(5)
+        np.testing.assert_allclose(SeriesStore(self.store_dir).values(), self.csv_values())
+
+    def test_amend_more_rows_than_store(self):
+        store = SeriesStore(self.store_dir, COLUMNS)
+        store.extend([None] * 3, np.zeros((3, COLUMNS)))
+        update = np.ones((5, COLUMNS))
+        self.assertEqual(3, store.amend_tail(update))
+        np.testing.assert_array_equal(np.ones((3, COLUMNS)), store.values())
+
+    def test_amend_columns(self):
+        # 只修改部分区域，其余区域保持原值
+        store = SeriesStore(self.store_dir, COLUMNS)
+        store.extend([None] * 4, np.zeros((4, COLUMNS)))
+        store.amend_tail(np.full((2, 2), 7.0), ['3', '5'])
+        expected = np.zeros((4, COLUMNS))
+        expected[-2:, [3, 5]] = 7.0
+        np.testing.assert_array_equal(expected, store.values())
+
+
+if __name__ == '__main__':
+    unittest.main()
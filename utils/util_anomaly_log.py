@@ -0,0 +1,321 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_23:50
+@FileName:util_anomaly_log.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 异常日志索引：每天的异常日志追加到一个JSON lines文件，查询一天的异常只需要一次顺序读取，不再逐个解析.ini文件
+
+日志目录为 <日志根目录>/年/月/日/时/分/秒/<编号>.ini，每天的目录中增加：
+    anomalies.jsonl   每条异常日志一行 {"dir": 时/分/秒, "file": 文件名, "time", "region index", "position", "bas", "degree"}
+    anomalies.idx     每个.ini文件一行 "偏移 长度 时/分/秒 文件名"，按目录查找最新日志时只读取索引和对应的一行
+                      不是异常日志的.ini文件偏移为-1，只用于核对
+
+    1. .ini文件照常写入，写入后追加到当天的文件；当天第一次写入时由已有的.ini文件生成，之后只追加，追加失败时重新生成当天的文件
+    2. 没有索引的日期（升级之前的日志）退回逐个解析.ini文件，可以运行 python util_anomaly_log.py <日志根目录> 一次性生成
+    3. 只有包含Anomalies的日志被记录到anomalies.jsonl，与find_max_log只选择异常日志的行为一致
+    4. 读取时核对目录中的.ini文件和索引：写入.ini之后中断、没有追加的日志在读取时解析并补充登记
+"""
+import ast
+import configparser
+import json
+import os
+import sys
+import threading
+
+LOG_NAME = 'anomalies.jsonl'
+INDEX_NAME = 'anomalies.idx'
+DAY_DEPTH = 3  # 日目录到日志目录 时/分/秒 的层数
+NO_RECORD = -1  # 索引中不是异常日志的.ini文件的偏移
+FIELDS = ('region index', 'position', 'bas', 'degree')
+
+_lock = threading.Lock()
+
+
+def day_dir(log_dir) -> str:
+    """
+    日志目录 年/月/日/时/分/秒 所在的日目录
+    """
+    path = os.path.abspath(log_dir)
+    for _ in range(DAY_DEPTH):
+        path = os.path.dirname(path)
+    return path
+
+
+def read_ini(path):
+    """
+    解析一个日志.ini文件
+    :return: {'time', 'region index', 'position', 'bas', 'degree'}，不是异常日志时返回None
+    """
+    config = configparser.ConfigParser()
+    config.read(path)
+    if not config.has_section('Anomalies'):
+        return None
+    record = {'time': config.get('Time', 'time', fallback=None)}
+    for field in FIELDS:
+        record[field] = ast.literal_eval(config.get('Anomalies', field))
+    return record
+
+
+def _ini_files(directory) -> list:
+    with os.scandir(directory) as entries:
+        return sorted(e.name for e in entries if e.is_file() and e.name.endswith('.ini'))
+
+
+def _encode(rel, name, record) -> bytes:
+    data = dict(record, dir=rel, file=name)
+    return (json.dumps(data, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+def _decode(line: bytes) -> dict:
+    record = json.loads(line.decode('utf-8'))
+    # JSON没有元组，坐标还原为与.ini文件解析结果相同的元组
+    record['position'] = [tuple(p) if isinstance(p, list) else p for p in record.get('position', [])]
+    return record
+
+
+def _rel(day, log_dir) -> str:
+    return os.path.relpath(os.path.abspath(log_dir), day).replace(os.sep, '/')
+
+
+def _index_line(offset, size, rel, name) -> bytes:
+    return f"{offset} {size} {rel} {name}\n".encode('utf-8')
+
+
+def _read_ini(path):
+    """
+    read_ini，无法解析的文件按不是异常日志处理
+    """
+    try:
+        return read_ini(path)
+    except Exception as e:
+        print(f"An error occurred: {e} in _read_ini")
+        return None
+
+
+def build_day(day) -> int:
+    """
+    由日目录中已有的.ini文件生成当天的异常日志文件和索引，已存在时覆盖
+    :return: 记录的异常日志数
+    """
+    log, index, offset = [], [], 0
+    for root, dirs, files in os.walk(day):
+        dirs.sort()
+        rel = _rel(day, root)
+        for name in sorted(f for f in files if f.endswith('.ini')):
+            record = _read_ini(os.path.join(root, name))
+            if record is None:
+                index.append(_index_line(NO_RECORD, 0, rel, name))
+                continue
+            line = _encode(rel, name, record)
+            log.append(line)
+            index.append(_index_line(offset, len(line), rel, name))
+            offset += len(line)
+    for file_name, data in ((LOG_NAME, b''.join(log)), (INDEX_NAME, b''.join(index))):
+        tmp = os.path.join(day, f"{file_name}.{os.getpid()}.tmp")
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(day, file_name))
+    return len(log)
+
+
+def append(log_dir, name, record) -> bool:
+    """
+    写入.ini文件之后追加异常日志；当天还没有索引时由日目录中已有的.ini文件（包括本条）生成
+    追加失败时重新生成当天的文件，避免索引缺少这条日志
+    :param log_dir: 日志目录 年/月/日/时/分/秒
+    :param name: 日志文件名
+    :param record: {'time', 'region index', 'position', 'bas', 'degree'}，不是异常日志时为None，只登记到索引
+    """
+    day = day_dir(log_dir)
+    with _lock:
+        try:
+            if not os.path.isfile(os.path.join(day, INDEX_NAME)):
+                build_day(day)
+                return True
+            rel = _rel(day, log_dir)
+            if record is None:
+                entry = _index_line(NO_RECORD, 0, rel, name)
+            else:
+                line = _encode(rel, name, record)
+                with open(os.path.join(day, LOG_NAME), 'ab') as f:
+                    offset = f.tell()
+                    f.write(line)
+                entry = _index_line(offset, len(line), rel, name)
+            with open(os.path.join(day, INDEX_NAME), 'ab') as f:
+                f.write(entry)
+            return True
+        except Exception as e:
+            print(f"An error occurred: {e} in append")
+        try:
+            build_day(day)
+        except Exception as e:
+            print(f"An error occurred: {e} in append")
+        return False
+
+
+def append_ini(path) -> bool:
+    """
+    追加刚写入的.ini文件，内容与解析.ini文件得到的完全一致；不是异常日志时只登记到索引
+    """
+    return append(os.path.dirname(path), os.path.basename(path), _read_ini(path))
+
+
+def _find_day(path):
+    """
+    path本身或上级目录中有索引的日目录
+    """
+    path = os.path.abspath(path)
+    for _ in range(DAY_DEPTH + 1):
+        if os.path.isfile(os.path.join(path, INDEX_NAME)):
+            return path
+        path = os.path.dirname(path)
+    return None
+
+
+def read_index(day) -> dict:
+    """
+    :return: {时/分/秒: {文件名: (偏移, 长度)}}，不是异常日志的文件偏移为NO_RECORD
+    """
+    res = {}
+    with open(os.path.join(day, INDEX_NAME), 'r', encoding='utf-8') as f:
+        for line in f:
+            offset, size, rel, name = line.rstrip('\n').split(' ', 3)
+            res.setdefault(rel, {})[name] = (int(offset), int(size))
+    return res
+
+
+def read_day(day) -> list:
+    """
+    顺序读取一天的异常日志
+    :return: [记录]，记录中的dir为日志目录的完整路径
+    """
+    res = []
+    with open(os.path.join(day, LOG_NAME), 'rb') as f:
+        for line in f:
+            if line.strip():
+                record = _decode(line)
+                record['dir'] = os.path.join(day, *record['dir'].split('/'))
+                res.append(record)
+    return res
+
+
+def _repair(log_dir, names) -> dict:
+    """
+    登记写入.ini之后中断、没有追加到索引的日志
+    :param log_dir: 日志目录
+    :param names: 索引中没有的.ini文件名
+    :return: {文件名: 记录}，只含异常日志
+    """
+    res = {}
+    for name in names:
+        record = _read_ini(os.path.join(log_dir, name))
+        append(log_dir, name, record)
+        if record is not None:
+            res[name] = record
+    return res
+
+
+def _unindexed(log_dir, files: dict) -> list:
+    """
+    日志目录中没有登记到索引的.ini文件
+    :param files: 索引中该目录的 {文件名: (偏移, 长度)}
+    """
+    return [name for name in _ini_files(log_dir) if name not in files] if os.path.isdir(log_dir) else []
+
+
+def _day_records(day, under=None) -> list:
+    """
+    一天的异常日志，与目录中的.ini文件核对，没有登记的日志解析后补充登记
+    :param under: 只核对该目录中的.ini文件，默认整天
+    :return: [记录]，同read_day
+    """
+    records = read_day(day)
+    index = read_index(day)
+    for root, dirs, files in os.walk(under or day):
+        files = index.get(_rel(day, root), {})
+        for name, record in _repair(root, _unindexed(root, files)).items():
+            records.append(dict(record, dir=root, file=name))
+    return records
+
+
+def max_log(log_dir):
+    """
+    日志目录中文件名最大的异常日志
+    :return: (.ini文件路径, 记录)，没有异常日志时返回None
+    """
+    log_dir = os.path.abspath(log_dir)
+    day = _find_day(log_dir)
+    if day is None:
+        # 没有索引的旧日志
+        for name in reversed(_ini_files(log_dir)):
+            record = read_ini(os.path.join(log_dir, name))
+            if record is not None:
+                return os.path.join(log_dir, name), record
+        return None
+    files = read_index(day).get(_rel(day, log_dir), {})
+    repaired = _repair(log_dir, _unindexed(log_dir, files))
+    names = [name for name, (offset, _) in files.items() if offset != NO_RECORD] + list(repaired)
+    if not names:
+        return None
+    name = max(names)
+    if name in repaired:
+        return os.path.join(log_dir, name), repaired[name]
+    offset, size = files[name]
+    with open(os.path.join(day, LOG_NAME), 'rb') as f:
+        f.seek(offset)
+        record = _decode(f.read(size))
+    return os.path.join(log_dir, name), record
+
+
+def latest_records(path) -> list:
+    """
+    path中每个日志目录文件名最大的异常日志，有索引的日期每天只读取一个文件，.ini文件只列出文件名与索引核对
+    :param path: 日志根目录下的任意目录
+    :return: [(日志目录, 记录)]，按日志目录排序
+    """
+    path = os.path.abspath(path)
+    latest = {}
+
+    def collect(records):
+        for record in records:
+            directory = record['dir']
+            if directory != path and not directory.startswith(path + os.sep):
+                continue
+            if directory not in latest or record['file'] > latest[directory]['file']:
+                latest[directory] = record
+
+    day = _find_day(path)
+    if day is not None:
+        collect(_day_records(day, path))
+    else:
+        for root, dirs, files in os.walk(path):
+            if INDEX_NAME in files:
+                collect(_day_records(root))
+                dirs[:] = []
+                continue
+            if any(f.endswith('.ini') for f in files):
+                res = max_log(root)
+                if res is not None:
+                    latest[root] = dict(res[1], dir=root, file=os.path.basename(res[0]))
+    return sorted(latest.items())
+
+
+def rebuild(root) -> int:
+    """
+    为日志根目录 年/月/日 中的每一天生成索引
+    :return: 记录的异常日志数
+    """
+    count = 0
+    for year in sorted(os.listdir(root)):
+        for month in sorted(os.listdir(os.path.join(root, year))) if year.isdigit() else []:
+            for day in sorted(os.listdir(os.path.join(root, year, month))) if month.isdigit() else []:
+                path = os.path.join(root, year, month, day)
+                if day.isdigit() and os.path.isdir(path):
+                    count += build_day(path)
+    return count
+
+
+if __name__ == '__main__':
+    print(f"anomaly log: {rebuild(sys.argv[1] if len(sys.argv) > 1 else '../data/log')} records")
@@ -0,0 +1,340 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_20:50
+@FileName:util_archive.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 历史扫描压缩归档文件：一个小时或一天的扫描合并为一个文件，每个区域单独压缩，按索引随机读取
+
+归档文件位于被归档的时间目录旁边，如 history/2026/10/18/12 归档为 history/2026/10/18/12.tpar
+归档中的扫描路径为归档文件路径加上扫描目录的相对路径，如 history/2026/10/18/12.tpar/30/5，写回pcd_log的Path
+
+文件结构（小端序）：
+    头部    magic(4s) version(B) codec(B) reserved(H) n_scans(I) n_entries(I) index_offset(Q)
+    数据    每个区域单独压缩的帧，内容为只包含该区域的打包文件（见util_pack）
+    索引    n_scans * (name_len(H) name)，扫描的相对路径，以/分隔
+            n_entries * (scan(I) region(i) offset(Q) compressed_size(I) raw_size(I))
+
+读取一个区域只需要读取并解压对应的一帧；压缩算法优先使用zstd或lz4，未安装时退化为标准库zlib
+"""
+import io
+import os
+import struct
+import threading
+import zlib
+
+from utils.util_pack import RegionPack, encode_pack
+from utils.util_writer import fsync_path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+ARCHIVE_SUFFIX = '.tpar'
+MAGIC = b'TRAR'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHIIQ')
+SCAN_NAME = struct.Struct('<H')
+ENTRY = struct.Struct('<IiQII')
+
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODEC_LZ4 = 3
+CODECS = {'zlib': CODEC_ZLIB, 'zstd': CODEC_ZSTD, 'lz4': CODEC_LZ4}
+
+# 同一进程中的分级压缩和保留策略任务修改归档时互斥
+ARCHIVE_LOCK = threading.Lock()
+
+GRANULARITY_HOUR = 'hour'
+GRANULARITY_DAY = 'day'
+# 扫描目录 年/月/日/时/分/秒 到归档时间目录的层数
+BUCKET_DEPTH = {GRANULARITY_HOUR: 2, GRANULARITY_DAY: 3}
+
+
+def codec_available(codec: int) -> bool:
+    if codec == CODEC_ZSTD:
+        return zstandard is not None
+    if codec == CODEC_LZ4:
+        return lz4 is not None
+    return codec == CODEC_ZLIB
+
+
+def choose_codec(name: str) -> int:
+    """
+    按名称选择压缩算法，对应的库没有安装时使用zlib
+    """
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ValueError(f"unknown codec: {name}")
+    if not codec_available(codec):
+        print(f"codec {name} is not installed, fall back to zlib")
+        return CODEC_ZLIB
+    return codec
+
+
+def compress(codec: int, data: bytes, level: int) -> bytes:
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if codec == CODEC_LZ4:
+        return lz4.frame.compress(data, compression_level=level)
+    return zlib.compress(data, min(max(level, 1), 9))
+
+
+def decompress(codec: int, data: bytes, size: int) -> bytes:
+    if not codec_available(codec):
+        raise RuntimeError(f"archive codec {codec} is not installed")
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+    if codec == CODEC_LZ4:
+        return lz4.frame.decompress(data)
+    return zlib.decompress(data)
+
+
+def member_path(archive, scan: str) -> str:
+    """
+    归档中扫描的路径
+    :param archive: 归档文件路径
+    :param scan: 扫描的相对路径，以/分隔
+    """
+    return os.path.join(archive, *scan.split('/'))
+
+
+def split_member(path):
+    """
+    将扫描路径拆分为归档文件和扫描的相对路径
+    :param path: 归档中扫描的路径，或者已经被归档的原扫描目录
+    :return: (归档文件路径, 扫描相对路径)，不在归档中时返回None
+    """
+    path = os.path.normpath(path)
+    marker = ARCHIVE_SUFFIX + os.sep
+    i = path.find(marker)
+    if i >= 0:
+        archive = path[:i + len(ARCHIVE_SUFFIX)]
+        if os.path.isfile(archive):
+            return archive, path[i + len(marker):].replace(os.sep, '/')
+        return None
+    if os.path.isdir(path):
+        return None
+    # 按时间目录拼出的原扫描目录，向上查找覆盖它的归档
+    head, rest = path, []
+    for _ in range(max(BUCKET_DEPTH.values())):
+        head, name = os.path.split(head)
+        if not name:
+            break
+        rest.insert(0, name)
+        if os.path.isfile(head + ARCHIVE_SUFFIX):
+            return head + ARCHIVE_SUFFIX, '/'.join(rest)
+    return None
+
+
+def is_member(path) -> bool:
+    return split_member(path) is not None
+
+
+class ScanArchive(object):
+    """
+    归档文件读取类
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        magic, version, codec, _, n_scans, n_entries, index_offset = HEADER.unpack(self._file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"not a scan archive: {path}")
+        if version != VERSION:
+            raise ValueError(f"unsupported scan archive version: {version}")
+        self.codec = codec
+        self._file.seek(index_offset)
+        raw = self._file.read()
+        offset, names = 0, []
+        for _ in range(n_scans):
+            (size,) = SCAN_NAME.unpack_from(raw, offset)
+            offset += SCAN_NAME.size
+            names.append(raw[offset:offset + size].decode('utf-8'))
+            offset += size
+        self._index = {name: {} for name in names}  # 扫描 -> {区域索引: (偏移, 压缩大小, 原始大小)}
+        for i in range(n_entries):
+            scan, region, frame_offset, csize, rsize = ENTRY.unpack_from(raw, offset + i * ENTRY.size)
+            self._index[names[scan]][region] = (frame_offset, csize, rsize)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def scans(self) -> list:
+        return list(self._index.keys())
+
+    def __contains__(self, scan) -> bool:
+        return scan in self._index
+
+    def keys(self, scan) -> list:
+        return list(self._index.get(scan, {}).keys())
+
+    def read_frame(self, scan, region):
+        """
+        读取一个区域的压缩帧
+        :return: (压缩数据, 原始大小)，不存在时返回None
+        """
+        entry = self._index.get(scan, {}).get(int(region))
+        if entry is None:
+            return None
+        offset, csize, rsize = entry
+        self._file.seek(offset)
+        return self._file.read(csize), rsize
+
+    def read(self, scan, regions=None, bbox=None) -> dict:
+        """
+        读取一次扫描的多个区域，每个区域只解压对应的一帧
+        :param scan: 扫描相对路径
+        :param regions: 区域索引列表，默认全部区域
+        :param bbox: 见RegionPack.read
+        :return: {区域索引: DataFrame}
+        """
+        index = self._index.get(scan, {})
+        if regions is None:
+            regions = index.keys()
+        keys = sorted((int(k) for k in regions if int(k) in index), key=lambda k: index[k][0])
+        res = {}
+        for k in keys:
+            data, size = self.read_frame(scan, k)
+            with RegionPack(self.path, io.BytesIO(decompress(self.codec, data, size))) as pack:
+                res.update(pack.read([k], bbox))
+        return res
+
+
+class ArchivedScan(object):
+    """
+    归档中的一次扫描，接口与RegionPack相同，供list_regions/load_regions使用
+    """
+
+    def __init__(self, path):
+        archive, self.scan = split_member(path)
+        self.path = member_path(archive, self.scan)
+        self._archive = ScanArchive(archive)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        self._archive.close()
+
+    def keys(self) -> list:
+        return self._archive.keys(self.scan)
+
+    def __contains__(self, region) -> bool:
+        return int(region) in self._archive.keys(self.scan)
+
+    def read(self, regions=None, bbox=None) -> dict:
+        return self._archive.read(self.scan, regions, bbox)
+
+
+class ArchiveWriter(object):
+    """
+    归档文件写入类：先写临时文件，commit时落盘并替换
+    """
+
+    def __init__(self, path, codec=CODEC_ZLIB, level=3):
+        self.path = path
+        self.codec = codec
+        self.level = level
+        self._tmp = f"{path}.{os.getpid()}.tmp"
+        self._file = open(self._tmp, 'wb')
+        self._file.write(b'\0' * HEADER.size)
+        self._scans = {}
+        self._entries = []
+
+    def scan_id(self, scan) -> int:
+        """
+        扫描在索引中的编号，第一次出现时登记
+        """
+        return self._scans.setdefault(scan, len(self._scans))
+
+    def add_frame(self, scan, region, data: bytes, size: int) -> None:
+        """
+        写入已经压缩的一帧
+        """
+        self._entries.append((self.scan_id(scan), int(region), self._file.tell(), len(data), size))
+        self._file.write(data)
+
+    def add(self, scan, regions: dict) -> None:
+        """
+        写入一次扫描，每个区域编码为单独的打包文件后压缩
+        :param scan: 扫描相对路径
+        :param regions: {区域索引: DataFrame}
+        """
+        self.scan_id(scan)
+        for k, df in regions.items():
+            if df is None:
+                continue
+            raw = encode_pack({k: df})
+            self.add_frame(scan, k, compress(self.codec, raw, self.level), len(raw))
+
+    def commit(self) -> str:
+        index_offset = self._file.tell()
+        for name in self._scans:
+            data = name.encode('utf-8')
+            self._file.write(SCAN_NAME.pack(len(data)) + data)
+        self._file.write(b''.join(ENTRY.pack(*e) for e in self._entries))
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, VERSION, self.codec, 0, len(self._scans), len(self._entries),
+                                     index_offset))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._tmp, self.path)
+        fsync_path(os.path.dirname(self.path) or '.', True)
+        return self.path
+
+    def abort(self) -> None:
+        self._file.close()
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+
+def compact_archive(path, drop) -> int:
+    """
+    从归档中删除扫描并重写归档，其余扫描的压缩帧原样复制；扫描全部删除时删除归档文件
+    调用方需要持有ARCHIVE_LOCK
+    :param path: 归档文件路径
+    :param drop: 需要删除的扫描相对路径
+    :return: 释放的字节数
+    """
+    size = os.path.getsize(path)
+    with ScanArchive(path) as old:
+        scans = old.scans()
+        keep = [scan for scan in scans if scan not in drop]
+        if len(keep) == len(scans):
+            return 0
+        if not keep:
+            writer = None
+        else:
+            writer = ArchiveWriter(path, old.codec)
+            try:
+                for scan in keep:
+                    writer.scan_id(scan)
+                    for k in old.keys(scan):
+                        data, raw_size = old.read_frame(scan, k)
+                        writer.add_frame(scan, k, data, raw_size)
+            except Exception:
+                writer.abort()
+                raise
+    if writer is None:
+        os.remove(path)
+        return size
+    writer.commit()
+    return size - os.path.getsize(path)
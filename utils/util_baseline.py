@@ -0,0 +1,220 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_20:10
+@FileName:util_baseline.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 基准数据版本管理：新基准先写入临时目录，写完后通过原子替换CURRENT指针发布
+
+目录结构：
+    init/CURRENT                    当前基准的版本号
+    init/versions/<版本号>/          一个完整的基准（init.csv、regions/）
+    init/versions/.staging-<...>/   正在生成的基准，发布时整体改名为versions/<版本号>
+
+版本号为基准采集时间（%Y%m%d%H%M%S%f），按字符串排序即按时间排序；只有比当前版本新的基准才会替换指针
+读取方通过resolve_baseline将init目录或init/regions目录解析为当前版本中的对应目录，旧版没有CURRENT的目录原样返回
+已发布的版本目录不再修改，history中仍有增量文件引用的版本不会被清理，增量文件中记录的基准路径始终有效
+"""
+import configparser
+import os
+import shutil
+import uuid
+from datetime import datetime, timedelta
+
+from utils.util_writer import fsync_path
+
+CONFIG_PATH = '../config/receive.ini'
+
+CURRENT_NAME = 'CURRENT'
+VERSIONS_NAME = 'versions'
+STAGING_PREFIX = '.staging-'
+HISTORY_NAME = 'history'  # 设备数据目录中与init同级的扫描数据目录
+VERSION_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def current_version(init_path):
+    """
+    读取init目录的当前基准版本号
+    :return: 版本号，没有发布过版本时返回None
+    """
+    try:
+        with open(os.path.join(init_path, CURRENT_NAME), 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def resolve_baseline(path) -> str:
+    """
+    将init目录或其中的子目录（如init/regions）解析为当前基准版本中的对应目录
+    :param path: init目录、init下的子目录或任意其他目录
+    :return: 解析后的目录，不是版本化的init目录时原样返回
+    """
+    version = current_version(path)
+    if version is not None:
+        return os.path.join(path, VERSIONS_NAME, version)
+    parent, name = os.path.split(os.path.normpath(path))
+    if name != VERSIONS_NAME:
+        version = current_version(parent)
+        if version is not None:
+            return os.path.join(parent, VERSIONS_NAME, version, name)
+    return path
+
+
+class BaselineVersions(object):
+    """
+    单个采集设备的基准版本
+    """
+
+    def __init__(self, init_path, keep: int = None):
+        """
+        :param init_path: 设备的init目录
+        :param keep: 保留的历史版本数量（不含当前版本），0表示全部保留，None时使用[Baseline]配置
+        """
+        if keep is None:
+            config = configparser.ConfigParser()
+            config.read(CONFIG_PATH)
+            keep = config.getint("Baseline", "keepVersions", fallback=5)
+        self.init_path = init_path
+        self.versions_path = os.path.join(init_path, VERSIONS_NAME)
+        self.keep = keep
+
+    @staticmethod
+    def new_version(time: datetime = None) -> str:
+        """
+        由基准采集时间生成版本号
+        """
+        return (time or datetime.now()).strftime(VERSION_FORMAT)
+
+    def current(self):
+        return current_version(self.init_path)
+
+    def versions(self) -> list:
+        """
+        已发布的版本号，按时间升序
+        """
+        if not os.path.isdir(self.versions_path):
+            return []
+        with os.scandir(self.versions_path) as entries:
+            return sorted(e.name for e in entries if e.is_dir() and not e.name.startswith('.'))
+
+    def path(self, version=None) -> str:
+        """
+        指定版本的目录，默认当前版本；还没有发布过版本时为init目录本身（旧版布局）
+        """
+        version = version or self.current()
+        return self.init_path if version is None else os.path.join(self.versions_path, version)
+
+    def stage(self, version: str) -> str:
+        """
+        创建生成新基准的临时目录，与版本目录位于同一文件系统，发布时可以原子改名
+        :return: 临时目录
+        """
+        staging = os.path.join(self.versions_path, f"{STAGING_PREFIX}{version}-{uuid.uuid4().hex[:8]}")
+        os.makedirs(staging)
+        return staging
+
+    def discard(self, staging) -> None:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    def publish(self, staging, version: str) -> bool:
+        """
+        发布临时目录中写完的基准：改名为版本目录后替换CURRENT指针，读取方不会看到缺失或写了一半的基准
+        :param staging: stage返回的临时目录，其中的文件必须已经写完
+        :param version: 版本号
+        :return: 是否成为当前版本，比当前版本旧的基准只保留为历史版本
+        """
+        try:
+            target = os.path.join(self.versions_path, version)
+            if os.path.exists(target):
+                shutil.rmtree(staging, ignore_errors=True)
+                return False
+            # 临时目录中的文件在替换指针之前落盘
+            for root, _, files in os.walk(staging):
+                for name in files:
+                    fsync_path(os.path.join(root, name))
+                fsync_path(root, True)
+            os.rename(staging, target)
+            fsync_path(self.versions_path, True)
+            current = self.current()
+            if current is not None and current >= version:
+                self.prune()
+                return False
+            pointer = os.path.join(self.init_path, CURRENT_NAME)
+            tmp = f"{pointer}.{uuid.uuid4().hex[:8]}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(version)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, pointer)
+            fsync_path(self.init_path, True)
+            if current is None:
+                self._migrate_legacy(version)
+            self.prune()
+            return True
+        except Exception as e:
+            print(f"An error occurred: {e} in BaselineVersions.publish")
+            return False
+
+    def _migrate_legacy(self, version: str) -> None:
+        """
+        第一次发布后将旧版直接写在init目录中的基准移入版本目录，作为早于version的历史版本保留
+        """
+        legacy = [e for e in os.listdir(self.init_path) if e not in (CURRENT_NAME, VERSIONS_NAME)
+                  and not e.endswith('.tmp')]
+        if not legacy:
+            return
+        mtime = datetime.fromtimestamp(max(os.path.getmtime(os.path.join(self.init_path, e)) for e in legacy))
+        latest = datetime.strptime(version, VERSION_FORMAT) - timedelta(microseconds=1)
+        target = os.path.join(self.versions_path, self.new_version(min(mtime, latest)))
+        if os.path.exists(target):
+            return
+        os.makedirs(target)
+        for name in legacy:
+            os.rename(os.path.join(self.init_path, name), os.path.join(target, name))
+
+    def referenced(self) -> set:
+        """
+        history中的增量文件（regions.delta）仍在引用的版本号
+        """
+        from utils.util_pack import DELTA_NAME, delta_baseline
+        history = os.path.join(os.path.dirname(os.path.normpath(self.init_path)), HISTORY_NAME)
+        prefix = os.path.abspath(self.versions_path) + os.sep
+        res = set()
+        for root, _, files in os.walk(history):
+            if DELTA_NAME not in files:
+                continue
+            try:
+                baseline = delta_baseline(os.path.join(root, DELTA_NAME))
+            except (OSError, ValueError):
+                continue
+            if baseline.startswith(prefix):
+                res.add(baseline[len(prefix):].split(os.sep)[0])
+        return res
+
+    def prune(self) -> list:
+        """
+        删除超出保留数量的旧版本和中断遗留的临时目录，当前版本和增量文件仍在引用的版本始终保留
+        正在后台写入的增量引用的是发布之前的当前版本，它是最新的历史版本，keep不为0时不会被删除
+        :return: 删除的版本号
+        """
+        removed = []
+        current = self.current()
+        if self.keep > 0:
+            older = [v for v in self.versions() if current is None or v < current]
+            expired = older[:max(len(older) - self.keep, 0)]
+            if expired:
+                referenced = self.referenced()
+                for version in expired:
+                    if version in referenced:
+                        continue
+                    shutil.rmtree(os.path.join(self.versions_path, version), ignore_errors=True)
+                    removed.append(version)
+        # 临时目录以版本号命名，比当前版本还旧的说明生成过程已经中断
+        with os.scandir(self.versions_path) as entries:
+            for e in entries:
+                if e.name.startswith(STAGING_PREFIX) and current is not None \
+                        and e.name[len(STAGING_PREFIX):].split('-')[0] < current:
+                    shutil.rmtree(e.path, ignore_errors=True)
+        return removed
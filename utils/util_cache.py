@@ -0,0 +1,140 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_23:10
+@FileName:util_cache.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 基准数据内存缓存：进程内按设备init目录缓存读取好的基准区域，按内存预算LRU淘汰
+
+    1. 缓存键为init目录和点数预算实际选择的多级细节级别，值为 {区域索引: DataFrame}
+       不同的预算选择同一级别（包括没有多级细节、都读取完整数据）时共用一份缓存
+    2. 每次读取只检查基准版本标记：版本化目录为CURRENT指向的版本，旧版目录为基准目录的修改时间
+       init_process发布新基准后版本标记改变，下一次读取重新加载并替换旧的缓存
+    3. 缓存中的DataFrame由多个请求共享，调用方不能原地修改
+"""
+import configparser
+import os
+import threading
+from collections import OrderedDict
+
+from utils.util_baseline import resolve_baseline
+from utils.util_lod import level_regions, lod_level
+from utils.util_pack import clip_bbox, load_regions
+
+CONFIG_PATH = '../config/receive.ini'
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def baseline_marker(directory):
+    """
+    基准版本标记，基准被替换后改变
+    :param directory: init目录或其中的基准目录
+    """
+    resolved = resolve_baseline(directory)
+    if resolved != directory:
+        return resolved
+    try:
+        return os.stat(directory).st_mtime_ns
+    except OSError:
+        return None
+
+
+def frame_size(frames: dict) -> int:
+    return int(sum(df.memory_usage(index=True).sum() for df in frames.values() if df is not None))
+
+
+class BaselineCache(object):
+    """
+    基准数据LRU缓存
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        :param max_bytes: 内存预算，单位字节，0表示不缓存
+        """
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (目录, 级别) -> (版本标记, 区域字典, 字节数)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def metrics(self) -> dict:
+        return {'entries': len(self._entries), 'bytes': self._size, 'hits': self.hits, 'misses': self.misses}
+
+    def _remove(self, key) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[2]
+
+    def invalidate(self, directory=None) -> None:
+        """
+        删除一个init目录的缓存，directory为None时清空
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if directory is None or key[0] == os.path.abspath(directory):
+                    self._remove(key)
+
+    def get(self, directory, budget=None) -> dict:
+        """
+        读取基准区域，版本标记未变时直接返回缓存
+        :param directory: init目录或其中的基准目录
+        :param budget: 点数预算，见lod_regions
+        :return: {区域索引: DataFrame}
+        """
+        marker = baseline_marker(directory)
+        level = lod_level(directory, budget)
+        key = (os.path.abspath(directory), level)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == marker:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        frames = load_regions(level_regions(directory, level))
+        size = frame_size(frames)
+        with self._lock:
+            self._remove(key)
+            if marker is not None and size <= self.max_bytes:
+                self._entries[key] = (marker, frames, size)
+                self._size += size
+                while self._size > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+        return frames
+
+
+def get_baseline_cache() -> BaselineCache:
+    """
+    当前进程的基准缓存，内存预算为[Cache] baselineMemory，单位MB
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            config = configparser.ConfigParser()
+            config.read(CONFIG_PATH)
+            _cache = BaselineCache(int(config.getfloat("Cache", "baselineMemory", fallback=512) * 1024 * 1024))
+        return _cache
+
+
+def load_baseline(directory, budget=None, bbox=None) -> dict:
+    """
+    通过缓存读取基准区域
+    :param directory: init目录或其中的基准目录
+    :param budget: 点数预算，见lod_regions
+    :param bbox: (x0, y0, x1, y1) 只返回投影面上包围盒内的点，不含与包围盒不相交的区域
+    :return: {区域索引: DataFrame}，返回新的字典，其中的DataFrame不能原地修改
+    """
+    frames = get_baseline_cache().get(directory, budget)
+    if bbox is None:
+        return dict(frames)
+    res = {}
+    for k, df in frames.items():
+        df = clip_bbox(df, bbox)
+        if df is not None and len(df):
+            res[k] = df
+    return res
@@ -0,0 +1,385 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_23:30
+@FileName:util_catalog.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 扫描和日志目录索引：每个设备的 <设备>/data/catalog.db（sqlite），写入数据时增量维护，查询最新、按时间和目录树时不再遍历磁盘
+
+记录类型：
+    history   write_single_df写入的扫描目录（含已归档扫描的归档路径）
+    log       日志.ini文件
+    raw       write_df2pcd写入的root及编号目录
+.pcd文件不经过本程序写入，不登记到索引，查询时遍历磁盘
+每条记录保存 路径、上级目录、设备、采集时间、区域索引、最大预警等级和写入时间
+
+索引是否完整记录在meta表中：重建之后、或者设备第一次写入数据时创建的索引是完整的；
+不完整或不存在时查询函数返回None，调用方退回遍历磁盘
+重建：python util_catalog.py <数据根目录>，逐个设备重新扫描磁盘生成索引
+"""
+import ast
+import configparser
+import json
+import os
+import sqlite3
+import sys
+import time as _time
+from datetime import datetime
+
+from utils.util_archive import ARCHIVE_SUFFIX, ScanArchive, member_path
+from utils.util_pack import has_delta, has_pack, has_refs, list_regions
+
+CATALOG_NAME = 'catalog.db'
+DATA_NAME = 'data'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+KIND_HISTORY = 'history'
+KIND_LOG = 'log'
+KIND_RAW = 'raw'
+
+DEGREES = {'一': 1, '二': 2, '三': 3}
+
+
+def degree_level(degree):
+    """
+    预警等级转换为数字，一/二/三或数字
+    """
+    if degree in DEGREES:
+        return DEGREES[degree]
+    try:
+        return int(degree)
+    except (TypeError, ValueError):
+        return 0
+
+
+def data_root(path):
+    """
+    由设备数据目录中的任意路径找到 <设备>/data 目录
+    :return: 目录路径，不在设备数据目录中时返回None
+    """
+    path = os.path.abspath(path)
+    while True:
+        if os.path.basename(path) == DATA_NAME:
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def path_time(path, depth=6):
+    """
+    由 年/月/日/时/分/秒 目录结构得到采集时间，目录层数不足的部分为0
+    :param path: 时间目录中的路径，末尾的非数字部分（如root、文件名）被忽略
+    :return: datetime，无法解析时返回None
+    """
+    parts = []
+    for name in os.path.normpath(path).split(os.sep):
+        if name.isdigit():
+            parts.append(int(name))
+        else:
+            parts = [] if len(parts) < 3 else parts
+    if len(parts) < 3:
+        return None
+    parts = (parts[:depth] + [0] * depth)[:depth]
+    try:
+        return datetime(*parts)
+    except ValueError:
+        return None
+
+
+def parse_log(path) -> dict:
+    """
+    读取一个日志.ini文件
+    :return: {'time', 'regions', 'max_degree'}，无法解析时返回None
+    """
+    config = configparser.ConfigParser()
+    try:
+        config.read(path)
+        time = datetime.strptime(config.get('Time', 'time'), TIME_FORMAT)
+    except (configparser.Error, ValueError):
+        return None
+    regions, max_degree = None, None
+    if config.has_section('Anomalies'):
+        regions = ast.literal_eval(config.get('Anomalies', 'region index'))
+        degree = ast.literal_eval(config.get('Anomalies', 'degree'))
+        max_degree = max([degree_level(d) for d in degree] or [0])
+    return {'time': time, 'regions': regions, 'max_degree': max_degree}
+
+
+def _range(path):
+    """
+    path目录下所有路径的字符串范围
+    """
+    prefix = os.path.abspath(path).rstrip(os.sep) + os.sep
+    return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+
+class Catalog(object):
+    """
+    单个设备的扫描和日志目录索引
+    """
+
+    def __init__(self, directory, exclude=None):
+        """
+        :param directory: 设备数据目录 <设备>/data
+        :param exclude: 创建索引时判断设备是否已有数据，忽略正在登记的路径
+        """
+        self.directory = os.path.abspath(directory)
+        self.path = os.path.join(self.directory, CATALOG_NAME)
+        created = not os.path.isfile(self.path)
+        os.makedirs(self.directory, exist_ok=True)
+        self._con = sqlite3.connect(self.path, timeout=30)
+        with self._con:
+            self._con.execute("CREATE TABLE IF NOT EXISTS entries "
+                              "(path TEXT PRIMARY KEY, parent TEXT NOT NULL, kind TEXT NOT NULL, device TEXT, "
+                              "time TEXT, regions TEXT, max_degree INTEGER, mtime REAL NOT NULL)")
+            self._con.execute("CREATE INDEX IF NOT EXISTS entries_kind_time ON entries (kind, time)")
+            self._con.execute("CREATE INDEX IF NOT EXISTS entries_kind_mtime ON entries (kind, mtime)")
+            self._con.execute("CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent)")
+            self._con.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if created and not self._has_data(exclude):
+            # 设备还没有任何数据，从第一次写入开始的索引是完整的
+            self.set_complete(True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        self._con.close()
+
+    @property
+    def device(self) -> str:
+        return os.path.basename(os.path.dirname(self.directory))
+
+    def _has_data(self, exclude=None) -> bool:
+        """
+        设备数据目录中是否已经有索引登记的数据（history、log和write_df2pcd写入的原始数据），找到第一个文件即返回
+        基准和objects不登记，不影响索引是否完整
+        """
+        exclude = os.path.abspath(exclude) if exclude is not None else None
+        for root, dirs, files in os.walk(self.directory):
+            if root == self.directory:
+                dirs[:] = [d for d in dirs if d != 'init' and d != 'objects']
+                files = [f for f in files if not f.startswith(CATALOG_NAME)]
+            if exclude is not None and (root == exclude or root.startswith(exclude + os.sep)):
+                dirs[:] = []
+                continue
+            if any(os.path.join(root, f) != exclude for f in files):
+                return True
+        return False
+
+    def complete(self) -> bool:
+        row = self._con.execute("SELECT value FROM meta WHERE key = 'complete'").fetchone()
+        return row is not None and row[0] == '1'
+
+    def set_complete(self, value: bool) -> None:
+        with self._con:
+            self._con.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('complete', ?)",
+                              ('1' if value else '0',))
+
+    def add(self, kind, path, time: datetime = None, regions=None, max_degree=None, mtime=None) -> None:
+        """
+        登记一条记录，路径已存在时覆盖
+        """
+        path = os.path.abspath(path)
+        with self._con:
+            self._con.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (path, os.path.dirname(path), kind, self.device,
+                               time.strftime(TIME_FORMAT) if time is not None else None,
+                               json.dumps([int(r) if str(r).lstrip('-').isdigit() else r for r in regions])
+                               if regions is not None else None,
+                               max_degree, _time.time() if mtime is None else mtime))
+
+    def remove(self, paths) -> None:
+        with self._con:
+            self._con.executemany("DELETE FROM entries WHERE path = ?", [(os.path.abspath(p),) for p in paths])
+
+    def move(self, moves) -> None:
+        """
+        修改记录的路径，如扫描被归档
+        :param moves: [(原路径, 新路径)]
+        """
+        with self._con:
+            for old, new in moves:
+                new = os.path.abspath(new)
+                self._con.execute("UPDATE entries SET path = ?, parent = ? WHERE path = ?",
+                                  (new, os.path.dirname(new), os.path.abspath(old)))
+
+    def _where(self, kind, under=None):
+        sql, args = "kind = ?", [kind]
+        if under is not None:
+            low, high = _range(under)
+            sql += " AND ((path > ? AND path < ?) OR path = ?)"
+            args += [low, high, os.path.abspath(under)]
+        return sql, args
+
+    def entries(self, kind, under=None, start: datetime = None, end: datetime = None) -> list:
+        """
+        按采集时间升序列出记录
+        :param kind: 记录类型
+        :param under: 只列出该目录中的记录
+        :param start: 采集时间下限（含）
+        :param end: 采集时间上限（不含）
+        :return: [{'path', 'parent', 'time', 'regions', 'max_degree', 'mtime'}]
+        """
+        sql, args = self._where(kind, under)
+        if start is not None:
+            sql += " AND time >= ?"
+            args.append(start.strftime(TIME_FORMAT))
+        if end is not None:
+            sql += " AND time < ?"
+            args.append(end.strftime(TIME_FORMAT))
+        rows = self._con.execute(f"SELECT path, parent, time, regions, max_degree, mtime FROM entries "
+                                 f"WHERE {sql} ORDER BY time, path", args).fetchall()
+        return [{'path': r[0], 'parent': r[1], 'time': datetime.strptime(r[2], TIME_FORMAT) if r[2] else None,
+                 'regions': json.loads(r[3]) if r[3] else None, 'max_degree': r[4], 'mtime': r[5]} for r in rows]
+
+    def parents(self, kind, under=None) -> list:
+        """
+        包含指定类型记录的目录，按路径排序
+        """
+        sql, args = self._where(kind, under)
+        return [r[0] for r in self._con.execute(f"SELECT DISTINCT parent FROM entries WHERE {sql} ORDER BY parent",
+                                                args)]
+
+    def latest(self, kind, under=None, parent=None, name=None):
+        """
+        写入时间最新的一条记录的路径
+        :param parent: 只在该目录的直接下级中查找
+        :param name: 只查找文件名或目录名为name的记录
+        :return: 路径，没有记录时返回None
+        """
+        sql, args = self._where(kind, under)
+        if parent is not None:
+            sql += " AND parent = ?"
+            args.append(os.path.abspath(parent))
+        if name is not None:
+            sql += " AND path = parent || ? || ?"
+            args += [os.sep, name]
+        row = self._con.execute(f"SELECT path FROM entries WHERE {sql} ORDER BY mtime DESC LIMIT 1", args).fetchone()
+        return row[0] if row else None
+
+    def rebuild(self) -> int:
+        """
+        清空索引并重新扫描设备数据目录
+        :return: 登记的记录数
+        """
+        with self._con:
+            self._con.execute("DELETE FROM entries")
+        self.set_complete(False)
+        count = 0
+        history = os.path.join(self.directory, KIND_HISTORY)
+        for root, dirs, files in os.walk(self.directory):
+            if root == self.directory:
+                dirs[:] = [d for d in dirs if d != 'init' and d != 'objects']
+            mtime = os.path.getmtime(root)
+            if root.startswith(history + os.sep) and (has_pack(root) or has_delta(root) or has_refs(root)
+                                                      or any(f.endswith('.csv') for f in files)):
+                self.add(KIND_HISTORY, root, path_time(root), list(list_regions(root).keys()), mtime=mtime)
+                count += 1
+            if 'root' in dirs:
+                for d in dirs:
+                    path = os.path.join(root, d)
+                    self.add(KIND_RAW, path, path_time(root), mtime=os.path.getmtime(path))
+                    count += 1
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith('.ini'):
+                    log = parse_log(path)
+                    if log is not None:
+                        self.add(KIND_LOG, path, log['time'], log['regions'], log['max_degree'],
+                                 os.path.getmtime(path))
+                        count += 1
+                elif name.endswith(ARCHIVE_SUFFIX) and root.startswith(history + os.sep):
+                    bucket = path[:-len(ARCHIVE_SUFFIX)]
+                    with ScanArchive(path) as archive:
+                        for scan in archive.scans():
+                            member = member_path(path, scan)
+                            self.add(KIND_HISTORY, member, path_time(os.path.join(bucket, *scan.split('/'))),
+                                     archive.keys(scan), mtime=os.path.getmtime(path))
+                            count += 1
+        self.set_complete(True)
+        return count
+
+
+def open_catalog(path):
+    """
+    打开path所在设备的完整索引，供查询使用
+    :return: Catalog，索引不存在或不完整时返回None
+    """
+    directory = data_root(path)
+    if directory is None or not os.path.isfile(os.path.join(directory, CATALOG_NAME)):
+        return None
+    try:
+        catalog = Catalog(directory)
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e} in open_catalog")
+        return None
+    if not catalog.complete():
+        catalog.close()
+        return None
+    return catalog
+
+
+def record(kind, path, time: datetime = None, regions=None, max_degree=None) -> bool:
+    """
+    写入数据后登记到所在设备的索引，失败时不影响写入
+    """
+    directory = data_root(path)
+    if directory is None:
+        return False
+    try:
+        with Catalog(directory, path) as catalog:
+            catalog.add(kind, path, time, regions, max_degree)
+        return True
+    except Exception as e:
+        print(f"An error occurred: {e} in record")
+        return False
+
+
+def forget(paths=(), moves=()) -> None:
+    """
+    扫描被删除或归档后同步修改所在设备的索引，索引不存在时忽略
+    :param paths: 删除的路径
+    :param moves: [(原路径, 新路径)]
+    """
+    groups = {}
+    for path in paths:
+        groups.setdefault(data_root(path), ([], []))[0].append(path)
+    for old, new in moves:
+        groups.setdefault(data_root(old), ([], []))[1].append((old, new))
+    for directory, (removed, moved) in groups.items():
+        if directory is None or not os.path.isfile(os.path.join(directory, CATALOG_NAME)):
+            continue
+        try:
+            with Catalog(directory) as catalog:
+                catalog.remove(removed)
+                catalog.move(moved)
+        except Exception as e:
+            print(f"An error occurred: {e} in forget")
+
+
+def rebuild_all(root) -> dict:
+    """
+    重建数据根目录中所有设备的索引
+    :param root: 数据根目录，其中每个设备一个目录
+    :return: {设备: 记录数}
+    """
+    res = {}
+    with os.scandir(root) as entries:
+        for entry in entries:
+            directory = os.path.join(entry.path, DATA_NAME)
+            if entry.is_dir() and os.path.isdir(directory):
+                with Catalog(directory) as catalog:
+                    res[entry.name] = catalog.rebuild()
+    return res
+
+
+if __name__ == '__main__':
+    for device, count in rebuild_all(sys.argv[1] if len(sys.argv) > 1 else '../data').items():
+        print(f"catalog: {device} {count} entries")
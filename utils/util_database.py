@@ -1229,7 +1229,8 @@ class DBUtils(object):
                 acq_res['Distance'], con_res['ConEquipCode'], tunnel.device_id, str_time, time.year,
                 time.month, time.day, time.hour, time.minute, time.second, str(os.path.abspath(path))))
             con.commit()
-            return True
+            # 返回新记录的ID，扫描数据写入失败时用于删除该记录
+            return cursor.lastrowid or True
         except Exception as e:
             if con:
                 con.rollback()
@@ -1289,6 +1290,122 @@ class DBUtils(object):
             if con:
                 DBUtils.close_connection(con)
 
+    @staticmethod
+    def get_pcd_log_before(end: datetime, exclude: str = None):
+        """
+        查询采集时间早于end的点云记录，按采集时间升序
+        :param end: 截止时间（不含）
+        :param exclude: 排除Path匹配该LIKE模式的记录
+        :return: [{'ID', 'ProCode', 'DataAcqEquipCode', 'AnomalyTime', 'Path'}]，查询失败时返回None
+        """
+        con = None
+        cursor = None
+        try:
+            dbu = DBUtils()
+            con = dbu.connection(cursor_class=DictCursor)
+            cursor = con.cursor()
+            sql = "SELECT ID, ProCode, DataAcqEquipCode, AnomalyTime, Path FROM pcd_log WHERE AnomalyTime < %s"
+            params = [end.strftime("%Y-%m-%d %H:%M:%S")]
+            if exclude is not None:
+                sql += " AND Path NOT LIKE %s"
+                params.append(exclude)
+            cursor.execute(sql + " ORDER BY AnomalyTime", params)
+            return cursor.fetchall()
+        except Exception as e:
+            print(f"An error occurred: {e} in get_pcd_log_before")
+            return None
+        finally:
+            if cursor:
+                cursor.close()
+            if con:
+                DBUtils.close_connection(con)
+
+    @staticmethod
+    def update_pcd_paths(paths: list) -> bool:
+        """
+        在一个事务中批量修改点云记录的保存路径
+        :param paths: [(ID, Path)]
+        :return: 是否全部修改成功，失败时回滚
+        """
+        if not paths:
+            return True
+        con = None
+        cursor = None
+        try:
+            dbu = DBUtils()
+            con = dbu.connection()
+            cursor = con.cursor()
+            con.begin()
+            cursor.executemany("UPDATE pcd_log SET Path = %s WHERE ID = %s", [(p, i) for i, p in paths])
+            con.commit()
+            return True
+        except Exception as e:
+            print(f"An error occurred: {e} in update_pcd_paths")
+            if con:
+                con.rollback()
+            return False
+        finally:
+            if cursor:
+                cursor.close()
+            if con:
+                DBUtils.close_connection(con)
+
+    @staticmethod
+    def get_pcd_log_by_paths(paths: list):
+        """
+        查询保存路径为paths之一的点云记录，同一秒内的多次扫描写入同一目录，共用一个Path
+        :param paths: 保存路径
+        :return: [{'ID', 'Path'}]，查询失败时返回None
+        """
+        if not paths:
+            return []
+        con = None
+        cursor = None
+        try:
+            dbu = DBUtils()
+            con = dbu.connection(cursor_class=DictCursor)
+            cursor = con.cursor()
+            cursor.execute(f"SELECT ID, Path FROM pcd_log WHERE Path IN ({', '.join(['%s'] * len(paths))})",
+                           list(paths))
+            return cursor.fetchall()
+        except Exception as e:
+            print(f"An error occurred: {e} in get_pcd_log_by_paths")
+            return None
+        finally:
+            if cursor:
+                cursor.close()
+            if con:
+                DBUtils.close_connection(con)
+
+    @staticmethod
+    def delete_pcd_logs(ids: list) -> bool:
+        """
+        在一个事务中批量删除点云记录
+        :param ids: 点云记录ID
+        :return: 是否全部删除成功，失败时回滚
+        """
+        if not ids:
+            return True
+        con = None
+        cursor = None
+        try:
+            dbu = DBUtils()
+            con = dbu.connection()
+            cursor = con.cursor()
+            con.begin()
+            cursor.execute(f"DELETE FROM pcd_log WHERE ID IN ({', '.join(['%s'] * len(ids))})", list(ids))
+            con.commit()
+            return True
+        except Exception as e:
+            print(f"An error occurred: {e} in delete_pcd_logs")
+            if con:
+                con.rollback()
+            return False
+        finally:
+            if cursor:
+                cursor.close()
+            if con:
+                DBUtils.close_connection(con)
 
 # if __name__ == '__main__':
 #     data = {
@@ -0,0 +1,200 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_9:30
+@FileName:util_grid.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 投影面网格计算工具类：基于NumPy的向量化区域划分
+"""
+import numpy as np
+
+
+def grid_shape(min_x, max_x, min_y, max_y, grid_size):
+    """
+    计算投影面在x、y方向上的网格数量，计算方式与Segment.subdivide保持一致
+    :param min_x: x轴起点
+    :param max_x: x轴终点
+    :param min_y: y轴起点
+    :param max_y: y轴终点
+    :param grid_size: 网格大小
+    :return: (num_x, num_y)
+    """
+    num_x = int(np.ceil((max_x - min_x) / grid_size))
+    num_y = int(np.ceil((max_y - min_y) / grid_size))
+    return num_x, num_y
+
+
+def cell_index(points, min_x, min_y, grid_size, num_x, num_y):
+    """
+    一次性计算所有点所在的网格索引：region_idx = x_idx + y_idx * num_x
+    落在投影面范围之外的点通过mask标记，不参与划分
+    :param points: (N, 2+) 坐标数组，只使用前两列
+    :param min_x: x轴起点
+    :param min_y: y轴起点
+    :param grid_size: 网格大小
+    :param num_x: x方向网格数量（可为负数，与Region的常量定义方式有关）
+    :param num_y: y方向网格数量
+    :return: (区域索引数组 int64, 有效点mask)
+    """
+    x_idx = np.floor_divide(points[:, 0] - min_x, grid_size).astype(np.int64)
+    y_idx = np.floor_divide(points[:, 1] - min_y, grid_size).astype(np.int64)
+    valid = ((x_idx >= min(0, num_x)) & (x_idx < max(0, num_x)) &
+             (y_idx >= min(0, num_y)) & (y_idx < max(0, num_y)))
+    return x_idx + y_idx * num_x, valid
+
+
+def group_by_cell(index, n_cells):
+    """
+    通过一次稳定排序和bincount对区域索引分组，区域内保持原始点顺序
+    :param index: 区域索引数组，取值范围[0, n_cells)
+    :param n_cells: 区域数量
+    :return: (排序下标, 区域偏移数组 长度n_cells+1, 有数据的区域索引)
+    """
+    order = np.argsort(index, kind='stable')
+    counts = np.bincount(index, minlength=n_cells)
+    offsets = np.zeros(n_cells + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    occupied = np.flatnonzero(counts)
+    return order, offsets, occupied
+
+
+def segment_points(points, min_x, max_x, min_y, max_y, grid_size):
+    """
+    向量化的区域划分引擎
+    :param points: (N, 3+) 点云坐标数组
+    :param min_x: x轴起点
+    :param max_x: x轴终点
+    :param min_y: y轴起点
+    :param max_y: y轴终点
+    :param grid_size: 网格大小
+    :return: (按区域排序后的点数组, 区域偏移数组, 有数据的区域索引, 区域数量)
+    """
+    num_x, num_y = grid_shape(min_x, max_x, min_y, max_y, grid_size)
+    n_cells = num_x * num_y
+    index, valid = cell_index(points, min_x, min_y, grid_size, num_x, num_y)
+    if not valid.all():
+        points, index = points[valid], index[valid]
+    order, offsets, occupied = group_by_cell(index, n_cells)
+    return points[order], offsets, occupied, n_cells
+
+
+def cell_stats(values, index, n_cells, percentiles=(5, 50, 95)):
+    """
+    一次向量化计算所有区域的统计量：数量、均值、最小值、最大值、标准差和分位数
+    没有数据的区域统计量为nan（数量为0）
+    :param values: 每个点的取值（通常为Z坐标）
+    :param index: 每个点所在的区域索引，取值范围[0, n_cells)
+    :param n_cells: 区域数量
+    :param percentiles: 需要计算的分位数，0~100
+    :return: dict，键为count/mean/min/max/std/p{q}，值为长度n_cells的数组
+    """
+    values = np.asarray(values, dtype=np.float64)
+    count = np.bincount(index, minlength=n_cells)
+    occupied = count > 0
+    total = np.bincount(index, weights=values, minlength=n_cells)
+
+    mean = np.full(n_cells, np.nan)
+    mean[occupied] = total[occupied] / count[occupied]
+    # 两遍法计算方差，避免平方和相减带来的精度损失
+    squares = np.bincount(index, weights=(values - mean[index]) ** 2, minlength=n_cells)
+    std = np.full(n_cells, np.nan)
+    std[occupied] = np.sqrt(squares[occupied] / count[occupied])
+
+    # 按(区域, 取值)排序后，每个区域的最小值、最大值和分位数都可以直接按位置取得
+    sorted_values = values[np.lexsort((values, index))]
+    offsets = np.zeros(n_cells + 1, dtype=np.int64)
+    np.cumsum(count, out=offsets[1:])
+    starts, ends = offsets[:-1][occupied], offsets[1:][occupied]
+
+    res = {'count': count, 'mean': mean, 'std': std}
+    for name, pos in (('min', starts), ('max', ends - 1)):
+        res[name] = np.full(n_cells, np.nan)
+        res[name][occupied] = sorted_values[pos]
+    for q in percentiles:
+        # 与np.percentile默认的线性插值一致
+        pos = starts + (ends - starts - 1) * (q / 100.0)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, ends - 1)
+        frac = pos - lo
+        res[f'p{q}'] = np.full(n_cells, np.nan)
+        res[f'p{q}'][occupied] = sorted_values[lo] * (1 - frac) + sorted_values[hi] * frac
+    return res
+
+
+def _spread_bits(v):
+    """
+    将32位整数的各位间隔展开到64位的偶数位上
+    """
+    v = np.asarray(v, dtype=np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def morton_encode(x, y):
+    """
+    二维Morton（Z序）编码：x占偶数位，y占奇数位，空间上相邻的网格编码也大多相邻
+    :param x: 非负整数数组
+    :param y: 非负整数数组
+    :return: uint64编码数组
+    """
+    return _spread_bits(x) | (_spread_bits(y) << np.uint64(1))
+
+
+def cell_coords(index, num_x, num_y):
+    """
+    由区域索引还原网格坐标，cell_index的逆运算
+    :param index: 区域索引数组
+    :param num_x: x方向网格数量（可为负数）
+    :param num_y: y方向网格数量（可为负数）
+    :return: (x_idx, y_idx)，与cell_index中的取值相同
+    """
+    index = np.asarray(index, dtype=np.int64)
+    lo_x = min(0, num_x)
+    x_idx = (index - lo_x) % abs(num_x) + lo_x
+    y_idx = (index - x_idx) // num_x
+    return x_idx, y_idx
+
+
+def cell_morton(index, num_x, num_y):
+    """
+    区域索引对应的Morton编码，网格坐标先平移为从0开始
+    """
+    x_idx, y_idx = cell_coords(index, num_x, num_y)
+    return morton_encode(x_idx - min(0, num_x), y_idx - min(0, num_y))
+
+
+def bbox_cells(bbox, min_x, max_x, min_y, max_y, grid_size):
+    """
+    与包围盒相交的所有区域索引
+    :param bbox: (x0, y0, x1, y1) 投影面上的包围盒，单位米
+    :return: 区域索引数组，按Morton编码排序
+    """
+    num_x, num_y = grid_shape(min_x, max_x, min_y, max_y, grid_size)
+    x0, y0, x1, y1 = bbox
+    ranges = []
+    for a, b, origin, n in ((x0, x1, min_x, num_x), (y0, y1, min_y, num_y)):
+        lo, hi = sorted((int(np.floor((a - origin) / grid_size)), int(np.floor((b - origin) / grid_size))))
+        lo, hi = max(lo, min(0, n)), min(hi, max(0, n) - 1)
+        ranges.append(np.arange(lo, hi + 1, dtype=np.int64))
+    xs, ys = np.meshgrid(*ranges, indexing='ij')
+    index = (xs + ys * num_x).ravel()
+    return index[np.argsort(cell_morton(index, num_x, num_y), kind='stable')]
+
+
+def point_order(xy, grid_size, bits=8):
+    """
+    区域内点的Morton顺序：以区域内坐标最小值为原点，按grid_size / 2**bits的小格编码
+    :param xy: (n, 2) 坐标数组
+    :param grid_size: 网格大小
+    :param bits: 每个方向的编码位数
+    :return: 排序下标
+    """
+    xy = np.asarray(xy, dtype=np.float64)
+    if len(xy) == 0:
+        return np.arange(0, dtype=np.int64)
+    q = np.floor((xy - xy.min(axis=0)) / grid_size * (1 << bits)).astype(np.int64)
+    q = np.clip(q, 0, (1 << bits) - 1)
+    return np.argsort(morton_encode(q[:, 0], q[:, 1]), kind='stable')
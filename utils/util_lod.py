@@ -0,0 +1,257 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_22:30
+@FileName:util_lod.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 多级细节（LOD）：写入扫描和基准时按几个体素大小降采样，与完整数据保存在同一目录，读取时按点数预算选择级别
+
+目录结构（与regions.pack等完整数据位于同一目录）：
+    regions.lod1.pack ...   第1、2、3级降采样数据，格式与regions.pack相同，体素依次增大
+    lod.json                {"voxels": [0, 0.05, 0.1, 0.2], "points": [完整点数, 第1级点数, ...]}
+
+每个体素只保留第一个点，点的颜色和区域划分不变；没有lod.json的目录（旧数据、已归档的扫描）始终读取完整数据
+
+查询时的降采样（decimate）：按点数预算或体素大小对合并后的点云降采样，异常颜色的点使用更小的体素
+按点数预算降采样时异常点最多占预算的anomalyShare，超出时异常点单独按这部分预算选择体素，其余预算留给普通点
+"""
+import configparser
+import json
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from utils.util_baseline import resolve_baseline
+from utils.util_pack import PackRef, RegionPack, encode_pack, list_regions
+
+CONFIG_PATH = '../config/receive.ini'
+
+LOD_MANIFEST = 'lod.json'
+NORMAL_RGB = (118, 238, 198)  # 正常区域的颜色
+
+
+def lod_name(level: int) -> str:
+    return f"regions.lod{level}.pack"
+
+
+@lru_cache(maxsize=1)
+def lod_config() -> dict:
+    """
+    读取[LOD]配置：是否生成多级细节、每一级的体素大小（单位米）、查询降采样时异常点体素的缩小倍数和异常点最多占用的预算比例
+    """
+    config = configparser.ConfigParser()
+    config.read(CONFIG_PATH)
+    voxels = config.get("LOD", "voxels", fallback="0.05, 0.1, 0.2")
+    return {
+        'enabled': config.getboolean("LOD", "enabled", fallback=False),
+        'voxels': sorted(float(v) for v in voxels.split(',') if v.strip()),
+        'anomaly_density': config.getfloat("LOD", "anomalyDensity", fallback=4),
+        'anomaly_share': config.getfloat("LOD", "anomalyShare", fallback=0.5)
+    }
+
+
+def _voxel_keys(xyz, voxel: float) -> np.ndarray:
+    """
+    每个点所在体素的整数键，相同体素的点键相同
+    体素相对包围盒很小、网格单元总数超出int64时按体素坐标去重编号
+    """
+    cells = np.floor(xyz / voxel).astype(np.int64)
+    cells -= cells.min(axis=0)
+    dims = cells.max(axis=0) + 1
+    if float(np.prod(dims.astype(np.float64))) < 2 ** 62:
+        return np.ravel_multi_index(cells.T, tuple(dims))
+    return np.unique(cells, axis=0, return_inverse=True)[1].reshape(-1)
+
+
+def voxel_downsample(xyz, voxel: float) -> np.ndarray:
+    """
+    体素网格降采样
+    :param xyz: (n, 3) 坐标
+    :param voxel: 体素大小，单位米
+    :return: 保留的点的下标，按原顺序排列，每个体素一个点
+    """
+    xyz = np.asarray(xyz, dtype=np.float64)
+    if len(xyz) == 0 or voxel <= 0:
+        return np.arange(len(xyz))
+    _, first = np.unique(_voxel_keys(xyz, voxel), return_index=True)
+    return np.sort(first)
+
+
+def voxel_count(xyz, voxel: float) -> int:
+    """
+    体素网格降采样后的点数，只计数不排序下标
+    """
+    if len(xyz) == 0 or voxel <= 0:
+        return len(xyz)
+    keys = np.sort(_voxel_keys(xyz, voxel))
+    return int(np.count_nonzero(np.diff(keys))) + 1
+
+
+def _decimate_index(xyz, dense, voxel: float, dense_voxel: float) -> np.ndarray:
+    """
+    普通点按voxel降采样，异常点按dense_voxel降采样
+    :return: 保留的点的下标，升序
+    """
+    normal_idx, dense_idx = np.flatnonzero(~dense), np.flatnonzero(dense)
+    keep = [normal_idx[voxel_downsample(xyz[normal_idx], voxel)],
+            dense_idx[voxel_downsample(xyz[dense_idx], dense_voxel)]]
+    return np.sort(np.concatenate(keep))
+
+
+def _decimate_count(xyz, dense, voxel: float, factor: float) -> int:
+    return voxel_count(xyz[~dense], voxel) + voxel_count(xyz[dense], voxel / factor)
+
+
+def fit_voxel(xyz, dense, budget: int, factor: float, steps=6) -> float:
+    """
+    二分查找使降采样后点数不超过预算的最小体素
+    :param xyz: (n, 3) 坐标
+    :param dense: (n,) 是否为保持较高密度的异常点
+    :param budget: 点数预算
+    :param factor: 异常点体素的缩小倍数
+    :param steps: 二分次数，区间为初始估计的1/8到8倍时误差约7%
+    :return: 体素大小，单位米
+    """
+    span = np.maximum(np.ptp(xyz, axis=0), 1e-3) if len(xyz) else np.ones(3)
+    extent = float(span.max())
+    # 按包围盒体积估计初始体素，点云为曲面时偏小，上界不够时扩大
+    guess = float(np.cbrt(np.prod(span) / max(budget, 1)))
+    lo, hi = guess / 8, guess * 8
+    while hi < extent and _decimate_count(xyz, dense, hi, factor) > budget:
+        lo, hi = hi, hi * 8
+    hi = min(hi, extent)
+    if _decimate_count(xyz, dense, hi, factor) > budget:
+        return hi
+    for _ in range(steps):
+        mid = float(np.sqrt(lo * hi))
+        if _decimate_count(xyz, dense, mid, factor) <= budget:
+            hi = mid
+        else:
+            lo = mid
+    return hi
+
+
+def fit_voxels(xyz, dense, budget: int, factor: float, share: float) -> tuple:
+    """
+    按点数预算选择普通点和异常点的体素，异常点最多占用budget * share
+    :return: (普通点体素, 异常点体素)
+    """
+    voxel = fit_voxel(xyz, dense, budget, factor)
+    limit = int(budget * share)
+    if voxel_count(xyz[dense], voxel / factor) <= limit:
+        return voxel, voxel / factor
+    # 异常点超出自己的份额：异常点只在份额内降采样，剩余预算全部留给普通点
+    dense_xyz, normal_xyz = xyz[dense], xyz[~dense]
+    dense_voxel = fit_voxel(dense_xyz, np.zeros(len(dense_xyz), dtype=bool), max(limit, 1), 1)
+    rest = budget - voxel_count(dense_xyz, dense_voxel)
+    voxel = fit_voxel(normal_xyz, np.zeros(len(normal_xyz), dtype=bool), max(rest, 1), 1)
+    return voxel, dense_voxel
+
+
+def decimate(xyz, rgb, budget=None, voxel=None, normal=NORMAL_RGB, factor=None, share=None) -> tuple:
+    """
+    响应序列化之前的体素降采样，颜色不是正常颜色的异常点保持较高的密度
+    :param xyz: (n, 3) 坐标
+    :param rgb: (n, 3) 颜色
+    :param budget: 点数预算，超过时自动选择体素大小；与voxel都为None时不降采样
+    :param voxel: 普通点的体素大小，单位米，优先于budget
+    :param normal: 正常区域的颜色
+    :param factor: 异常点体素的缩小倍数，默认使用[LOD] anomalyDensity
+    :param share: 按预算降采样时异常点最多占用的预算比例，默认使用[LOD] anomalyShare
+    :return: (xyz, rgb)
+    """
+    if voxel is None and (budget is None or len(xyz) <= budget):
+        return xyz, rgb
+    xyz, rgb = np.asarray(xyz), np.asarray(rgb)
+    factor = lod_config()['anomaly_density'] if factor is None else factor
+    share = lod_config()['anomaly_share'] if share is None else share
+    dense = np.any(rgb != np.asarray(normal), axis=1)
+    if voxel is None:
+        voxel, dense_voxel = fit_voxels(xyz, dense, budget, factor, share)
+    else:
+        dense_voxel = voxel / factor
+    keep = _decimate_index(xyz, dense, voxel, dense_voxel)
+    return xyz[keep], rgb[keep]
+
+
+def encode_lods(regions: dict, voxels=None, grid=None) -> dict:
+    """
+    将区域点云编码为各级降采样文件和lod.json
+    :param regions: {区域索引: DataFrame}
+    :param voxels: 每一级的体素大小，默认使用[LOD]配置
+    :param grid: 见encode_pack
+    :return: {文件名: bytes}，没有区域时返回空字典
+    """
+    regions = {k: df for k, df in regions.items() if df is not None}
+    if not regions:
+        return {}
+    voxels = lod_config()['voxels'] if voxels is None else voxels
+    files, points = {}, [sum(len(df) for df in regions.values())]
+    for level, voxel in enumerate(voxels, 1):
+        decimated = {k: df.iloc[voxel_downsample(df[['X', 'Y', 'Z']].values, voxel)] for k, df in regions.items()}
+        files[lod_name(level)] = encode_pack(decimated, grid=grid)
+        points.append(sum(len(df) for df in decimated.values()))
+    files[LOD_MANIFEST] = json.dumps({'voxels': [0] + list(voxels), 'points': points}).encode('utf-8')
+    return files
+
+
+def read_manifest(directory):
+    """
+    :return: lod.json的内容，没有多级细节时返回None
+    """
+    try:
+        with open(os.path.join(directory, LOD_MANIFEST), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def choose_level(manifest: dict, budget: int) -> int:
+    """
+    选择点数不超过预算的最精细级别，都超过时选择最粗的级别
+    """
+    points = manifest['points']
+    for level, count in enumerate(points):
+        if count <= budget:
+            return level
+    return len(points) - 1
+
+
+def lod_level(directory, budget=None) -> int:
+    """
+    按点数预算实际读取的级别
+    :param directory: 扫描数据目录或基准目录
+    :param budget: 点数预算，None表示读取完整数据
+    :return: 级别，0为完整数据；没有lod.json或对应级别的文件不存在时为0
+    """
+    if budget is None:
+        return 0
+    resolved = resolve_baseline(directory)
+    manifest = read_manifest(resolved)
+    level = choose_level(manifest, budget) if manifest is not None else 0
+    if level == 0 or not os.path.isfile(os.path.join(resolved, lod_name(level))):
+        return 0
+    return level
+
+
+def level_regions(directory, level: int) -> dict:
+    """
+    列出指定级别的区域数据，返回值与list_regions相同
+    :param level: lod_level返回的级别
+    """
+    if level == 0:
+        return list_regions(directory)
+    with RegionPack(os.path.join(resolve_baseline(directory), lod_name(level))) as pack:
+        return {k: PackRef(pack.path, k) for k in pack.keys()}
+
+
+def lod_regions(directory, budget=None) -> dict:
+    """
+    按点数预算列出目录中的区域数据，返回值与list_regions相同，可以直接交给load_regions读取
+    :param directory: 扫描数据目录或基准目录
+    :param budget: 点数预算，None表示读取完整数据
+    :return: {区域索引: PackRef或CSV文件路径}
+    """
+    return level_regions(directory, lod_level(directory, budget))
@@ -0,0 +1,970 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_18:20
+@FileName:util_pack.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 单次扫描的区域打包文件：所有区域点云写入一个文件，文件头部的索引记录每个区域的偏移和点数
+
+文件结构（小端序）：
+    头部    magic(4s) version(B) flags(B) reserved(H) n_regions(I)
+    索引    n_regions * (region(i) n_points(I) offset(Q))，按区域索引升序
+    数据块  每个区域：坐标float32 * n_points * 3，颜色uint8 * n_points * 3（flags含FLAG_RGB时存在），补齐到4字节对齐
+
+量化编码（flags含FLAG_QUANT，version 2）：
+    每个数据块以 origin_x(d) origin_y(d) origin_z(d) precision(d) 开头
+    坐标为uint16 * n_points * 3，即相对区域原点的偏移除以精度；precision为0表示该区域无法满足误差要求，仍为float32
+    区域原点为区域内坐标最小值按精度向下取整，X/Y方向位于0.5m网格单元内，Z方向为区域最低点
+
+增量文件regions.delta：非初始化阶段的区域只保存相对基准（init/regions）的高度残差
+    头部    magic(4s) version(B) bins(B) reserved(H) n_regions(I) precision(d) base_size(Q) base_mtime_ns(q) path_len(H)
+    基准    基准打包文件路径utf-8，补齐到8字节对齐
+    索引    n_regions * (region(i) n_changed(I) offset(Q))，按区域索引升序
+    数据块  每个区域：颜色uint8 * 3，补齐1字节，残差int16 * bins * bins，补齐到4字节对齐，变化点float32 * n_changed * 3
+    区域按基准点的XY包围盒划分为bins * bins个小格，残差为本次扫描与基准在每个小格中的Z均值之差（单位precision）
+    还原时取基准区域的点，Z加上所在小格的残差，再加上原样保存的变化点；残差为DELTA_DROP的小格不使用基准点
+    逐点检查：小格内扫描点与基准点距小格平均高度的偏差都不超过deltaMaxError时才使用残差，其余扫描点作为变化点保存
+    基准文件的大小或修改时间变化时拒绝还原
+
+去重引用文件regions.refs：区域内容存放在设备级的内容寻址存储objects/中，扫描目录只保存引用
+    头部    magic(4s) version(B) reserved(B) reserved(H) n_regions(I)
+    引用    n_regions * (region(i) digest(16s))
+    对象    objects/<digest前2位>/<digest>.pack，内容为只包含一个区域的打包文件
+    引用计数保存在objects/objects.db（sqlite），计数归零时删除对象
+
+Morton布局（flags含FLAG_MORTON，version 3）：
+    头部之后为 min_x(d) max_x(d) min_y(d) max_y(d) grid_size(d)，即划分区域时使用的投影面网格
+    索引和数据块按区域网格坐标的Morton编码排序，区域内的点也按Morton顺序排列
+    按包围盒读取时只读取相交的区域，偏移相邻的数据块合并为一次连续读取
+
+读取任意区域子集只需要打开一次文件，按偏移顺序读取对应的数据块
+"""
+import configparser
+import contextlib
+import hashlib
+import os
+import sqlite3
+import struct
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from utils.util_baseline import resolve_baseline
+from utils.util_grid import bbox_cells, cell_morton, grid_shape, point_order
+
+PACK_NAME = 'regions.pack'
+DELTA_NAME = 'regions.delta'
+BASELINE_NAME = 'regions'  # 初始化目录中基准区域数据的目录名，与ReceiveThread.INIT_REGIONS_NAME一致
+MAGIC = b'TRPK'
+VERSION = 1
+VERSION_QUANT = 2
+VERSION_MORTON = 3
+HEADER = struct.Struct('<4sBBHI')
+ENTRY = struct.Struct('<iIQ')
+QBLOCK = struct.Struct('<dddd')
+GRID = struct.Struct('<ddddd')
+
+FLAG_RGB = 0x01  # 包含颜色数据
+FLAG_QUANT = 0x02  # 坐标量化编码
+FLAG_MORTON = 0x04  # 按Morton编码排列区域和点
+QMAX = np.iinfo(np.uint16).max
+
+DELTA_MAGIC = b'TRDL'
+DELTA_VERSION = 2
+DELTA_HEADER = struct.Struct('<4sBBHIdQqH')
+DELTA_ENTRY = struct.Struct('<iIQ')
+RMAX = np.iinfo(np.int16).max
+DELTA_DROP = np.iinfo(np.int16).min  # 本次扫描在该小格中没有可由残差表示的点
+
+REFS_NAME = 'regions.refs'
+REFS_CLAIMED = '.released'  # release_scan先把引用文件改名为regions.refs.released再释放
+OBJECTS_NAME = 'objects'  # 设备数据目录中的内容寻址存储目录，与init、history同级
+REFS_MAGIC = b'TRRF'
+REFS_VERSION = 1
+REFS_HEADER = struct.Struct('<4sBBHI')
+REF_ENTRY = struct.Struct('<i16s')
+
+CONFIG_PATH = '../config/receive.ini'
+
+COLUMNS = ['X', 'Y', 'Z', 'R', 'G', 'B']
+
+
+class PackRef(namedtuple('PackRef', ['path', 'region'])):
+    """
+    打包文件中的一个区域，字符串形式为 "打包文件路径#区域索引"，可以代替旧版的区域CSV文件路径返回给调用方
+    """
+
+    def __str__(self):
+        return f"{self.path}#{self.region}"
+
+    @staticmethod
+    def parse(ref):
+        """
+        将PackRef的字符串形式还原，其他路径原样返回
+        """
+        if isinstance(ref, PackRef) or not isinstance(ref, str):
+            return ref
+        from utils.util_archive import ARCHIVE_SUFFIX  # 归档模块依赖本模块，在使用时导入
+        path, sep, region = ref.rpartition('#')
+        name = os.path.basename(path)
+        if sep and (name == DELTA_NAME or name.endswith('.pack') or ARCHIVE_SUFFIX + os.sep in path) \
+                and region.lstrip('-').isdigit():
+            return PackRef(path, int(region))
+        return ref
+
+
+def _align(n, size=4):
+    return (n + size - 1) // size * size
+
+
+def pack_path(directory) -> str:
+    return os.path.join(directory, PACK_NAME)
+
+
+@lru_cache(maxsize=1)
+def storage_config() -> dict:
+    """
+    读取[Storage]配置：是否量化、量化精度和允许的最大误差，单位米
+    """
+    config = configparser.ConfigParser()
+    config.read(CONFIG_PATH)
+    precision = config.getfloat("Storage", "precision", fallback=0.001)
+    return {
+        'quantize': config.getboolean("Storage", "quantize", fallback=False),
+        'precision': precision,
+        'max_error': config.getfloat("Storage", "maxError", fallback=precision),
+        'delta': config.getboolean("Storage", "delta", fallback=False),
+        'delta_bins': config.getint("Storage", "deltaBins", fallback=10),
+        'delta_precision': config.getfloat("Storage", "deltaPrecision", fallback=precision),
+        'delta_max_miss': config.getfloat("Storage", "deltaMaxMiss", fallback=0.1),
+        'delta_max_error': config.getfloat("Storage", "deltaMaxError",
+                                           fallback=config.getfloat("Storage", "maxError", fallback=precision)),
+        'dedup': config.getboolean("Storage", "dedup", fallback=False),
+        'morton': config.getboolean("Storage", "morton", fallback=False)
+    }
+
+
+def quantize(xyz, precision, max_error=None):
+    """
+    将坐标量化为相对区域原点的uint16偏移
+    :param xyz: (n, 3) 坐标
+    :param precision: 量化精度
+    :param max_error: 允许的最大误差，默认为precision / 2
+    :return: (origin (3,), q (n, 3) uint16)，超出uint16范围或误差超限时返回None
+    """
+    xyz = np.asarray(xyz, dtype=np.float64)
+    if len(xyz) == 0:
+        return np.zeros(3), np.empty((0, 3), dtype='<u2')
+    origin = np.floor(xyz.min(axis=0) / precision) * precision
+    q = np.rint((xyz - origin) / precision)
+    if q.max() > QMAX:
+        return None
+    q = q.astype('<u2')
+    bound = precision / 2 if max_error is None else max_error
+    # 浮点舍入会使误差略大于precision / 2，留出相对误差余量
+    if np.abs(dequantize(q, origin, precision) - xyz).max() > bound * (1 + 1e-6) + 1e-9:
+        return None
+    return origin, q
+
+
+def dequantize(q, origin, precision) -> np.ndarray:
+    """
+    还原量化坐标
+    :return: (n, 3) float64坐标
+    """
+    return q * np.float64(precision) + np.asarray(origin, dtype=np.float64)
+
+
+def has_pack(directory) -> bool:
+    """
+    判断目录中是否存在区域打包文件
+    """
+    return os.path.isfile(pack_path(directory))
+
+
+def write_pack(directory, regions: dict, precision=None, max_error=None) -> str:
+    """
+    将区域点云写入目录中的打包文件，先写临时文件再替换，读取方不会看到写了一半的文件
+    :param directory: 保存目录
+    :param regions: {区域索引: DataFrame(X, Y, Z[, R, G, B])}，值为None的区域跳过
+    :param precision: 坐标量化精度，None时按[Storage]配置决定是否量化，0表示不量化
+    :param max_error: 量化允许的最大误差，None时使用配置
+    :return: 打包文件路径
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = pack_path(directory)
+    _write_atomic(path, encode_pack(regions, precision, max_error))
+    return path
+
+
+def _write_atomic(path, data: bytes) -> None:
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def encode_pack(regions: dict, precision=None, max_error=None, grid=None) -> bytes:
+    """
+    将区域点云编码为打包文件内容，参数与write_pack相同
+    :param grid: 投影面网格 (min_x, max_x, min_y, max_y, grid_size)，提供且[Storage] morton开启时使用Morton布局
+    """
+    conf = storage_config()
+    if precision is None:
+        precision = conf['precision'] if conf['quantize'] else 0
+        max_error = conf['max_error'] if max_error is None else max_error
+    items = sorted((int(k), v) for k, v in regions.items() if v is not None)
+    rgb = all(all(c in df.columns for c in ['R', 'G', 'B']) for _, df in items)
+    morton = grid is not None and conf['morton']
+    flags = (FLAG_RGB if rgb else 0) | (FLAG_QUANT if precision else 0) | (FLAG_MORTON if morton else 0)
+    head_size = HEADER.size
+    if morton:
+        head_size += GRID.size
+        num_x, num_y = grid_shape(*grid[:4], grid[4])
+        keys = cell_morton([k for k, _ in items], num_x, num_y)
+        items = [items[i] for i in np.argsort(keys, kind='stable')]
+
+    index, blocks = [], []
+    offset = _align(head_size + ENTRY.size * len(items))
+    for k, df in items:
+        xyz = df[['X', 'Y', 'Z']].values
+        if morton:
+            df = df.iloc[point_order(xyz[:, :2], grid[4])]
+            xyz = df[['X', 'Y', 'Z']].values
+        if precision:
+            res = quantize(xyz, precision, max_error)
+            if res is None:
+                # 超出量化范围或误差，该区域保留float32
+                block = [QBLOCK.pack(0, 0, 0, 0), np.ascontiguousarray(xyz, dtype='<f4').tobytes()]
+            else:
+                origin, q = res
+                block = [QBLOCK.pack(*origin.tolist(), precision), q.tobytes()]
+        else:
+            block = [np.ascontiguousarray(xyz, dtype='<f4').tobytes()]
+        if rgb:
+            block.append(np.ascontiguousarray(df[['R', 'G', 'B']].values, dtype=np.uint8).tobytes())
+        size = sum(len(b) for b in block)
+        block.append(b'\0' * (_align(size) - size))
+        index.append(ENTRY.pack(k, len(df), offset))
+        blocks.extend(block)
+        offset += _align(size)
+
+    version = VERSION_MORTON if morton else VERSION_QUANT if flags & FLAG_QUANT else VERSION
+    head = HEADER.pack(MAGIC, version, flags, 0, len(items))
+    if morton:
+        head += GRID.pack(*[float(v) for v in grid])
+    head += b''.join(index)
+    return b''.join([head, b'\0' * (_align(len(head)) - len(head))] + blocks)
+
+
+class RegionPack(object):
+    """
+    区域打包文件读取类
+    """
+
+    def __init__(self, path, fileobj=None):
+        """
+        :param path: 打包文件路径
+        :param fileobj: 已经打开的二进制文件对象（如内存中的io.BytesIO），为None时打开path
+        """
+        self.path = path
+        self._file = open(path, 'rb') if fileobj is None else fileobj
+        magic, version, flags, _, n = HEADER.unpack(self._file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"not a region pack: {path}")
+        if version not in (VERSION, VERSION_QUANT, VERSION_MORTON):
+            raise ValueError(f"unsupported region pack version: {version}")
+        self.flags = flags
+        self.grid = GRID.unpack(self._file.read(GRID.size)) if flags & FLAG_MORTON else None
+        raw = self._file.read(ENTRY.size * n)
+        self._index = {}  # 区域索引 -> (点数, 偏移)
+        for i in range(n):
+            k, count, offset = ENTRY.unpack_from(raw, i * ENTRY.size)
+            self._index[k] = (count, offset)
+        self._spans = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def keys(self) -> list:
+        return list(self._index.keys())
+
+    def __contains__(self, region) -> bool:
+        return int(region) in self._index
+
+    def spans(self) -> dict:
+        """
+        每个区域数据块在文件中的字节范围，数据块首尾相接，结束位置为下一个数据块的偏移
+        :return: {区域索引: (起始偏移, 结束偏移)}
+        """
+        if self._spans is None:
+            items = sorted(self._index.items(), key=lambda e: e[1][1])
+            self._file.seek(0, os.SEEK_END)
+            ends = [offset for _, (_, offset) in items[1:]] + [self._file.tell()]
+            self._spans = {k: (offset, end) for (k, (_, offset)), end in zip(items, ends)}
+        return self._spans
+
+    def _block_arrays(self, buf, pos, count):
+        """
+        解析缓冲区中pos处的一个数据块，量化编码的坐标在这里还原
+        """
+        rgb_size = count * 3 if self.flags & FLAG_RGB else 0
+        origin, precision = None, 0
+        if self.flags & FLAG_QUANT:
+            x, y, z, precision = QBLOCK.unpack_from(buf, pos)
+            origin = (x, y, z)
+            pos += QBLOCK.size
+        xyz_size = count * 6 if precision else count * 12
+        if precision:
+            q = np.frombuffer(buf, dtype='<u2', count=count * 3, offset=pos).reshape(count, 3)
+            xyz = dequantize(q, origin, precision)
+        else:
+            xyz = np.frombuffer(buf, dtype='<f4', count=count * 3, offset=pos).reshape(count, 3)
+        rgb = np.frombuffer(buf, dtype=np.uint8, count=rgb_size, offset=pos + xyz_size).reshape(count, 3) \
+            if rgb_size else None
+        return xyz, rgb
+
+    def read_arrays(self, region):
+        """
+        读取单个区域
+        :return: (xyz (n, 3) float32或float64, rgb (n, 3) uint8或None)，区域不存在时返回None
+        """
+        entry = self._index.get(int(region))
+        if entry is None:
+            return None
+        start, end = self.spans()[int(region)]
+        self._file.seek(start)
+        return self._block_arrays(self._file.read(end - start), 0, entry[0])
+
+    @staticmethod
+    def _frame(arrays, bbox=None):
+        xyz, rgb = arrays
+        if bbox is not None:
+            inside = bbox_mask(xyz, bbox)
+            xyz, rgb = xyz[inside], rgb[inside] if rgb is not None else None
+        data = {'X': xyz[:, 0].astype(np.float64), 'Y': xyz[:, 1].astype(np.float64),
+                'Z': xyz[:, 2].astype(np.float64)}
+        if rgb is not None:
+            data.update({'R': rgb[:, 0].astype(np.int64), 'G': rgb[:, 1].astype(np.int64),
+                         'B': rgb[:, 2].astype(np.int64)})
+        return pd.DataFrame(data)
+
+    def read_df(self, region):
+        """
+        读取单个区域，列与旧版区域CSV文件相同
+        :return: DataFrame，区域不存在时返回None
+        """
+        arrays = self.read_arrays(region)
+        if arrays is None:
+            return None
+        return self._frame(arrays)
+
+    def read(self, regions=None, bbox=None) -> dict:
+        """
+        按文件中的顺序读取多个区域，偏移相邻的数据块合并为一次读取
+        :param regions: 区域索引列表，默认全部区域
+        :param bbox: (x0, y0, x1, y1) 只返回包围盒内的点；Morton布局的文件只读取与包围盒相交的区域
+        :return: {区域索引: DataFrame}
+        """
+        if regions is None:
+            regions = self.keys()
+        keys = {int(k) for k in regions if int(k) in self._index}
+        if bbox is not None and self.grid is not None:
+            keys &= set(bbox_cells(bbox, *self.grid).tolist())
+        spans = self.spans()
+        order = sorted(keys, key=lambda k: spans[k][0])
+        res, i = {}, 0
+        while i < len(order):
+            j = i
+            while j + 1 < len(order) and spans[order[j + 1]][0] == spans[order[j]][1]:
+                j += 1
+            start, end = spans[order[i]][0], spans[order[j]][1]
+            self._file.seek(start)
+            buf = self._file.read(end - start)
+            for k in order[i:j + 1]:
+                res[k] = self._frame(self._block_arrays(buf, spans[k][0] - start, self._index[k][0]), bbox)
+            i = j + 1
+        return res
+
+
+def bbox_mask(xyz, bbox) -> np.ndarray:
+    """
+    落在包围盒 (x0, y0, x1, y1) 内的点
+    """
+    x0, y0, x1, y1 = bbox
+    xyz = np.asarray(xyz)
+    return (xyz[:, 0] >= min(x0, x1)) & (xyz[:, 0] <= max(x0, x1)) & \
+        (xyz[:, 1] >= min(y0, y1)) & (xyz[:, 1] <= max(y0, y1))
+
+
+def clip_bbox(df, bbox):
+    """
+    只保留DataFrame中落在包围盒内的点，bbox为None时原样返回
+    """
+    if bbox is None or df is None:
+        return df
+    return df[bbox_mask(df[['X', 'Y']].values, bbox)].reset_index(drop=True)
+
+
+def list_regions(directory) -> dict:
+    """
+    列出目录中的区域数据，兼容旧版的每个区域一个CSV文件
+    :param directory: 扫描数据目录，init目录下的基准目录会解析为当前版本，已归档的扫描从归档文件读取
+    :return: {区域索引: PackRef或CSV文件路径}
+    """
+    directory = resolve_baseline(directory)
+    if not os.path.isdir(directory):
+        # 已经压缩归档的扫描
+        from utils.util_archive import ArchivedScan, split_member
+        if split_member(directory) is not None:
+            with ArchivedScan(directory) as scan:
+                return {k: PackRef(scan.path, k) for k in scan.keys()}
+    if has_pack(directory) or has_delta(directory) or has_refs(directory):
+        res = {}
+        # 增量文件、打包文件和引用文件中的区域互不重复
+        for path in (delta_path(directory), pack_path(directory)):
+            if os.path.isfile(path):
+                with open_pack(path) as pack:
+                    res.update({k: PackRef(pack.path, k) for k in pack.keys()})
+        if has_refs(directory):
+            objects = RegionStore.locate(directory)
+            for k, digest in read_refs(directory).items():
+                res[k] = PackRef(RegionStore.object_path(objects, digest), k)
+        return res
+    res = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith('.csv'):
+                name = entry.name.split('.')[0]
+                res[int(name) if name.isdigit() else name] = entry.path
+    return res
+
+
+def load_regions(refs: dict, usecols=None, bbox=None) -> dict:
+    """
+    读取list_regions返回的区域数据，同一个打包文件中的区域只打开一次文件
+    :param refs: {任意键: PackRef或CSV文件路径}
+    :param usecols: 读取CSV文件时加载的列
+    :param bbox: (x0, y0, x1, y1) 只返回投影面上包围盒内的点，Morton布局的打包文件只读取相交区域的数据块
+    :return: {键: DataFrame}，键与refs相同；指定bbox时不含与包围盒不相交的区域
+    """
+    res, packs = {}, {}
+    for key, ref in refs.items():
+        ref = PackRef.parse(ref)
+        if isinstance(ref, PackRef):
+            packs.setdefault(ref.path, []).append((key, ref.region))
+        else:
+            res[key] = clip_bbox(pd.read_csv(ref, usecols=usecols), bbox)
+    for path, items in packs.items():
+        with open_pack(path) as pack:
+            frames = pack.read([region for _, region in items], bbox)
+        for key, region in items:
+            df = frames.get(int(region))
+            if df is None:  # 与包围盒不相交或基准中没有的区域
+                continue
+            res[key] = df if usecols is None else df[[c for c in usecols if c in df.columns]]
+    return {key: res[key] for key in refs.keys() if key in res}
+
+
+def delta_path(directory) -> str:
+    return os.path.join(directory, DELTA_NAME)
+
+
+def has_delta(directory) -> bool:
+    """
+    判断目录中是否存在增量文件
+    """
+    return os.path.isfile(delta_path(directory))
+
+
+def open_pack(path):
+    """
+    根据文件名打开打包文件、增量文件或归档中的扫描
+    :return: RegionPack、DeltaPack或ArchivedScan
+    """
+    name = os.path.basename(path)
+    if name == DELTA_NAME:
+        return DeltaPack(path)
+    if name.endswith('.pack'):
+        return RegionPack(path)
+    from utils.util_archive import ArchivedScan
+    return ArchivedScan(path)
+
+
+def _bin_index(xy, lo, hi, bins):
+    """
+    计算XY坐标在包围盒[lo, hi]划分的bins * bins小格中的编号
+    :return: (小格编号, 是否落在包围盒内)
+    """
+    span = np.where(hi > lo, hi - lo, 1.0)
+    b = np.floor((xy - lo) / span * bins).astype(np.int64)
+    b[xy == hi] = bins - 1  # 包围盒上边界归入最后一格
+    inside = np.all((b >= 0) & (b < bins), axis=1)
+    b = np.clip(b, 0, bins - 1)
+    return b[:, 0] + b[:, 1] * bins, inside
+
+
+def encode_residual(base_xyz, xyz, bins, precision, max_miss=0.1, max_error=0.001):
+    """
+    计算本次扫描相对基准的高度残差
+    :param base_xyz: (m, 3) 基准区域坐标
+    :param xyz: (n, 3) 本次扫描区域坐标
+    :param bins: 每个方向的小格数量
+    :param precision: 残差精度
+    :param max_miss: 变化点（不能由残差还原、需要原样保存的扫描点）所占比例上限，超出时说明区域形状变化，不能用残差表示
+    :param max_error: 每个点允许的高度误差，小格内的扫描点和基准点距小格平均高度的偏差都不能超过该值
+    :return: ((bins * bins,) int16残差, (n,) bool变化点)，不能用残差表示时返回None
+    """
+    base_xyz, xyz = np.asarray(base_xyz, dtype=np.float64), np.asarray(xyz, dtype=np.float64)
+    if len(base_xyz) == 0 or len(xyz) == 0:
+        return None
+    n = bins * bins
+    lo, hi = base_xyz[:, :2].min(axis=0), base_xyz[:, :2].max(axis=0)
+    base_bin, _ = _bin_index(base_xyz[:, :2], lo, hi, bins)
+    scan_bin, inside = _bin_index(xyz[:, :2], lo, hi, bins)
+    base_count = np.bincount(base_bin, minlength=n)
+    covered = inside & (base_count[scan_bin] > 0)
+    base_mean = np.bincount(base_bin, weights=base_xyz[:, 2], minlength=n) / np.maximum(base_count, 1)
+    scan_count = np.bincount(scan_bin[covered], minlength=n)
+    scan_mean = np.bincount(scan_bin[covered], weights=xyz[covered, 2], minlength=n) / np.maximum(scan_count, 1)
+    q = np.rint(np.where(scan_count > 0, scan_mean - base_mean, 0.0) / precision)
+    if np.abs(q).max() > RMAX:
+        return None
+    # 基准点偏离小格平均高度的小格不能整体平移，与本次扫描没有点的小格一起丢弃基准点
+    spread = np.zeros(n, dtype=bool)
+    spread[base_bin[np.abs(base_xyz[:, 2] - base_mean[base_bin]) > max_error]] = True
+    drop = spread | (scan_count == 0)
+    level = base_mean + q * precision
+    changed = ~covered | drop[scan_bin] | (np.abs(xyz[:, 2] - level[scan_bin]) > max_error)
+    if changed.mean() > max_miss:
+        return None
+    q[drop] = DELTA_DROP
+    return q.astype('<i2'), changed
+
+
+def decode_residual(base_xyz, residual, bins, precision) -> np.ndarray:
+    """
+    基准区域坐标加上高度残差，残差为DELTA_DROP的小格中的点被丢弃
+    :return: (k, 3) float64坐标
+    """
+    xyz = np.array(base_xyz, dtype=np.float64)
+    if len(xyz) == 0:
+        return xyz
+    lo, hi = xyz[:, :2].min(axis=0), xyz[:, :2].max(axis=0)
+    base_bin, _ = _bin_index(xyz[:, :2], lo, hi, bins)
+    residual = np.asarray(residual)[base_bin]
+    keep = residual != DELTA_DROP
+    xyz[:, 2] += residual * np.float64(precision)
+    return xyz[keep]
+
+
+def write_delta(directory, baseline_dir, regions: dict, bins=None, precision=None, max_miss=None,
+                max_error=None) -> dict:
+    """
+    将能够用残差表示的区域写入增量文件
+    :param directory: 保存目录
+    :param baseline_dir: 基准区域数据目录（init/regions）
+    :param regions: {区域索引: DataFrame(X, Y, Z, R, G, B)}，同一区域颜色相同
+    :param bins: 每个方向的小格数量，None时使用配置
+    :param precision: 残差精度，None时使用配置
+    :param max_miss: 见encode_residual，None时使用配置
+    :param max_error: 见encode_residual，None时使用配置
+    :return: 不能用残差表示、需要完整保存的区域
+    """
+    data, rest = encode_delta(baseline_dir, regions, bins, precision, max_miss, max_error)
+    if data is not None:
+        os.makedirs(directory, exist_ok=True)
+        _write_atomic(delta_path(directory), data)
+    return rest
+
+
+def encode_delta(baseline_dir, regions: dict, bins=None, precision=None, max_miss=None, max_error=None):
+    """
+    将能够用残差表示的区域编码为增量文件内容，参数与write_delta相同
+    :return: (增量文件内容，没有可用残差表示的区域时为None, 需要完整保存的区域)
+    """
+    conf = storage_config()
+    bins = conf['delta_bins'] if bins is None else bins
+    precision = conf['delta_precision'] if precision is None else precision
+    max_miss = conf['delta_max_miss'] if max_miss is None else max_miss
+    max_error = conf['delta_max_error'] if max_error is None else max_error
+    baseline_dir = resolve_baseline(baseline_dir)
+    if not has_pack(baseline_dir):
+        return None, regions
+    # 记录版本目录中的路径，基准更新后已写入的增量仍然可以由旧版本还原
+    base = os.path.abspath(pack_path(baseline_dir))
+    rest, encoded = {}, []
+    with RegionPack(base) as pack:
+        for k, df in regions.items():
+            if df is None:
+                continue
+            arrays = pack.read_arrays(k) if k in pack else None
+            res = None
+            xyz = df[['X', 'Y', 'Z']].values
+            if arrays is not None and all(c in df.columns for c in ['R', 'G', 'B']):
+                res = encode_residual(arrays[0], xyz, bins, precision, max_miss, max_error)
+            if res is None:
+                rest[k] = df
+            else:
+                residual, changed = res
+                encoded.append((int(k), np.asarray(df[['R', 'G', 'B']].values[0], dtype=np.uint8), residual,
+                                np.ascontiguousarray(xyz[changed], dtype='<f4')))
+    if not encoded:
+        return None, rest
+
+    encoded.sort(key=lambda e: e[0])
+    stat = os.stat(base)
+    path_bytes = base.encode('utf-8')
+    head = DELTA_HEADER.pack(DELTA_MAGIC, DELTA_VERSION, bins, 0, len(encoded), precision, stat.st_size,
+                             stat.st_mtime_ns, len(path_bytes)) + path_bytes
+    head += b'\0' * (_align(len(head), 8) - len(head))
+    blocks, entries = [], []
+    offset = len(head) + DELTA_ENTRY.size * len(encoded)
+    for k, rgb, residual, changed in encoded:
+        block = rgb.tobytes() + b'\0' + residual.tobytes()
+        block += b'\0' * (_align(len(block)) - len(block)) + changed.tobytes()
+        entries.append(DELTA_ENTRY.pack(k, len(changed), offset))
+        blocks.append(block)
+        offset += len(block)
+    return b''.join([head] + entries + blocks), rest
+
+
+def delta_baseline(path) -> str:
+    """
+    读取增量文件头部记录的基准打包文件路径
+    """
+    with open(path, 'rb') as f:
+        magic, _, _, _, _, _, _, _, path_len = DELTA_HEADER.unpack(f.read(DELTA_HEADER.size))
+        if magic != DELTA_MAGIC:
+            raise ValueError(f"not a region delta: {path}")
+        return f.read(path_len).decode('utf-8')
+
+
+class DeltaPack(object):
+    """
+    增量文件读取类，接口与RegionPack相同，读取时由基准区域还原
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            raw = f.read()
+        magic, version, bins, _, n, precision, base_size, base_mtime, path_len = DELTA_HEADER.unpack_from(raw)
+        if magic != DELTA_MAGIC:
+            raise ValueError(f"not a region delta: {path}")
+        if version != DELTA_VERSION:
+            raise ValueError(f"unsupported region delta version: {version}")
+        self.bins, self.precision = bins, precision
+        offset = DELTA_HEADER.size
+        self.baseline = raw[offset:offset + path_len].decode('utf-8')
+        self._fingerprint = (base_size, base_mtime)
+        offset = _align(offset + path_len, 8)
+        entries = (DELTA_ENTRY.unpack_from(raw, offset + i * DELTA_ENTRY.size) for i in range(n))
+        self._index = {k: (changed, block) for k, changed, block in entries}
+        self._raw = raw
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        self._raw = None
+
+    def keys(self) -> list:
+        return list(self._index.keys())
+
+    def __contains__(self, region) -> bool:
+        return int(region) in self._index
+
+    def baseline_valid(self) -> bool:
+        """
+        基准文件是否仍是写入增量时的版本
+        """
+        try:
+            stat = os.stat(self.baseline)
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == self._fingerprint
+
+    def read(self, regions=None, bbox=None) -> dict:
+        """
+        读取并还原多个区域，基准已被替换时抛出ValueError
+        :param regions: 区域索引列表，默认全部区域
+        :param bbox: 见RegionPack.read
+        :return: {区域索引: DataFrame}
+        """
+        if regions is None:
+            regions = self.keys()
+        keys = sorted(int(k) for k in regions if int(k) in self._index)
+        if not keys:
+            return {}
+        if not self.baseline_valid():
+            raise ValueError(f"baseline {self.baseline} changed, can not restore {self.path}")
+        res = {}
+        n = self.bins * self.bins
+        with RegionPack(self.baseline) as pack:
+            if bbox is not None and pack.grid is not None:
+                cells = set(bbox_cells(bbox, *pack.grid).tolist())
+                keys = [k for k in keys if k in cells]
+            for k in keys:
+                arrays = pack.read_arrays(k)
+                if arrays is None:
+                    continue
+                changed, offset = self._index[k]
+                rgb = np.frombuffer(self._raw, dtype=np.uint8, count=3, offset=offset)
+                residual = np.frombuffer(self._raw, dtype='<i2', count=n, offset=offset + 4)
+                points = np.frombuffer(self._raw, dtype='<f4', count=changed * 3,
+                                       offset=offset + _align(4 + n * 2)).reshape(-1, 3)
+                xyz = np.concatenate([decode_residual(arrays[0], residual, self.bins, self.precision), points])
+                res[k] = clip_bbox(pd.DataFrame({'X': xyz[:, 0], 'Y': xyz[:, 1], 'Z': xyz[:, 2],
+                                                 'R': np.full(len(xyz), rgb[0], dtype=np.int64),
+                                                 'G': np.full(len(xyz), rgb[1], dtype=np.int64),
+                                                 'B': np.full(len(xyz), rgb[2], dtype=np.int64)}), bbox)
+        return res
+
+
+def refs_path(directory) -> str:
+    return os.path.join(directory, REFS_NAME)
+
+
+def has_refs(directory) -> bool:
+    """
+    判断目录中是否存在去重引用文件
+    """
+    return os.path.isfile(refs_path(directory))
+
+
+def read_refs(directory) -> dict:
+    """
+    读取扫描目录中的区域引用
+    :return: {区域索引: 十六进制digest}
+    """
+    with open(refs_path(directory), 'rb') as f:
+        return decode_refs(f.read(), directory)
+
+
+def decode_refs(raw: bytes, name='') -> dict:
+    """
+    解析引用文件内容
+    :return: {区域索引: 十六进制digest}
+    """
+    magic, version, _, _, n = REFS_HEADER.unpack_from(raw)
+    if magic != REFS_MAGIC:
+        raise ValueError(f"not a region refs file: {name}")
+    if version != REFS_VERSION:
+        raise ValueError(f"unsupported region refs version: {version}")
+    res = {}
+    for i in range(n):
+        k, digest = REF_ENTRY.unpack_from(raw, REFS_HEADER.size + i * REF_ENTRY.size)
+        res[k] = digest.hex()
+    return res
+
+
+def content_hash(df, precision=0.001) -> str:
+    """
+    区域内容哈希：坐标按精度量化后连同颜色计算，噪声小于精度的两次扫描得到相同的哈希
+    :param df: DataFrame(X, Y, Z[, R, G, B])
+    :param precision: 量化精度
+    :return: 十六进制digest
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.ascontiguousarray(np.rint(df[['X', 'Y', 'Z']].values / precision), dtype='<i8').tobytes())
+    if all(c in df.columns for c in ['R', 'G', 'B']):
+        h.update(np.ascontiguousarray(df[['R', 'G', 'B']].values, dtype=np.uint8).tobytes())
+    return h.hexdigest()
+
+
+class RegionStore(object):
+    """
+    设备级的区域内容寻址存储，相同内容的区域只保存一份，由引用计数决定何时删除
+    同一设备的消息由同一个工作进程处理，sqlite保证计数在多个进程之间（例如保留策略清理）一致
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: 存储目录，一般为 <设备>/data/objects
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # 自动提交模式，事务由_immediate显式开始
+        self._con = sqlite3.connect(os.path.join(directory, 'objects.db'), timeout=30, isolation_level=None)
+        self._con.execute("CREATE TABLE IF NOT EXISTS objects "
+                          "(digest TEXT PRIMARY KEY, refs INTEGER NOT NULL, size INTEGER NOT NULL)")
+        # 已经释放但引用文件还没有删除的扫描，release_scan中断后重试时不再重复释放
+        self._con.execute("CREATE TABLE IF NOT EXISTS released (path TEXT PRIMARY KEY)")
+        self.freed = 0  # 本实例删除的对象字节数
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        self._con.close()
+
+    @staticmethod
+    def locate(scan_directory) -> str:
+        """
+        由扫描目录 <设备>/data/history/年/月/日/时/分/秒 找到存储目录 <设备>/data/objects
+        """
+        path = os.path.abspath(scan_directory)
+        while True:
+            parent = os.path.dirname(path)
+            if os.path.basename(path) == 'history' or parent == path:
+                return os.path.join(parent, OBJECTS_NAME)
+            path = parent
+
+    @staticmethod
+    def object_path(directory, digest) -> str:
+        return os.path.join(directory, digest[:2], f"{digest}.pack")
+
+    def refs(self, digest) -> int:
+        row = self._con.execute("SELECT refs FROM objects WHERE digest = ?", (digest,)).fetchone()
+        return row[0] if row else 0
+
+    @contextlib.contextmanager
+    def _immediate(self):
+        """
+        写事务：开始时即取得数据库写锁，计数的修改和对象文件的写入、删除在锁内完成
+        """
+        self._con.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._con.execute("ROLLBACK")
+            raise
+        self._con.execute("COMMIT")
+
+    def put(self, region, df, precision=None) -> str:
+        """
+        保存一个区域并增加引用计数，内容已存在时只增加计数
+        :param region: 区域索引
+        :param df: 区域数据
+        :param precision: 计算哈希的量化精度，None时使用[Storage] precision
+        :return: 十六进制digest
+        """
+        digest = content_hash(df, storage_config()['precision'] if precision is None else precision)
+        path = RegionStore.object_path(self.directory, digest)
+        with self._immediate():
+            # 先增加计数再检查文件：其他进程的release在同一把锁内删除对象，不会删掉这里刚确认存在的文件
+            self._con.execute("INSERT INTO objects (digest, refs, size) VALUES (?, 1, 0) "
+                              "ON CONFLICT(digest) DO UPDATE SET refs = refs + 1", (digest,))
+            if not os.path.isfile(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                _write_atomic(path, encode_pack({region: df}))
+            self._con.execute("UPDATE objects SET size = ? WHERE digest = ?", (os.path.getsize(path), digest))
+        return digest
+
+    def _release(self, digest) -> int:
+        """
+        减少引用计数，计数归零时删除对象，在_immediate事务中调用
+        :return: 剩余引用计数
+        """
+        self._con.execute("UPDATE objects SET refs = refs - 1 WHERE digest = ?", (digest,))
+        row = self._con.execute("SELECT refs, size FROM objects WHERE digest = ?", (digest,)).fetchone()
+        refs = row[0] if row else 0
+        if refs <= 0:
+            self._con.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+            try:
+                os.remove(RegionStore.object_path(self.directory, digest))
+                self.freed += row[1] if row else 0
+            except FileNotFoundError:
+                pass
+        return max(refs, 0)
+
+    def release(self, digest) -> int:
+        """
+        减少引用计数，计数归零时删除对象
+        :return: 剩余引用计数
+        """
+        with self._immediate():
+            return self._release(digest)
+
+    def release_all(self, digests) -> None:
+        """
+        在一个事务中释放多个引用
+        """
+        with self._immediate():
+            for digest in digests:
+                self._release(digest)
+
+    def write_refs(self, scan_directory, regions: dict) -> str:
+        """
+        将区域保存到存储中，并在扫描目录中写入引用文件，替换已有引用文件时释放其中的引用
+        :param scan_directory: 扫描目录
+        :param regions: {区域索引: DataFrame}，值为None的区域跳过
+        :return: 引用文件路径
+        """
+        replaced = read_refs(scan_directory) if has_refs(scan_directory) else {}
+        data = self.encode_refs(regions)
+        os.makedirs(scan_directory, exist_ok=True)
+        path = refs_path(scan_directory)
+        try:
+            _write_atomic(path, data)
+        except Exception:
+            self.release_all(decode_refs(data, scan_directory).values())
+            raise
+        self.release_all(replaced.values())
+        return path
+
+    def encode_refs(self, regions: dict) -> bytes:
+        """
+        将区域保存到存储中，返回引用文件内容
+        引用文件写入失败时由调用者释放其中的引用，替换旧引用文件后释放旧文件中的引用
+        """
+        entries = []
+        for k, df in sorted((int(k), v) for k, v in regions.items() if v is not None):
+            entries.append(REF_ENTRY.pack(k, bytes.fromhex(self.put(k, df))))
+        return REFS_HEADER.pack(REFS_MAGIC, REFS_VERSION, 0, 0, len(entries)) + b''.join(entries)
+
+    def release_scan(self, scan_directory) -> int:
+        """
+        释放扫描目录引用的所有区域并删除引用文件，删除扫描目录之前调用
+        引用文件先改名占有再释放：并发调用只有改名成功的一方释放；改名后中断时重试释放占有的文件，
+        释放的事务中记录该文件，删除文件之前中断时重试不会再次释放
+        :return: 释放的引用数量
+        """
+        claimed = refs_path(scan_directory) + REFS_CLAIMED
+        key = os.path.abspath(claimed)
+        try:
+            os.rename(refs_path(scan_directory), claimed)
+        except FileNotFoundError:
+            if not os.path.isfile(claimed):
+                self._con.execute("DELETE FROM released WHERE path = ?", (key,))
+                return 0
+        try:
+            with open(claimed, 'rb') as f:
+                refs = decode_refs(f.read(), scan_directory)
+        except FileNotFoundError:  # 另一个调用已经释放完成
+            return 0
+        with self._immediate():
+            done = self._con.execute("SELECT 1 FROM released WHERE path = ?", (key,)).fetchone()
+            if not done:
+                self._con.execute("INSERT INTO released (path) VALUES (?)", (key,))
+                for digest in refs.values():
+                    self._release(digest)
+        try:
+            os.remove(claimed)
+        except FileNotFoundError:
+            pass
+        self._con.execute("DELETE FROM released WHERE path = ?", (key,))
+        return 0 if done else len(refs)
+
+
+def pending_release(directory) -> bool:
+    """
+    判断扫描目录是否有需要release_scan释放的引用，包括上一次释放中断后留下的占有文件
+    """
+    return has_refs(directory) or os.path.isfile(refs_path(directory) + REFS_CLAIMED)
@@ -10,18 +10,28 @@
 import ast
 import configparser
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import os
 
+import numpy as np
 import pandas as pd
 from deprecated import deprecated
 from open3d.cpu.pybind.geometry import PointCloud
 import open3d as o3d
 from pandas import DataFrame
 
-from rmq.construct import PointCloudData, Tunnel
+from rmq.construct import PointCloudData, Region, Tunnel
 from utils.util_database import DBUtils
+from utils.util_pack import encode_pack, encode_delta, list_regions, load_regions, storage_config, RegionStore, \
+    decode_refs, read_refs, COLUMNS, BASELINE_NAME, OBJECTS_NAME, PACK_NAME, DELTA_NAME, REFS_NAME
+from utils.util_anomaly_log import append_ini, latest_records, max_log
+from utils.util_cache import load_baseline
+from utils.util_catalog import KIND_HISTORY, KIND_LOG, KIND_RAW, degree_level, open_catalog, record
+from utils.util_lod import LOD_MANIFEST, decimate, encode_lods, lod_config, lod_regions
+from utils.util_response import FORMAT_JSON, arrays_to_lists, encode_response, frames_to_arrays
+from utils.util_writer import get_writer, write_files
 
 
 def df2pcd(data: DataFrame) -> PointCloud:
@@ -82,6 +92,7 @@ def write_log(now, log_path, time_list):
         }
         with open(os.path.join(save_path, f"{i}.ini"), 'w') as configfile:
             config.write(configfile)
+        record(KIND_LOG, os.path.join(save_path, f"{i}.ini"), datetime.strptime(data, '%Y-%m-%d %H:%M:%S.%f'))
 
 
 def number2str(number_list):
@@ -132,6 +143,9 @@ def write_anomaly_log(now, log_path, time_list, anomaly_list):
         }
         with open(os.path.join(save_path, f"{i}.ini"), 'w') as configfile:
             config.write(configfile)
+        record(KIND_LOG, os.path.join(save_path, f"{i}.ini"), datetime.strptime(data[0], '%Y-%m-%d %H:%M:%S.%f'),
+               list(data[1].keys()), max([degree_level(d) for d in degree] or [0]))
+        append_ini(os.path.join(save_path, f"{i}.ini"))
 
 
 def get_region_dict(path):
@@ -178,14 +192,12 @@ def get_log_bas_dict(path):
     if not os.path.exists(path):
         return None
     log_folder = find_latest_ini_folder(path)
-    latest_log_path = str(find_max_log(log_folder))
-    if latest_log_path is None:
+    latest = max_log(log_folder) if log_folder is not None else None
+    if latest is None:
         return None
-    else:
-        log_dict = get_log_data(latest_log_path)
-        if log_dict is None:
-            return None
-    return log_dict
+    # 异常日志索引中的记录与get_log_data解析.ini文件的结果相同
+    _, record = latest
+    return dict(zip(record['region index'], record['bas']))
 
 
 def df_mean(data: DataFrame):
@@ -208,7 +220,7 @@ def compare_log(region_index, root_log, comparison_log):
     return False
 
 
-def compare_region(root, comparison, root_log, comparison_log):
+def compare_region(root, comparison, root_log, comparison_log, bbox=None):
     """
     1.先找到comparison中不同于root的区域索引
     2.在找到相同的索引检索日志
@@ -216,25 +228,27 @@ def compare_region(root, comparison, root_log, comparison_log):
     :param comparison:
     :param root_log:
     :param comparison_log:
+    :param bbox: (x0, y0, x1, y1) 只读取投影面上包围盒内的点
     :return:
     """
     # 读取root数据，并将颜色设置为默认的绿色
     res_list = {}
-    for i, v in root.items():
-        data = color_df(pd.read_csv(v, usecols=['X', 'Y', 'Z', 'R', 'G', 'B']), [118, 238, 198])
-        res_list[i] = data
+    for i, data in load_regions(root, usecols=COLUMNS, bbox=bbox).items():
+        res_list[i] = color_df(data, [118, 238, 198])
     # 对比两个数据，找到root中没有的区域替换res_list对应的数据，找到相同的数据查阅日志进行比对差距大的进行替换
     root_keys, comparison_keys = root.keys(), comparison.keys()
     compare_message = []  # TODO：用于存储对比信息
+    replace = {}  # 需要替换的区域，最后一次读取
     for k in comparison_keys:
         if k not in root_keys:
-            res_list[k] = pd.read_csv(comparison.get(k), usecols=['X', 'Y', 'Z', 'R', 'G', 'B'])
+            replace[k] = comparison.get(k)
         elif k in root_keys:
             root_dict, compare_dict = get_log_bas_dict(root_log), get_log_bas_dict(comparison_log)
             if root_dict is None or compare_dict is None:
                 return None
             if compare_log(k, root_dict, compare_dict):
-                res_list[k] = pd.read_csv(comparison.get(k), usecols=['X', 'Y', 'Z', 'R', 'G', 'B'])
+                replace[k] = comparison.get(k)
+    res_list.update(load_regions(replace, usecols=COLUMNS, bbox=bbox))
     return res_list
 
 
@@ -271,7 +285,8 @@ def merge_df_dict(init_dict, compare_res_dict):
     return coordinate_list, color_list
 
 
-def compare_data(init_region, root, comparison, root_log, comparison_log):
+def compare_data(init_region, root, comparison, root_log, comparison_log, bbox=None, budget=None, fmt=FORMAT_JSON,
+                 voxel=None):
     """
     http://127.0.0.1:8024/outer/service/compare
     对比接口
@@ -279,11 +294,15 @@ def compare_data(init_region, root, comparison, root_log, comparison_log):
         2.找出第二个时间点中不同的异常区域
         3.将两者之间相同的异常区域通过日志信息进行比对
         4.用后者不同于前者或者差距较大的数据替换前者中的数据
+    :param bbox: (x0, y0, x1, y1) 只返回投影面上包围盒内的点
+    :param budget: 点数预算，生成了多级细节时基准读取不超过预算的级别，合并后仍超过预算时降采样
+    :param fmt: 响应格式，见util_response
+    :param voxel: 降采样的体素大小，单位米，优先于budget
     :return:
     """
     # 拿到两个数据的区域字典
-    init_dict, root_dict, comparison_dict = get_root_data(init_region), get_region_dict(root), get_region_dict(
-        comparison)
+    init_dict, root_dict, comparison_dict = get_root_data(init_region, bbox, budget), get_region_dict(root), \
+        get_region_dict(comparison)
     if root_dict is None:
         return {'msg': 'root数据不存在'}
     if comparison_dict is None:
@@ -291,11 +310,10 @@ def compare_data(init_region, root, comparison, root_log, comparison_log):
     if init_dict is None:
         return {'msg': '初始化数据不存在'}
     # 比较两个数据
-    compare_res_dict = compare_region(root_dict, comparison_dict, root_log, comparison_log)
+    compare_res_dict = compare_region(root_dict, comparison_dict, root_log, comparison_log, bbox)
     if compare_res_dict is None:
         return {'msg': 'root或者comparison数据不存在'}
-    coordinate_list, color_list = merge_data(init_dict, compare_res_dict, True)
-    return {'xyz': str(coordinate_list), 'rgb': str(color_list)}
+    return encode_response(*merge_arrays(init_dict, compare_res_dict, True, budget=budget, voxel=voxel), fmt)
 
 
 def data_visual(path, init_path):
@@ -305,19 +323,13 @@ def data_visual(path, init_path):
     :param init_path:
     :return:
     """
-    init = {}
-    with os.scandir(init_path) as entries:
-        for entry in entries:
-            init[entry.name[:-4]] = pd.read_csv(entry.path)
+    init = {str(k): v for k, v in load_baseline(init_path).items()}
     # 寻找最新的文件夹
     latest_path = find_latest_folder(path)
     if latest_path is None:
         return None
-    # 将其保存为字典形式 anomaly 文件名：dataframe
-    anomaly = {}
-    with os.scandir(str(latest_path)) as entries:
-        for entry in entries:
-            anomaly[entry.name[:-4]] = pd.read_csv(entry.path)
+    # 将其保存为字典形式 anomaly 区域索引：dataframe
+    anomaly = {str(k): v for k, v in load_regions(list_regions(str(latest_path))).items()}
 
     # 遍历root的键，将其dataframe的rgb设置为绿色，找到与anomaly键相同的键，将其dataframe的rgb设置为红色
     k_a_list, k_r_list = list(anomaly.keys()), list(init.keys())
@@ -379,6 +391,10 @@ def find_log_path(path):
     :param path:
     :return:
     """
+    catalog = open_catalog(path)
+    if catalog is not None:
+        with catalog:
+            return catalog.parents(KIND_LOG, path)
     log_path_list = []
     if not os.path.exists(path):
         print("not found path")
@@ -396,28 +412,20 @@ def process_log(log_path):
     :param log_path:
     :return:
     """
-    latest_log = find_max_log(log_path)
-    if latest_log is None:
-        return None
-
-    config = configparser.ConfigParser()
-    config.read(str(latest_log))
-    if not config.has_section('Anomalies'):
+    latest = max_log(log_path)
+    if latest is None:
         return None
+    _, record = latest
 
     try:
-        now = datetime.strptime(config.get('Time', 'time'), '%Y-%m-%d %H:%M:%S.%f')
-    except ValueError:
+        now = datetime.strptime(record['time'], '%Y-%m-%d %H:%M:%S.%f')
+    except (TypeError, ValueError):
         return None  # 如果时间格式不正确，跳过此日志
 
     time_str = f"{now.hour:02d}:{now.minute:02d}:{now.second:02d}"
-    index = ast.literal_eval(config.get('Anomalies', 'region index'))
-    position = ast.literal_eval(config.get('Anomalies', 'position'))
-    bas = ast.literal_eval(config.get('Anomalies', 'bas'))
-    degree = ast.literal_eval(config.get('Anomalies', 'degree'))
     tag = get_log_data_tag(log_path)
 
-    return time_str, index, position, bas, degree, tag
+    return time_str, record['region index'], record['position'], record['bas'], record['degree'], tag
 
 
 def find_log(path):
@@ -426,8 +434,9 @@ def find_log(path):
     :param path:
     :return:
     """
-    log_path_list = find_log_path(path)
-    if not log_path_list:
+    # 有索引的日期每天只顺序读取一个异常日志文件
+    records = latest_records(path)
+    if not records:
         return None
 
     time, index, position, bas, degree, tag = [], [], [], [], [], []
@@ -446,22 +455,14 @@ def find_log(path):
     #         degree.append(deg)
     #         tag.append(tg)
 
-    for log_path in log_path_list:
-        config = configparser.ConfigParser()
-        latest_log = find_max_log(log_path)
-        if latest_log is None:
-            continue
-        config.read(str(latest_log))
-        if not config.has_section('Anomalies'):
-            continue
-
-        now = datetime.strptime(config.get('Time', 'time'), '%Y-%m-%d %H:%M:%S.%f')
+    for log_path, record in records:
+        now = datetime.strptime(record['time'], '%Y-%m-%d %H:%M:%S.%f')
 
         time.append(f"{now.hour:02d}:{now.minute:02d}:{now.second:02d}")
-        index.append(ast.literal_eval(config.get('Anomalies', 'region index')))
-        position.append(ast.literal_eval(config.get('Anomalies', 'position')))
-        bas.append(ast.literal_eval(config.get('Anomalies', 'bas')))
-        degree.append(ast.literal_eval(config.get('Anomalies', 'degree')))
+        index.append(record['region index'])
+        position.append(record['position'])
+        bas.append(record['bas'])
+        degree.append(record['degree'])
         tag.append(get_log_data_tag(log_path))
 
     if not time:
@@ -519,6 +520,10 @@ def find_latest_log(path):
     :param path:
     :return:
     """
+    catalog = open_catalog(path)
+    if catalog is not None:
+        with catalog:
+            return catalog.latest(KIND_LOG, path)
     latest_file = None
     latest_mtime = None
 
@@ -564,12 +569,15 @@ def process_init_file(path, tag):
         os.remove(path) if tag else shutil.rmtree(path)
 
 
+@deprecated(reason="删除后重写期间读取方会看到缺失或不完整的基准，使用BaselineVersions.stage/publish")
 def recreate_init_file(path):
     """
     重新创建初始化目录
     :param path:
     :return:
     """
+    # 等待后台写入完成，避免还没写完的旧基准在删除之后重新出现
+    get_writer().flush()
     if os.path.exists(path):
         shutil.rmtree(path)
         os.makedirs(path)
@@ -578,7 +586,8 @@ def recreate_init_file(path):
 def write_init(path: str, init: bool, data: PointCloudData, init_name, region_name):
     """
     init.csv完整的原始数据
-    regions.csv完整的预处理后的区域数据
+    regions完整的预处理后的区域数据
+    两部分在不同线程中同时编码和写入，返回时已经落盘；path为BaselineVersions.stage创建的临时目录
     :param path:
     :param init:
     :param data:
@@ -590,18 +599,15 @@ def write_init(path: str, init: bool, data: PointCloudData, init_name, region_na
         # 获取数据
         all_data = data.get_data()
         regions_data = data.get_region().get_pcds()
-        os.makedirs(path, exist_ok=True)
         # 构建保存路径
-        init_save_path = os.path.join(path, init_name)
-        # process_init_file(init_save_path, True)
         regions_save_path = os.path.join(path, region_name)
-        # process_init_file(regions_save_path, False)
         # 写入数据
-        all_data.to_csv(init_save_path, index=False)
-        if write_df(regions_save_path, path, regions_data, init):
-            return True
-        else:
-            return False
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            all_future = pool.submit(
+                lambda: write_files(path, {init_name: all_data.to_csv(index=False).encode('utf-8')}, True))
+            regions_future = pool.submit(write_df, regions_save_path, path, regions_data, init)
+            all_future.result()
+            return regions_future.result()
     except Exception as e:
         print(f"An error occurred: {e} in write_init")
         return False
@@ -647,6 +653,34 @@ def color_df(data: DataFrame, rgb: list) -> DataFrame:
     return data
 
 
+def previous_scan_files(path) -> dict:
+    """
+    扫描目录中已有的区域数据文件，等待后台写入完成后列出
+    :return: {文件名: None}，作为写入任务的一部分时表示删除本次没有重新写入的文件
+    """
+    get_writer().wait(path)
+    if not os.path.isdir(path):
+        return {}
+    with os.scandir(path) as entries:
+        return {e.name: None for e in entries
+                if e.is_file() and (e.name in (PACK_NAME, DELTA_NAME, REFS_NAME, LOD_MANIFEST)
+                                    or e.name.startswith('regions.lod'))}
+
+
+def release_refs(objects, refs: dict) -> None:
+    """
+    释放引用文件中的区域引用，在后台写入完成的回调中调用
+    :param objects: 设备的内容寻址存储目录
+    :param refs: {区域索引: digest}
+    """
+    try:
+        if refs:
+            with RegionStore(objects) as store:
+                store.release_all(refs.values())
+    except Exception as e:
+        print(f"An error occurred: {e} in release_refs")
+
+
 def write_df(path, init_path, data, init):
     """
     将点云区域字典数据写入目标路径
@@ -657,24 +691,60 @@ def write_df(path, init_path, data, init):
     :return:
     """
     try:
-        os.makedirs(path, exist_ok=True)
         if init:  # 初始化阶段
+            colored = {}
             for k in data.keys():
                 df = data.get(k)
                 if df is not None:
-                    df = color_df(df, [118, 238, 198])
-                    df.to_csv(os.path.join(path, f"{k}.csv"), index=False)
+                    colored[k] = color_df(df, [118, 238, 198])
+            # 所有区域编码为同一个打包文件，基准发布之前必须写完，不经过后台写入
+            files = {PACK_NAME: encode_pack(colored, grid=Region.grid())}
+            if lod_config()['enabled']:
+                files.update(encode_lods(colored, grid=Region.grid()))
+            write_files(path, files, True)
             return True
         else:  # 非初始化阶段
             if data is not None:  # 如果有异常数据则将有异常的区域数据写入文件
                 regions = data.get_region()
                 describes = data.get_describe()
+                colored = {}
                 for k in regions.keys():
                     df = regions.get(k)
                     if df is not None:
                         rgb = set_color_by_degree(describes.get(k)[2])
-                        df = color_df(df, rgb)
-                        df.to_csv(os.path.join(path, f"{k}.csv"), index=False)
+                        colored[k] = color_df(df, rgb)
+                # 同一秒内的上一次扫描写入了同一目录：合并其中本次没有的区域，上一次的文件整体替换
+                files = previous_scan_files(path)
+                objects = os.path.join(os.path.dirname(init_path), OBJECTS_NAME)
+                replaced = read_refs(path) if REFS_NAME in files else {}
+                written = {}
+                if files:
+                    keys = {int(k) for k in colored.keys()}
+                    for k, df in load_regions(list_regions(path)).items():
+                        if int(k) not in keys:
+                            colored[k] = df
+                if lod_config()['enabled']:
+                    # 多级细节由全部区域生成，增量和去重模式只影响完整数据
+                    files.update(encode_lods(colored, grid=Region.grid()))
+                if storage_config()['delta']:
+                    # 增量模式：能用相对基准的高度残差表示的区域写入增量文件，其余区域完整保存
+                    delta, colored = encode_delta(os.path.join(init_path, BASELINE_NAME), colored)
+                    if delta is not None:
+                        files[DELTA_NAME] = delta
+                if colored and storage_config()['dedup']:
+                    # 去重模式：区域保存到设备级的内容寻址存储，扫描目录只保存引用
+                    with RegionStore(objects) as store:
+                        files[REFS_NAME] = store.encode_refs(colored)
+                    written = decode_refs(files[REFS_NAME], path)
+                elif colored:
+                    files[PACK_NAME] = encode_pack(colored, grid=Region.grid())
+                if files:
+                    # 一次扫描的所有文件作为一个任务交给后台写入
+                    future = get_writer().submit(path, files)
+                    if replaced or written:
+                        # 写入成功后释放被替换的引用文件中的引用，写入失败时释放本次增加的引用
+                        future.add_done_callback(
+                            lambda f: release_refs(objects, replaced if f.exception() is None else written))
             return True
     except Exception as e:
         print(f"An error occurred: {e} in write_df")
@@ -712,10 +782,25 @@ def write_single_df(path: str, init_path: str, init: bool, tunnel: Tunnel):
         else:
             # 不包含root目录，直接通过时间检索
             # 将pcd文件保存地址写入数据库
-            if not DBUtils.pcd_path2db(save_path, time, tunnel):
+            row_id = DBUtils.pcd_path2db(save_path, time, tunnel)
+            if not row_id:
                 return False
             anomaly = data.get_anomaly()
-            return write_df(save_path, init_path, anomaly, init)
+            with get_writer().batch() as batch:
+                ok = write_df(save_path, init_path, anomaly, init)
+            if row_id is not True:
+                # 写入失败时删除本次扫描的点云记录，消息重新投递后不会留下指向缺失数据的记录
+                if not ok:
+                    DBUtils.delete_pcd_logs([row_id])
+                else:
+                    batch.future().add_done_callback(
+                        lambda f: f.result() or DBUtils.delete_pcd_logs([row_id]))
+            if not ok:
+                return False
+            describes = anomaly.get_describe() if anomaly is not None else {}
+            record(KIND_HISTORY, save_path, time, list(anomaly.get_region().keys()) if anomaly is not None else [],
+                   max([degree_level(v[2]) for v in describes.values()] or [0]))
+            return True
             # 包含root目录
             # filename = 'root' if folder_count == 0 else str(folder_count)
             # final_path = os.path.join(save_path, filename)
@@ -742,6 +827,7 @@ def write_single_normal_log(path, time: datetime, file_name):
         # config['Time'] = {'time': time.strftime('%Y-%m-%d %H:%M:%S.%f')}
         with open(os.path.join(path, f"{str(file_name)}.ini"), 'w') as configfile:
             config.write(configfile)
+        record(KIND_LOG, os.path.join(path, f"{str(file_name)}.ini"), time)
         return True
     except Exception as e:
         print(f"An error occurred: {e} in write_single_normal_log")
@@ -788,6 +874,9 @@ def write_single_anomaly_log(path, time: datetime, file_name, anomaly_data):
 
         with open(os.path.join(path, f"{file_name}.ini"), 'w') as configfile:
             config.write(configfile)
+        record(KIND_LOG, os.path.join(path, f"{file_name}.ini"), time, list(anomaly_describe.keys()),
+               max([degree_level(d) for d in degree] or [0]))
+        append_ini(os.path.join(path, f"{file_name}.ini"))
         return True
     except Exception as e:
         print(f"An error occurred: {e} in write_single_anomaly_log")
@@ -869,6 +958,7 @@ def write_df2pcd(now: str, path: str, datas) -> None:
 
         if not os.path.exists(final_path):  # 如果文件夹不存在则创建文件夹
             os.makedirs(final_path)
+        record(KIND_RAW, final_path, time)
 
         for k in data.keys():
             if data.get(k) is not None:
@@ -881,17 +971,13 @@ def write_df2pcd(now: str, path: str, datas) -> None:
 
 
 def find_max_log(path):
-    filename_list = []
-    with os.scandir(path) as entries:
-        for entry in entries:
-            if entry.is_file() and entry.name.endswith('.ini'):
-                config = configparser.ConfigParser()
-                config.read(entry.path)
-                if config.has_section("Anomalies"):
-                    filename_list.append(entry.name)
-    if not filename_list:
-        return None
-    return os.path.join(path, max(filename_list))
+    """
+    目录中文件名最大的异常日志，有索引时只读取当天的索引文件
+    :param path: 日志目录
+    :return: .ini文件路径，没有异常日志时返回None
+    """
+    latest = max_log(path)
+    return None if latest is None else latest[0]
 
 
 def content(path: str) -> dict:
@@ -910,14 +996,9 @@ def content(path: str) -> dict:
     if not log_path_list:
         return {'msg': '信息不存在'}
 
-    # 获取每个目录中的最新的ini文件中的time属性
-    config = configparser.ConfigParser()
-    for log_path in log_path_list:
-        max_log_path = find_max_log(log_path)
-        if max_log_path is None:
-            continue
-        config.read(str(max_log_path))
-        now = datetime.strptime(config['Time']['time'], '%Y-%m-%d %H:%M:%S.%f')
+    # 获取每个目录中的最新的异常日志中的time属性，有索引的日期每天只读取一个文件
+    for _, record in latest_records(path):
+        now = datetime.strptime(record['time'], '%Y-%m-%d %H:%M:%S.%f')
         res_list.append(f"{now.hour:02d}:{now.minute:02d}:{now.second:02d}")
 
     if not res_list:
@@ -981,6 +1062,7 @@ def get_latest_csv(path):
         return {'msg': '目录不存在'}
     """
     获取目录及其子目录中最新的 .pcd 文件名。
+    .pcd文件不经过本程序写入，索引中没有记录，始终遍历磁盘
     """
     latest_file = None
     latest_mtime = -1
@@ -1005,6 +1087,11 @@ def find_latest_ini_folder(directory):
     :param directory:
     :return:
     """
+    catalog = open_catalog(directory)
+    if catalog is not None:
+        with catalog:
+            latest_log = catalog.latest(KIND_LOG, directory)
+        return None if latest_log is None else os.path.dirname(latest_log)
     # 获取所有子文件夹路径
     folders = find_log_path(directory)
 
@@ -1030,6 +1117,11 @@ def find_latest_root_folder(directory):
     :param directory:
     :return:
     """
+    catalog = open_catalog(directory)
+    if catalog is not None:
+        with catalog:
+            root_path = catalog.latest(KIND_RAW, directory, name='root')
+        return None if root_path is None else os.path.dirname(root_path)
     latest_folder = None
     # latest_root_folder = None
     latest_time = 0
@@ -1054,6 +1146,11 @@ def find_latest_folder(directory):
     :param directory:
     :return:
     """
+    catalog = open_catalog(directory)
+    if catalog is not None:
+        with catalog:
+            root_path = catalog.latest(KIND_RAW, directory, name='root')
+            return None if root_path is None else catalog.latest(KIND_RAW, parent=os.path.dirname(root_path))
     latest_folder = None
     latest_time = None
 
@@ -1081,35 +1178,30 @@ def find_root_folder(directory):
     return None
 
 
-def get_root_data(directory):
+def get_root_data(directory, bbox=None, budget=None):
     """
     http://127.0.0.1:8024/outer/service/history
     :param directory:
+    :param bbox: (x0, y0, x1, y1) 只读取投影面上包围盒内的点
+    :param budget: 点数预算，见lod_regions
     :return:
     """
-    datas = {}
-    with os.scandir(directory) as entries:
-        for entry in entries:
-            if entry.is_file() and entry.name.endswith('.csv'):
-                datas[entry.name] = pd.read_csv(entry.path)
-    return datas
+    # 键与旧版区域CSV文件名保持一致，基准数据从进程内缓存读取
+    return {f"{k}.csv": v for k, v in load_baseline(directory, budget, bbox).items()}
 
 
-def get_root_filename(directory):
+def get_root_filename(directory, budget=None):
     """
     http://127.0.0.1:8024/outer/service/history
     :param directory:
+    :param budget: 点数预算，见lod_regions
     :return:
     """
-    paths = {}
-    with os.scandir(directory) as entries:
-        for entry in entries:
-            if entry.is_file() and entry.name.endswith('.csv'):
-                paths[entry.name] = entry.path
-    return paths
+    # 值为区域打包文件中的PackRef，旧版目录为区域CSV文件路径
+    return {f"{k}.csv": v for k, v in lod_regions(directory, budget).items()}
 
 
-def merge_data(datas, target=None, is_df=False):
+def merge_arrays(datas, target=None, is_df=False, bbox=None, budget=None, voxel=None) -> tuple:
     """
     paths为初始化目录中的数据，如果directory为None会直接返回初始化数据
     directory为None的情况：
@@ -1119,15 +1211,16 @@ def merge_data(datas, target=None, is_df=False):
     :param datas:
     :param target:
     :param is_df:
-    :return:
+    :param bbox: (x0, y0, x1, y1) 只读取投影面上包围盒内的点，is_df为True时数据已经读取，不再裁剪
+    :param budget: 点数预算，选择target的细节级别，合并后仍超过预算时降采样，异常区域保持较高密度
+    :param voxel: 降采样的体素大小，单位米，优先于budget
+    :return: (xyz (n, 3), rgb (n, 3))
     """
     # df_list = []
     if not is_df:
         if target is not None:
-            with os.scandir(target) as entries:
-                for entry in entries:
-                    if entry.is_file() and entry.name.endswith('.csv'):
-                        datas[entry.name] = entry.path
+            for k, v in lod_regions(target, budget).items():
+                datas[f"{k}.csv"] = v
             # for e in list(datas.values()):
             #     df_list.append(pd.read_csv(e, usecols=['X', 'Y', 'Z', 'R', 'G', 'B']))
     else:
@@ -1141,36 +1234,43 @@ def merge_data(datas, target=None, is_df=False):
     # pcd.colors = o3d.utility.Vector3dVector(res_df[['R', 'G', 'B']].values / 255.0)
     # o3d.visualization.draw_geometries([pcd])
 
-    coordinate_list, color_list = [], []
-    for data in datas.values():
-        # 读取 CSV 文件时只加载需要的列
-        if not is_df:
-            data = pd.read_csv(data, usecols=['X', 'Y', 'Z', 'R', 'G', 'B'])
-        # 检查是否有颜色列
-        has_color = all(col in data.columns for col in ['R', 'G', 'B'])
-        for line in data.itertuples(index=False):
-            coordinate_list.extend([line.X, line.Y, line.Z])
-            if has_color:
-                color_list.extend([line.R, line.G, line.B])
-            else:
-                color_list.extend([0, 0, 0])
-    return coordinate_list, color_list
+    if not is_df:
+        # 只加载需要的列，同一个打包文件只打开一次
+        datas = load_regions(datas, usecols=COLUMNS, bbox=bbox)
+    # 没有颜色列的区域颜色为[0, 0, 0]
+    xyz, rgb = frames_to_arrays(datas.values())
+    return decimate(xyz, rgb, budget, voxel)
 
 
-def get_history(init_path, path=None):
+def merge_data(datas, target=None, is_df=False, bbox=None, budget=None, voxel=None):
+    """
+    与merge_arrays相同，返回扁平的坐标列表和颜色列表
+    :return: ([x1, y1, z1, ...], [r1, g1, b1, ...])
+    """
+    return arrays_to_lists(*merge_arrays(datas, target, is_df, bbox, budget, voxel))
+
+
+def get_history(init_path, path=None, bbox=None, budget=None, fmt=FORMAT_JSON, voxel=None):
     """
     http://127.0.0.1/outer/service/history
     :param path:
     :param init_path:
+    :param bbox: (x0, y0, x1, y1) 只返回投影面上包围盒内的点
+    :param budget: 点数预算，基准和异常数据分别选择不超过预算的细节级别，合并后仍超过预算时降采样
+    :param fmt: 响应格式，见util_response
+    :param voxel: 降采样的体素大小，单位米，优先于budget
     :return:
     """
     # 获取包含root文件夹的最新目录的路径
     # root_folder = find_latest_root_folder(path)
     # latest_path = find_max_folder(root_folder)
-    root_filepath = get_root_filename(init_path)
+    # 基准数据从进程内缓存读取，只有异常数据需要读取文件
+    root_data = get_root_data(init_path, bbox, budget)
+    target = {}
+    if path is not None:
+        target = {f"{k}.csv": v for k, v in load_regions(lod_regions(path, budget), usecols=COLUMNS, bbox=bbox).items()}
     # coordinate_list, color_list = merge_data(root_filepath, latest_path)
-    coordinate_list, color_list = merge_data(root_filepath, path)
-    return {'xyz': str(coordinate_list), 'rgb': str(color_list)}
+    return encode_response(*merge_arrays(root_data, target, True, budget=budget, voxel=voxel), fmt)
 
 
 def get_path_by_time(data: dict):
@@ -1211,18 +1311,16 @@ def get_path(data: dict, path, cls: str, tag):
     # return content(data_path) if tag == 'tree' else data_path
 
 
-def get_pcd_list(path):
+def get_pcd_list(path, budget=None):
     """
     获取path地址中的区域点云数据字典
     :param path:
-    :return: {区域索引: 区域csv文件地址}
+    :param budget: 点数预算，见lod_regions
+    :return: {区域索引: 区域数据地址，打包文件为"regions.pack#区域索引"形式}
     """
     res = {}
-    with os.scandir(path) as entries:
-        for entry in entries:
-            if entry.is_file() and entry.name.endswith('.csv'):
-                name = entry.name.split('.')[0]
-                res[name] = {'path': entry.path, 'bas': '0'}
+    for k, v in lod_regions(path, budget).items():
+        res[str(k)] = {'path': str(v), 'bas': '0'}
     return res
 
 
@@ -1239,32 +1337,35 @@ def compare_log_information(root_bas: dict, compare_bas: dict, compare: dict):
     return compare_bas_res, compare_bas_log
 
 
-def get_xyz_rgb_list(init: dict, compare: dict):
-    coordinate_list, color_list = [], []
-    # df_list = []
-    for k, v in init.items():
-        r, g, b = (118, 238, 198)
-        data = pd.read_csv(v.get('path'), usecols=['X', 'Y', 'Z', 'R', 'G', 'B'])
+def get_xyz_rgb_list(init: dict, compare: dict, bbox=None, fmt=None, budget=None, voxel=None):
+    """
+    基准区域为绿色，compare中的区域为红色，没有颜色列的区域为黑色
+    :param init: get_pcd_list的返回值
+    :param compare: 需要标红的区域
+    :param bbox: (x0, y0, x1, y1) 只读取投影面上包围盒内的点
+    :param fmt: 响应格式，见util_response；None时返回扁平的坐标列表和颜色列表
+    :param budget: 点数预算，超过时降采样，红色区域保持较高密度
+    :param voxel: 降采样的体素大小，单位米，优先于budget
+    :return:
+    """
+    datas = load_regions({k: v.get('path') for k, v in init.items()}, usecols=COLUMNS, bbox=bbox)
+    xyz, _ = frames_to_arrays(datas.values())
+    colors, counts = [], []
+    for k, data in datas.items():
+        if data is None:
+            continue
         has_color = all(col in data.columns for col in ['R', 'G', 'B'])
         if has_color and k in compare.keys():
-            r, g, b = (178, 34, 34)
+            colors.append((178, 34, 34))
         else:
-            r, g, b = (118, 238, 198) if has_color else (0, 0, 0)
-
-        data['R'], data['G'], data['B'] = r, g, b
-
-        # 提取坐标和颜色
-        # coordinates = data[['X', 'Y', 'Z']].to_numpy().flatten()  # 转换为 NumPy 数组并展开
-        # colors = data[['R', 'G', 'B']].to_numpy().flatten()  # 转换为 NumPy 数组并展开
-        # coordinate_list.extend(coordinates)
-        # color_list.extend(colors)
-        # df_list.append(data)
-
-        for line in data.itertuples(index=False):
-            coordinate_list.extend([line.X, line.Y, line.Z])
-            color_list.extend([line.R, line.G, line.B])
-        # df_list.append(data)
-    return coordinate_list, color_list
+            colors.append((118, 238, 198) if has_color else (0, 0, 0))
+        counts.append(len(data))
+    # 每个区域一种颜色，按点数展开
+    rgb = np.repeat(np.array(colors, dtype=np.int64).reshape(-1, 3), counts, axis=0)
+    xyz, rgb = decimate(xyz, rgb, budget, voxel)
+    if fmt is None:
+        return arrays_to_lists(xyz, rgb)
+    return encode_response(xyz, rgb, fmt)
 
 
 def data_is_overdue(data: dict):
@@ -9,6 +9,7 @@
 """
 import json
 import os
+import threading
 
 import numpy as np
 import pandas as pd
@@ -16,6 +17,8 @@ import pika
 from open3d.cpu.pybind.geometry import PointCloud
 from pandas import DataFrame
 
+from utils.util_series import SeriesStore, has_store
+
 
 def get_line(path) -> int:
     """
@@ -52,6 +55,8 @@ def is_init(init_count: int, file_path):
     :param file_path: 时序数据所在路径
     :return: 返回True说明，在初始化阶段
     """
+    if has_store(file_path):
+        return SeriesStore(file_path).is_init(init_count)
     return True if (get_all_file_line_length(file_path) - init_count) < 0 else False
 
 
@@ -122,6 +127,66 @@ def compare_df_len(df1: DataFrame, df2: DataFrame):
     return df2
 
 
+class MonitorPublisher(object):
+    """
+    监听队列消息发布：按连接参数缓存连接，避免每次发送都新建一个从不关闭的连接
+    """
+    _connections = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _connect(key):
+        username, password, host, port, vh = key
+        credentials = pika.PlainCredentials(username=username, password=password)
+        parameters = pika.ConnectionParameters(host=host, port=port, virtual_host=vh, credentials=credentials)
+        conn = pika.BlockingConnection(parameters)
+        return conn, conn.channel()
+
+    @staticmethod
+    def _close(key):
+        conn, _ = MonitorPublisher._connections.pop(key, (None, None))
+        try:
+            if conn is not None and conn.is_open:
+                conn.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def publish(username, password, host, port, vh, queue_name, body) -> None:
+        """
+        发送消息至指定队列，连接失效时重连一次
+        """
+        key = (username, password, host, port, vh)
+        with MonitorPublisher._lock:
+            for attempt in range(2):
+                try:
+                    if key not in MonitorPublisher._connections:
+                        MonitorPublisher._connections[key] = MonitorPublisher._connect(key)
+                    conn, ch = MonitorPublisher._connections[key]
+                    # 处理积压的心跳，连接失效时抛出异常
+                    conn.process_data_events(time_limit=0)
+                    # 确保队列存在
+                    ch.queue_declare(
+                        queue=queue_name,
+                        durable=True,
+                        arguments={
+                            'x-queue-mode': 'lazy'  # 设置队列为惰性模式
+                        }
+                    )
+                    ch.basic_publish(exchange='', routing_key=queue_name, body=body)
+                    return
+                except Exception:
+                    MonitorPublisher._close(key)
+                    if attempt == 1:
+                        raise
+
+    @staticmethod
+    def close_all() -> None:
+        with MonitorPublisher._lock:
+            for key in list(MonitorPublisher._connections.keys()):
+                MonitorPublisher._close(key)
+
+
 def send_queue_info2monitor(eq_code, queue_name, status, equipment, username, password, host, port, vh, bing_key):
     """
     向PC监听队列发送队列
@@ -149,27 +214,7 @@ def send_queue_info2monitor(eq_code, queue_name, status, equipment, username, pa
                 'queues': {f'{queue_name}_{bing_key}': status}
             }
 
-        credentials = pika.PlainCredentials(username=username, password=password)
-        parameters = pika.ConnectionParameters(host=host, port=port,
-                                               virtual_host=vh,
-                                               credentials=credentials)
-        conn = pika.BlockingConnection(parameters)
-        ch = conn.channel()
-
-        # 确保队列存在
-        ch.queue_declare(
-            queue=monitor_queue_name,
-            durable=True,
-            arguments={
-                'x-queue-mode': 'lazy'  # 设置队列为惰性模式
-            }
-        )
-
-        ch.basic_publish(
-            exchange='',
-            routing_key=monitor_queue_name,
-            body=json.dumps(data)
-        )
+        MonitorPublisher.publish(username, password, host, port, vh, monitor_queue_name, json.dumps(data))
         return True
     except Exception as e:
         return False
@@ -0,0 +1,108 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_22:50
+@FileName:util_response.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 点云接口响应编码：由区域DataFrame向量化生成坐标和颜色数组，按请求的格式输出
+
+响应格式：
+    json     {'xyz': str(坐标列表), 'rgb': str(颜色列表)}，与原接口相同
+    base64   {'format': 'base64', 'count': 点数, 'xyz': float32坐标的base64, 'rgb': uint8颜色的base64}
+    binary   application/octet-stream，小端序：
+                 header_len(I) header(JSON，UTF-8，用空格补齐到4字节) xyz(count * 3 float32) rgb(count * 3 uint8)
+             header为 {'count': 点数, 'xyz': {'dtype', 'shape'}, 'rgb': {'dtype', 'shape'}}
+             坐标从4字节对齐的位置开始，浏览器可以直接用Float32Array/Uint8Array读取
+"""
+import base64
+import json
+import struct
+
+import numpy as np
+
+FORMAT_JSON = 'json'
+FORMAT_BASE64 = 'base64'
+FORMAT_BINARY = 'binary'
+FORMATS = (FORMAT_JSON, FORMAT_BASE64, FORMAT_BINARY)
+BINARY_MIMETYPE = 'application/octet-stream'
+
+HEADER_LEN = struct.Struct('<I')
+
+
+def frames_to_arrays(frames) -> tuple:
+    """
+    合并多个区域的点云
+    :param frames: DataFrame的可迭代对象，没有颜色列的区域颜色为[0, 0, 0]
+    :return: (xyz (n, 3) float64, rgb (n, 3) int64)
+    """
+    xyz_list, rgb_list = [], []
+    for df in frames:
+        if df is None:
+            continue
+        xyz_list.append(df[['X', 'Y', 'Z']].to_numpy(dtype=np.float64))
+        if all(col in df.columns for col in ['R', 'G', 'B']):
+            rgb_list.append(df[['R', 'G', 'B']].to_numpy(dtype=np.int64))
+        else:
+            rgb_list.append(np.zeros((len(df), 3), dtype=np.int64))
+    if not xyz_list:
+        return np.empty((0, 3), dtype=np.float64), np.empty((0, 3), dtype=np.int64)
+    return np.concatenate(xyz_list), np.concatenate(rgb_list)
+
+
+def arrays_to_lists(xyz, rgb) -> tuple:
+    """
+    转换为原接口使用的扁平列表 [x1, y1, z1, x2, ...] 和 [r1, g1, b1, r2, ...]
+    """
+    return np.asarray(xyz).ravel().tolist(), np.asarray(rgb).ravel().tolist()
+
+
+def _align(n, size=4):
+    return (n + size - 1) // size * size
+
+
+def encode_binary(xyz, rgb) -> bytes:
+    """
+    编码为binary格式的响应体
+    """
+    xyz = np.ascontiguousarray(xyz, dtype='<f4')
+    rgb = np.ascontiguousarray(rgb, dtype=np.uint8)
+    count = len(xyz)
+    header = json.dumps({'count': count,
+                         'xyz': {'dtype': 'float32', 'shape': [count, 3]},
+                         'rgb': {'dtype': 'uint8', 'shape': [count, 3]}}).encode('utf-8')
+    header += b' ' * (_align(HEADER_LEN.size + len(header)) - HEADER_LEN.size - len(header))
+    return HEADER_LEN.pack(len(header)) + header + xyz.tobytes() + rgb.tobytes()
+
+
+def decode_binary(data: bytes) -> tuple:
+    """
+    解析binary格式的响应体
+    :return: (xyz (n, 3) float32, rgb (n, 3) uint8)
+    """
+    (size,) = HEADER_LEN.unpack_from(data, 0)
+    offset = HEADER_LEN.size + size
+    count = json.loads(data[HEADER_LEN.size:offset].decode('utf-8'))['count']
+    xyz = np.frombuffer(data, dtype='<f4', count=count * 3, offset=offset).reshape(count, 3)
+    rgb = np.frombuffer(data, dtype=np.uint8, count=count * 3, offset=offset + xyz.nbytes).reshape(count, 3)
+    return xyz, rgb
+
+
+def encode_response(xyz, rgb, fmt=FORMAT_JSON):
+    """
+    按格式生成接口响应
+    :param xyz: (n, 3) 坐标
+    :param rgb: (n, 3) 颜色
+    :param fmt: json、base64或binary
+    :return: json和base64格式返回字典，binary格式返回bytes（BINARY_MIMETYPE）
+    """
+    if fmt == FORMAT_JSON:
+        coordinate_list, color_list = arrays_to_lists(xyz, rgb)
+        return {'xyz': str(coordinate_list), 'rgb': str(color_list)}
+    if fmt == FORMAT_BASE64:
+        return {'format': FORMAT_BASE64, 'count': len(xyz),
+                'xyz': base64.b64encode(np.ascontiguousarray(xyz, dtype='<f4').tobytes()).decode('ascii'),
+                'rgb': base64.b64encode(np.ascontiguousarray(rgb, dtype=np.uint8).tobytes()).decode('ascii')}
+    if fmt == FORMAT_BINARY:
+        return encode_binary(xyz, rgb)
+    raise ValueError(f"unknown response format: {fmt}")
@@ -0,0 +1,302 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_21:40
+@FileName:util_retention.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 历史扫描保留策略：按pcd_log中的采集时间稀疏化或删除旧扫描，同时删除对应的pcd_log记录
+
+策略格式：逗号分隔的 时长:粒度，按时长升序，最后一段时长可以为*
+    3d:all, 90d:hour, *:day     3天内全部保留，90天内每小时保留一次扫描，之后每天保留一次
+    7d:all, 30d:day, *:none     7天内全部保留，30天内每天保留一次，之后全部删除
+    时长单位 d天 h小时；粒度 all全部保留、hour每小时、day每天、none不保留
+每个设备按小时或按天分组，只保留组内最后一次扫描；时间段还没有结束的组不处理
+
+按设备或项目覆盖默认策略：[Retention]中的 device.<DataAcqEquipCode> 和 project.<ProCode>，设备优先
+
+    1. 只处理超过最短全部保留时长的扫描，与正在写入的扫描互不影响
+    2. 先删除文件（去重引用先释放，归档中的扫描重写归档），再在一个事务中删除一批pcd_log记录
+       中断后再次运行会重新选中同样的记录，删除是幂等的
+    3. 同一秒内的多次扫描共用一个目录，目录仍被其他记录引用时只删除过期的记录，不删除文件
+    4. 删除扫描目录和重写归档都持有ARCHIVE_LOCK，与分层归档互斥
+"""
+import configparser
+import os
+import shutil
+import threading
+from datetime import datetime, timedelta
+
+from utils.util_archive import ARCHIVE_LOCK, ARCHIVE_SUFFIX, compact_archive, split_member
+from utils.util_catalog import forget
+from utils.util_database import DBUtils
+from utils.util_pack import RegionStore, pending_release
+from utils.util_tiering import dir_size
+
+CONFIG_PATH = '../config/receive.ini'
+
+RESOLUTION_ALL = 'all'
+RESOLUTION_HOUR = 'hour'
+RESOLUTION_DAY = 'day'
+RESOLUTION_NONE = 'none'
+SPANS = {RESOLUTION_HOUR: timedelta(hours=1), RESOLUTION_DAY: timedelta(days=1)}
+UNITS = {'d': 'days', 'h': 'hours'}
+
+# 删除扫描目录后向上清理空目录的层数：秒/分/时/日，年和月目录保留
+CLEAN_DEPTH = 4
+
+
+class RetentionPolicy(object):
+    """
+    一个保留策略
+    """
+
+    def __init__(self, tiers: list):
+        """
+        :param tiers: [(时长timedelta，None表示不限, 粒度)]，按时长升序
+        """
+        self.tiers = tiers
+
+    @staticmethod
+    def parse(text: str):
+        """
+        解析 "3d:all, 90d:hour, *:day" 形式的策略
+        """
+        tiers = []
+        for item in text.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            age, _, resolution = item.partition(':')
+            age, resolution = age.strip(), resolution.strip()
+            if resolution not in (RESOLUTION_ALL, RESOLUTION_HOUR, RESOLUTION_DAY, RESOLUTION_NONE):
+                raise ValueError(f"unknown retention resolution: {resolution}")
+            if age == '*':
+                tiers.append((None, resolution))
+            elif age[-1:] in UNITS:
+                tiers.append((timedelta(**{UNITS[age[-1]]: float(age[:-1])}), resolution))
+            else:
+                raise ValueError(f"unknown retention age: {age}")
+        if not tiers:
+            raise ValueError("empty retention policy")
+        if any(age is None for age, _ in tiers[:-1]):
+            raise ValueError("only the last retention tier can be *")
+        return RetentionPolicy(tiers)
+
+    def keep_all(self) -> timedelta:
+        """
+        全部保留的时长，比它新的扫描不会被处理
+        """
+        age, resolution = self.tiers[0]
+        if resolution != RESOLUTION_ALL:
+            return timedelta(0)
+        return age if age is not None else timedelta.max
+
+    def resolution(self, age: timedelta) -> str:
+        for limit, resolution in self.tiers:
+            if limit is None or age < limit:
+                return resolution
+        return self.tiers[-1][1]
+
+    def expired(self, rows: list, now: datetime) -> list:
+        """
+        选出一个设备中需要删除的扫描
+        :param rows: 同一设备的pcd_log记录，按采集时间升序
+        :param now: 当前时间
+        :return: 需要删除的记录
+        """
+        latest, drop = {}, []
+        for row in rows:
+            time = row['time']
+            resolution = self.resolution(now - time)
+            if resolution == RESOLUTION_ALL:
+                continue
+            if resolution == RESOLUTION_NONE:
+                drop.append(row)
+                continue
+            start = time.replace(minute=0, second=0, microsecond=0)
+            if resolution == RESOLUTION_DAY:
+                start = start.replace(hour=0)
+            if start + SPANS[resolution] > now:
+                continue
+            key = (resolution, start)
+            if key in latest:
+                drop.append(latest[key])
+            latest[key] = row
+        return drop
+
+
+def _row_time(value) -> datetime:
+    return value if isinstance(value, datetime) else datetime.strptime(str(value), "%Y-%m-%d %H:%M:%S")
+
+
+class Retention(object):
+    """
+    历史扫描保留策略任务
+    """
+
+    def __init__(self, policy=None, overrides: dict = None, batch=None, interval=None):
+        """
+        参数为None时使用[Retention]配置
+        :param policy: 默认策略
+        :param overrides: {'device.<设备编号>' 或 'project.<项目编号>': 策略}
+        :param batch: 每个事务删除的pcd_log记录数
+        :param interval: 后台运行的间隔，单位秒
+        """
+        config = configparser.ConfigParser()
+        config.read(CONFIG_PATH)
+        self.enabled = config.getboolean("Retention", "enabled", fallback=False)
+        if policy is None:
+            policy = config.get("Retention", "policy", fallback="3d:all, 90d:hour, *:day")
+        if overrides is None:
+            overrides = {k: v for k, v in config.items("Retention")
+                         if k.startswith('device.') or k.startswith('project.')} \
+                if config.has_section("Retention") else {}
+        self.policy = RetentionPolicy.parse(policy)
+        self.overrides = {k: RetentionPolicy.parse(v) for k, v in overrides.items()}
+        self.batch = config.getint("Retention", "batch", fallback=500) if batch is None else batch
+        self.interval = config.getfloat("Retention", "interval", fallback=3600) if interval is None else interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def policy_for(self, device, project):
+        """
+        设备策略优先于项目策略，都没有时使用默认策略
+        """
+        # configparser的键为小写
+        for key in (f"device.{device}".lower(), f"project.{project}".lower()):
+            if key in self.overrides:
+                return self.overrides[key]
+        return self.policy
+
+    def candidates(self, now: datetime = None) -> list:
+        """
+        :return: 需要删除的pcd_log记录 [{'ID', 'Path', ...}]，查询失败时返回None
+        """
+        now = now or datetime.now()
+        keep_all = min([self.policy.keep_all()] + [p.keep_all() for p in self.overrides.values()])
+        if keep_all == timedelta.max:
+            return []
+        rows = DBUtils.get_pcd_log_before(now - keep_all)
+        if rows is None:
+            return None
+        devices = {}
+        for row in rows:
+            row['time'] = _row_time(row['AnomalyTime'])
+            devices.setdefault((row.get('DataAcqEquipCode'), row.get('ProCode')), []).append(row)
+        res = []
+        for (device, project), items in devices.items():
+            items.sort(key=lambda r: r['time'])
+            res.extend(self.policy_for(device, project).expired(items, now))
+        return res
+
+    @staticmethod
+    def _remove_scan(path) -> int:
+        """
+        删除一个扫描目录并清理空的上级目录
+        :return: 释放的字节数，包括objects中引用归零的对象
+        """
+        with ARCHIVE_LOCK:
+            if not os.path.isdir(path):
+                return 0
+            freed = dir_size(path)
+            if pending_release(path):
+                with RegionStore(RegionStore.locate(path)) as store:
+                    store.release_scan(path)
+                    freed += store.freed
+            shutil.rmtree(path, ignore_errors=True)
+            parent = os.path.dirname(os.path.normpath(path))
+            for _ in range(CLEAN_DEPTH - 1):
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+            return freed
+
+    @staticmethod
+    def shared_paths(rows: list):
+        """
+        :return: 仍被这批记录之外的pcd_log记录引用的保存路径，查询失败时返回None
+        """
+        ids = {row['ID'] for row in rows}
+        others = DBUtils.get_pcd_log_by_paths(sorted({row['Path'] for row in rows if row.get('Path')}))
+        if others is None:
+            return None
+        return {os.path.normpath(r['Path']) for r in others if r['ID'] not in ids}
+
+    def remove(self, rows: list) -> dict:
+        """
+        删除一批扫描的文件，然后在一个事务中删除它们的pcd_log记录
+        :return: {'scans': 删除的记录数, 'bytes': 释放的字节数}
+        """
+        freed, archives = 0, {}
+        shared = self.shared_paths(rows)
+        if shared is None:
+            return {'scans': 0, 'bytes': 0}
+        for row in rows:
+            path = os.path.normpath(row.get('Path') or '')
+            if path in shared:
+                continue
+            if ARCHIVE_SUFFIX + os.sep in path:
+                # 归档中的扫描，同一归档只重写一次
+                member = split_member(path)
+                if member is not None:
+                    archives.setdefault(member[0], set()).add(member[1])
+            else:
+                freed += self._remove_scan(path)
+        for archive, scans in archives.items():
+            try:
+                with ARCHIVE_LOCK:
+                    freed += compact_archive(archive, scans)
+            except Exception as e:
+                # 归档重写失败时保留这些记录，下次运行重试
+                print(f"An error occurred: {e} in Retention.remove")
+                rows = [r for r in rows if not os.path.normpath(r.get('Path') or '').startswith(archive + os.sep)]
+        if not DBUtils.delete_pcd_logs([row['ID'] for row in rows]):
+            return {'scans': 0, 'bytes': freed}
+        forget(paths=[row.get('Path') for row in rows
+                      if row.get('Path') and os.path.normpath(row['Path']) not in shared])
+        return {'scans': len(rows), 'bytes': freed}
+
+    def run_once(self, now: datetime = None) -> dict:
+        """
+        按保留策略清理一次
+        :return: {'scans': 删除的扫描数, 'bytes': 释放的字节数}
+        """
+        res = {'scans': 0, 'bytes': 0}
+        rows = self.candidates(now)
+        if not rows:
+            return res
+        for i in range(0, len(rows), self.batch):
+            stats = self.remove(rows[i:i + self.batch])
+            res['scans'] += stats['scans']
+            res['bytes'] += stats['bytes']
+        print(f"retention: removed {res['scans']} scans, reclaimed {res['bytes']} bytes")
+        return res
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"An error occurred: {e} in Retention._run")
+            self._stop.wait(self.interval)
+
+    def start(self) -> None:
+        """
+        在后台线程中定期运行
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+if __name__ == '__main__':
+    Retention().run_once()
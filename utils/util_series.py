@@ -0,0 +1,231 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_17:20
+@FileName:util_series.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 追加写入的时序数据存储，替代按130行切分的CSV文件
+
+目录结构：
+    manifest.json   {"version": 1, "columns": 区域数量, "rows": 行数, "dtype": "<f8"}
+    values.bin      每行为所有区域的Z均值，定长记录，按行连续存放，可直接内存映射为(rows, columns)数组
+    time.bin        每行的采集时间，int64微秒时间戳，与values.bin逐行对应
+
+行数只以manifest为准：追加时先写数据再原子替换manifest，中断写入留下的多余字节会在下次追加时被覆盖
+"""
+import json
+import os
+import shutil
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+MANIFEST_NAME = 'manifest.json'
+VALUES_NAME = 'values.bin'
+TIME_NAME = 'time.bin'
+IMPORT_DIR = '.import'  # 旧版CSV导入时的临时目录
+
+VERSION = 1
+DTYPE = '<f8'
+TIME_DTYPE = '<i8'
+EPOCH = datetime(1970, 1, 1)
+NO_TIME = -1  # 由旧版CSV导入的数据没有采集时间
+
+
+def has_store(directory) -> bool:
+    """
+    判断目录中是否存在时序数据存储
+    """
+    return os.path.isfile(os.path.join(directory, MANIFEST_NAME))
+
+
+class SeriesStore(object):
+    """
+    单个采集设备的时序数据存储
+    """
+
+    def __init__(self, directory, columns: int = None):
+        """
+        :param directory: 时序数据保存目录
+        :param columns: 区域数量，新建存储时必须提供，打开已有存储时用于校验
+        """
+        self.directory = directory
+        self.values_path = os.path.join(directory, VALUES_NAME)
+        self.time_path = os.path.join(directory, TIME_NAME)
+        self.manifest_path = os.path.join(directory, MANIFEST_NAME)
+        if has_store(directory):
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                self._manifest = json.load(f)
+            if self._manifest.get('version') != VERSION:
+                raise ValueError(f"unsupported series version: {self._manifest.get('version')}")
+            if columns is not None and columns != self.columns:
+                raise ValueError(f"series has {self.columns} columns, got {columns}")
+        else:
+            if columns is None:
+                raise ValueError(f"no series store in {directory}")
+            os.makedirs(directory, exist_ok=True)
+            self._manifest = {'version': VERSION, 'columns': int(columns), 'rows': 0, 'dtype': DTYPE}
+            open(self.values_path, 'wb').close()
+            open(self.time_path, 'wb').close()
+            self._write_manifest()
+
+    @property
+    def columns(self) -> int:
+        return self._manifest['columns']
+
+    @property
+    def rows(self) -> int:
+        return self._manifest['rows']
+
+    @property
+    def row_size(self) -> int:
+        """
+        单行记录的字节数
+        """
+        return self.columns * np.dtype(DTYPE).itemsize
+
+    def _write_manifest(self) -> None:
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self._manifest, f)
+        os.replace(tmp, self.manifest_path)
+
+    def _row(self, vals, columns=None) -> np.ndarray:
+        """
+        构造一行定长记录，columns为None时vals为全部区域的值，否则只填充指定区域，其余为NaN
+        """
+        if columns is None:
+            row = np.asarray(vals, dtype=DTYPE)
+            if row.shape != (self.columns,):
+                raise ValueError(f"row has {row.size} values, expected {self.columns}")
+            return row
+        row = np.full(self.columns, np.nan, dtype=DTYPE)
+        row[np.asarray([int(c) for c in columns], dtype=np.int64)] = np.asarray(vals, dtype=DTYPE)
+        return row
+
+    def append(self, time: datetime, vals, columns=None) -> int:
+        """
+        追加一行时序数据，耗时与已有数据量无关
+        :param time: 采集时间，为None时记为NO_TIME
+        :param vals: 一行时序数据
+        :param columns: vals对应的区域索引，为None时vals包含全部区域
+        :return: 追加后的行数
+        """
+        return self.extend([time], [self._row(vals, columns)])
+
+    def extend(self, times, rows) -> int:
+        """
+        批量追加多行时序数据
+        :param times: 采集时间列表
+        :param rows: (n, columns) 时序数据
+        :return: 追加后的行数
+        """
+        rows = np.ascontiguousarray(rows, dtype=DTYPE).reshape(-1, self.columns)
+        stamps = np.asarray([NO_TIME if t is None else (t - EPOCH) // timedelta(microseconds=1) for t in times],
+                            dtype=TIME_DTYPE)
+        if len(stamps) != len(rows):
+            raise ValueError("times and rows length mismatch")
+        n = self.rows
+        for path, data, size in ((self.values_path, rows, self.row_size), (self.time_path, stamps, 8)):
+            with open(path, 'r+b') as f:
+                f.seek(n * size)
+                f.write(data.tobytes())
+                f.truncate()
+        self._manifest['rows'] = n + len(rows)
+        self._write_manifest()
+        return self.rows
+
+    def amend_tail(self, rows, columns=None) -> int:
+        """
+        原地修改最后若干行，只写入被修改的行，耗时与已有数据量无关
+        :param rows: (n, len(columns)) 修正后的时序数据，第i行对应倒数第n-i行
+        :param columns: rows对应的区域索引，为None时rows包含全部区域；未包含的区域保持原值
+        :return: 实际修改的行数，rows多于已有行数时只修改已有的行
+        """
+        rows = np.asarray(rows, dtype=DTYPE)
+        rows = rows.reshape(len(rows), -1)
+        n = min(len(rows), self.rows)
+        if n == 0:
+            return 0
+        mm = np.memmap(self.values_path, dtype=DTYPE, mode='r+', shape=(self.rows, self.columns))
+        tail = mm[self.rows - n:]
+        if columns is None:
+            tail[:] = rows[-n:]
+        else:
+            tail[:, [int(c) for c in columns]] = rows[-n:]
+        mm.flush()
+        del mm
+        return n
+
+    def is_init(self, init_count: int) -> bool:
+        """
+        判断是否仍在初始化阶段，只读取manifest
+        :param init_count: 初始化阶段需要的时序数据长度
+        :return: 返回True说明在初始化阶段
+        """
+        return self.rows < init_count
+
+    def values(self, start=None, stop=None) -> np.ndarray:
+        """
+        内存映射读取时序数据，只有访问到的行会被读入内存
+        :return: (rows, columns) 只读数组
+        """
+        if self.rows == 0:
+            return np.empty((0, self.columns), dtype=DTYPE)
+        mm = np.memmap(self.values_path, dtype=DTYPE, mode='r', shape=(self.rows, self.columns))
+        return mm[start:stop]
+
+    def times(self, start=None, stop=None) -> np.ndarray:
+        """
+        读取采集时间，int64微秒时间戳
+        """
+        if self.rows == 0:
+            return np.empty(0, dtype=TIME_DTYPE)
+        mm = np.memmap(self.time_path, dtype=TIME_DTYPE, mode='r', shape=(self.rows,))
+        return mm[start:stop]
+
+    def column(self, index: int, start=None, stop=None) -> np.ndarray:
+        """
+        读取单个区域的时序数据
+        """
+        return np.array(self.values(start, stop)[:, int(index)])
+
+    def read_df(self, start=None, stop=None, columns=None) -> pd.DataFrame:
+        """
+        以DataFrame形式读取时序数据，列名与旧版CSV相同
+        :param columns: 需要读取的区域索引，默认全部区域
+        """
+        vals = self.values(start, stop)
+        if columns is None:
+            return pd.DataFrame(np.array(vals), columns=[str(i) for i in range(self.columns)])
+        idx = [int(c) for c in columns]
+        return pd.DataFrame(np.array(vals[:, idx]), columns=[str(i) for i in idx])
+
+    @staticmethod
+    def import_csv(directory, columns: int):
+        """
+        将目录中旧版的N.csv时序数据按文件编号顺序导入新的存储
+        先导入到临时目录，全部文件导入后再移入，manifest最后移入；中断的导入没有manifest，下次重新导入
+        :param directory: 时序数据保存目录
+        :param columns: 区域数量
+        :return: SeriesStore
+        """
+        if has_store(directory):
+            return SeriesStore(directory, columns)
+        staging = os.path.join(directory, IMPORT_DIR)
+        shutil.rmtree(staging, ignore_errors=True)
+        store = SeriesStore(staging, columns)
+        names = [e.name for e in os.scandir(directory)
+                 if e.is_file() and e.name.endswith('.csv') and os.path.splitext(e.name)[0].isdigit()]
+        for name in sorted(names, key=lambda x: int(os.path.splitext(x)[0])):
+            df = pd.read_csv(os.path.join(directory, name))
+            if df.empty:
+                continue
+            rows = df.reindex(columns=[str(i) for i in range(columns)]).values
+            store.extend([None] * len(rows), rows)
+        for name in (VALUES_NAME, TIME_NAME, MANIFEST_NAME):
+            os.replace(os.path.join(staging, name), os.path.join(directory, name))
+        os.rmdir(staging)
+        return SeriesStore(directory, columns)
@@ -0,0 +1,209 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_21:10
+@FileName:util_tiering.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 历史扫描分级压缩任务：按pcd_log中的采集时间选择超过保留时间的扫描，按小时或按天写入压缩归档
+
+    1. 只处理已经结束的时间段（截止时间按归档粒度向下取整），不会与正在写入的扫描冲突
+    2. 归档落盘后在一个事务中修改pcd_log的Path，再删除原扫描目录
+    3. 增量和去重引用的区域在归档时还原为完整数据，并释放objects中的引用
+"""
+import configparser
+import os
+import shutil
+import threading
+from datetime import datetime, timedelta
+
+from utils.util_archive import ARCHIVE_LOCK, ARCHIVE_SUFFIX, BUCKET_DEPTH, GRANULARITY_DAY, GRANULARITY_HOUR, \
+    ArchiveWriter, ScanArchive, choose_codec, compress, decompress, member_path
+from utils.util_catalog import forget
+from utils.util_database import DBUtils
+from utils.util_pack import RegionStore, list_regions, load_regions, pending_release
+
+CONFIG_PATH = '../config/receive.ini'
+
+
+def dir_size(path) -> int:
+    """
+    目录中所有文件的字节数
+    """
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+class Tiering(object):
+    """
+    历史扫描分级压缩任务，按pcd_log中的采集时间选择超过保留时间的扫描
+    """
+
+    def __init__(self, age=None, granularity=None, codec=None, level=None, interval=None):
+        """
+        参数为None时使用[Tiering]配置
+        :param age: 扫描采集后保持原样的天数
+        :param granularity: 归档粒度 hour/day
+        :param codec: 压缩算法 zstd/lz4/zlib
+        :param level: 压缩等级
+        :param interval: 后台运行的间隔，单位秒
+        """
+        config = configparser.ConfigParser()
+        config.read(CONFIG_PATH)
+        self.enabled = config.getboolean("Tiering", "enabled", fallback=False)
+        self.age = config.getfloat("Tiering", "age", fallback=7) if age is None else age
+        self.granularity = config.get("Tiering", "granularity", fallback=GRANULARITY_HOUR) \
+            if granularity is None else granularity
+        if self.granularity not in BUCKET_DEPTH:
+            raise ValueError(f"unknown granularity: {self.granularity}")
+        self.codec = choose_codec(config.get("Tiering", "codec", fallback='zstd') if codec is None else codec)
+        self.level = config.getint("Tiering", "level", fallback=3) if level is None else level
+        self.interval = config.getfloat("Tiering", "interval", fallback=3600) if interval is None else interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def cutoff(self, now: datetime = None) -> datetime:
+        """
+        早于该时间的扫描可以归档，按归档粒度向下取整，保证归档的时间段已经结束
+        """
+        end = (now or datetime.now()) - timedelta(days=self.age)
+        end = end.replace(minute=0, second=0, microsecond=0)
+        return end.replace(hour=0) if self.granularity == GRANULARITY_DAY else end
+
+    def bucket(self, scan_path) -> str:
+        """
+        扫描目录所属的时间目录
+        """
+        path = os.path.normpath(scan_path)
+        for _ in range(BUCKET_DEPTH[self.granularity]):
+            path = os.path.dirname(path)
+        return path
+
+    def candidates(self, now: datetime = None) -> dict:
+        """
+        :return: {时间目录: [(ID, 扫描目录)]}，查询失败时返回None
+        """
+        rows = DBUtils.get_pcd_log_before(self.cutoff(now), exclude=f"%{ARCHIVE_SUFFIX}%")
+        if rows is None:
+            return None
+        res = {}
+        for row in rows:
+            path = row.get('Path')
+            if path:
+                res.setdefault(self.bucket(path), []).append((row['ID'], path))
+        return res
+
+    def archive_bucket(self, bucket, rows: list) -> dict:
+        """
+        将一个时间目录中的扫描写入归档，修改pcd_log中的Path后删除原扫描目录
+        已存在的归档会被合并，同一扫描以本次写入为准
+        :param bucket: 时间目录
+        :param rows: [(ID, 扫描目录)]
+        :return: {'scans': 归档的扫描数, 'before': 原扫描目录字节数, 'after': 归档增加的字节数}
+        """
+        archive = bucket + ARCHIVE_SUFFIX
+        old_size = os.path.getsize(archive) if os.path.isfile(archive) else 0
+        writer = ArchiveWriter(archive, self.codec, self.level)
+        paths, scans, before = [], [], 0
+        try:
+            old_scans = set()
+            if old_size:
+                with ScanArchive(archive) as old:
+                    old_scans = set(old.scans())
+            for row_id, path in rows:
+                scan = os.path.relpath(os.path.normpath(path), bucket).replace(os.sep, '/')
+                if os.path.isdir(path):
+                    # 增量和去重引用的区域在这里还原为完整数据，归档不依赖基准版本和objects
+                    writer.add(scan, load_regions(list_regions(path)))
+                    before += dir_size(path)
+                    scans.append((scan, path))
+                elif scan not in old_scans:
+                    continue
+                paths.append((row_id, member_path(archive, scan)))
+            if old_size:
+                # 合并已有归档中本次没有重写的扫描
+                written = {scan for scan, _ in scans}
+                with ScanArchive(archive) as old:
+                    for scan in old.scans():
+                        if scan in written:
+                            continue
+                        writer.scan_id(scan)
+                        for k in old.keys(scan):
+                            data, size = old.read_frame(scan, k)
+                            if old.codec != self.codec:
+                                raw = decompress(old.codec, data, size)
+                                data, size = compress(self.codec, raw, self.level), len(raw)
+                            writer.add_frame(scan, k, data, size)
+            writer.commit()
+        except Exception as e:
+            writer.abort()
+            print(f"An error occurred: {e} in Tiering.archive_bucket")
+            return {'scans': 0, 'before': 0, 'after': 0}
+
+        # 归档落盘后再修改数据库，修改失败时保留原扫描目录，下次运行重新合并
+        if not DBUtils.update_pcd_paths(paths):
+            return {'scans': 0, 'before': 0, 'after': 0}
+        forget(moves=[(path, member_path(archive, scan)) for scan, path in scans])
+        for _, path in scans:
+            if pending_release(path):
+                with RegionStore(RegionStore.locate(path)) as store:
+                    store.release_scan(path)
+            shutil.rmtree(path, ignore_errors=True)
+            # 删除空的上级目录，直到时间目录
+            parent = os.path.dirname(os.path.normpath(path))
+            while len(parent) >= len(bucket):
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+        return {'scans': len(scans), 'before': before, 'after': os.path.getsize(archive) - old_size}
+
+    def run_once(self, now: datetime = None) -> dict:
+        """
+        归档所有已经超过保留时间的扫描
+        :return: {'buckets', 'scans', 'before', 'after'}
+        """
+        res = {'buckets': 0, 'scans': 0, 'before': 0, 'after': 0}
+        candidates = self.candidates(now)
+        if not candidates:
+            return res
+        for bucket, rows in candidates.items():
+            with ARCHIVE_LOCK:
+                stats = self.archive_bucket(bucket, rows)
+            if stats['scans']:
+                res['buckets'] += 1
+            for k in ('scans', 'before', 'after'):
+                res[k] += stats[k]
+        print(f"tiering: {res['scans']} scans in {res['buckets']} archives, "
+              f"{res['before']} -> {res['after']} bytes")
+        return res
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"An error occurred: {e} in Tiering._run")
+            self._stop.wait(self.interval)
+
+    def start(self) -> None:
+        """
+        在后台线程中定期运行
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="tiering", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+if __name__ == '__main__':
+    Tiering().run_once()
@@ -0,0 +1,328 @@
+"""
+@Author: zhang_zhiyi
+@Date: 2026/10/18_19:40
+@FileName:util_writer.py
+@LastEditors: zhang_zhiyi
+@version: 1.0
+@lastEditTime:
+@Description: 后台磁盘写入：扫描处理只负责编码，文件写入由少量写线程完成
+
+    1. 一次扫描输出到同一目录的所有文件作为一个任务提交，目录只创建一次，文件先写临时文件再替换
+    2. 同一目录的任务固定分配到同一个写线程，保证按提交顺序写入
+    3. 每个写线程的任务队列有界，写满时提交方阻塞
+    4. 持久化模式
+        none      不调用fsync，由操作系统决定何时落盘
+        scan      每个任务写完后fsync文件和目录
+        interval  每隔fsyncInterval秒统一fsync这段时间内写入的文件
+    5. submit返回Future，按持久化模式落盘后完成（interval模式在下一次统一fsync之后），写入失败时为异常；
+       batch()收集一次消息处理中提交的所有任务，消息在全部写完之后才向RabbitMQ确认
+"""
+import configparser
+import contextlib
+import multiprocessing.util
+import os
+import queue
+import threading
+import zlib
+from concurrent.futures import Future, wait as wait_futures
+
+CONFIG_PATH = '../config/receive.ini'
+
+DURABILITY_NONE = 'none'
+DURABILITY_SCAN = 'scan'
+DURABILITY_INTERVAL = 'interval'
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def fsync_path(path, directory=False) -> None:
+    """
+    将文件或目录项落盘
+    :param path: 文件或目录路径
+    :param directory: path是否为目录
+    """
+    if directory and os.name == 'nt':  # Windows不支持打开目录
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_files(directory, files: dict, sync=False) -> list:
+    """
+    在当前线程中写入同一目录的多个文件，目录只创建一次，文件先写临时文件再替换
+    :param directory: 输出目录
+    :param files: {文件名: bytes}，值为None的文件在其他文件写完后删除
+    :param sync: 是否fsync文件和目录
+    :return: 写入的文件路径
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for name, data in files.items():
+        if data is None:
+            continue
+        path = os.path.join(directory, name)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+        paths.append(path)
+    for name, data in files.items():
+        if data is None:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+    if sync:
+        fsync_path(directory, True)
+    return paths
+
+
+class WriteBatch(object):
+    """
+    DiskWriter.batch()收集的一组写入任务
+    """
+
+    def __init__(self):
+        self.futures = []
+
+    def future(self) -> Future:
+        """
+        :return: 所有任务完成后完成的Future，结果为是否全部写入成功
+        """
+        combined = Future()
+        futures = list(self.futures)
+        if not futures:
+            combined.set_result(True)
+            return combined
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            combined.set_result(all(f.exception() is None for f in futures))
+
+        for f in futures:
+            f.add_done_callback(done)
+        return combined
+
+
+class DiskWriter(object):
+    """
+    后台磁盘写入器
+    """
+
+    def __init__(self, threads=2, queue_size=64, durability=DURABILITY_SCAN, fsync_interval=5.0):
+        """
+        :param threads: 写线程数量，0表示在提交方线程中同步写入
+        :param queue_size: 每个写线程任务队列的最大长度
+        :param durability: 持久化模式 none/scan/interval
+        :param fsync_interval: interval模式的fsync间隔，单位秒
+        """
+        if durability not in (DURABILITY_NONE, DURABILITY_SCAN, DURABILITY_INTERVAL):
+            raise ValueError(f"unknown durability mode: {durability}")
+        self._durability = durability
+        self._fsync_interval = fsync_interval
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(threads)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._dirty = set()  # interval模式下等待fsync的文件和目录
+        self._unsynced = []  # interval模式下写完、等待fsync之后完成的Future
+        self._local = threading.local()
+        self._pending = {}  # 目录 -> 该目录最后提交的任务的Future
+        self._stopping = threading.Event()
+        self._flusher = None
+        self.written = 0
+        self.failed = 0
+        self.fsyncs = 0
+        self.pid = os.getpid()
+        for i, q in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(q,), name=f"disk-writer-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if durability == DURABILITY_INTERVAL:
+            self._flusher = threading.Thread(target=self._flush_loop, name="disk-writer-fsync", daemon=True)
+            self._flusher.start()
+
+    @property
+    def durability(self) -> str:
+        return self._durability
+
+    def depth(self) -> int:
+        """
+        等待写入的任务数量
+        """
+        return sum(q.qsize() for q in self._queues)
+
+    def metrics(self) -> dict:
+        """
+        队列深度、已写入文件数、写入失败的任务数和fsync次数
+        """
+        return {
+            'depth': self.depth(),
+            'written': self.written,
+            'failed': self.failed,
+            'fsyncs': self.fsyncs
+        }
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        在with块中收集当前线程提交的任务
+            with writer.batch() as batch:
+                ...
+            batch.future()
+        """
+        outer = getattr(self._local, 'batch', None)
+        batch = self._local.batch = WriteBatch()
+        try:
+            yield batch
+        finally:
+            # 嵌套使用时内层的任务同样属于外层
+            if outer is not None:
+                outer.futures.extend(batch.futures)
+            self._local.batch = outer
+
+    def submit(self, directory, files: dict) -> Future:
+        """
+        提交一次扫描的输出，写线程队列写满时阻塞
+        :param directory: 输出目录
+        :param files: {文件名: bytes}，值为None的文件被删除
+        :return: Future，按持久化模式落盘后结果为写入的文件路径，写入失败时为异常
+        """
+        future = Future()
+        batch = getattr(self._local, 'batch', None)
+        if batch is not None:
+            batch.futures.append(future)
+        task = (directory, files, future)
+        key = os.path.abspath(directory)
+        with self._lock:
+            self._pending[key] = future
+        future.add_done_callback(lambda f: self._done(key, f))
+        if not self._queues:
+            self._write(task)
+            return future
+        shard = zlib.crc32(os.path.abspath(directory).encode('utf-8')) % len(self._queues)
+        self._queues[shard].put(task)
+        return future
+
+    def _done(self, key, future) -> None:
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    def wait(self, directory) -> None:
+        """
+        等待已提交到该目录的任务写完，读取目录中现有文件之前调用
+        """
+        with self._lock:
+            future = self._pending.get(os.path.abspath(directory))
+        if future is not None:
+            wait_futures([future])
+
+    def _write(self, task) -> None:
+        directory, files, future = task
+        try:
+            paths = write_files(directory, files, self._durability == DURABILITY_SCAN)
+        except Exception as e:
+            self.failed += 1
+            print(f"An error occurred: {e} in DiskWriter._write")
+            future.set_exception(e)
+            return
+        self.written += len(paths)
+        if self._durability == DURABILITY_INTERVAL:
+            with self._lock:
+                self._dirty.update((path, False) for path in paths)
+                self._dirty.add((directory, True))
+                self._unsynced.append((future, paths))
+            return
+        if self._durability == DURABILITY_SCAN:
+            self.fsyncs += 1
+        future.set_result(paths)
+
+    def _run(self, q) -> None:
+        while True:
+            task = q.get()
+            try:
+                if task is None:
+                    break
+                self._write(task)
+            finally:
+                q.task_done()
+
+    def _sync_dirty(self) -> None:
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            unsynced, self._unsynced = self._unsynced, []
+        if not dirty:
+            return
+        # 先fsync文件再fsync目录
+        error = None
+        for path, directory in sorted(dirty, key=lambda e: e[1]):
+            try:
+                fsync_path(path, directory)
+            except FileNotFoundError:
+                pass  # 之后的任务删除了该文件
+            except OSError as e:
+                error = e
+        self.fsyncs += 1
+        for future, paths in unsynced:
+            if error is None:
+                future.set_result(paths)
+            else:
+                self.failed += 1
+                future.set_exception(error)
+
+    def _flush_loop(self) -> None:
+        while not self._stopping.wait(self._fsync_interval):
+            self._sync_dirty()
+
+    def flush(self) -> None:
+        """
+        等待已提交的任务全部写完，interval模式下立即fsync
+        """
+        for q in self._queues:
+            q.join()
+        if self._durability == DURABILITY_INTERVAL:
+            self._sync_dirty()
+
+    def close(self) -> None:
+        """
+        写完已提交的任务后停止写线程
+        """
+        if self._stopping.is_set():
+            return
+        self.flush()
+        self._stopping.set()
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._flusher is not None:
+            self._flusher.join()
+
+
+def get_writer() -> DiskWriter:
+    """
+    当前进程的磁盘写入器，按[Writer]配置创建；进程退出时（包括流水线工作进程）写完剩余任务
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None or os.getpid() != _writer.pid:
+            config = configparser.ConfigParser()
+            config.read(CONFIG_PATH)
+            _writer = DiskWriter(threads=config.getint("Writer", "threads", fallback=2),
+                                 queue_size=config.getint("Writer", "queueSize", fallback=64),
+                                 durability=config.get("Writer", "durability", fallback=DURABILITY_SCAN),
+                                 fsync_interval=config.getfloat("Writer", "fsyncInterval", fallback=5.0))
+            multiprocessing.util.Finalize(_writer, _writer.close, exitpriority=10)
+        return _writer